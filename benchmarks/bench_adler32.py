@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Measures throughput of sequential adler32() (with different block reading
+modes) against the ranged parallel computation of
+castlib3.checksum.ChecksumService on a single large file.
+
+Usage:
+    $ python benchmarks/bench_adler32.py [sizeMB [nWorkers [splitMB]]]
+
+Note, that the file is created right before measurement, so it is likely to
+reside in the page cache: the numbers show the CPU-bound limit. Drop caches
+(or point TMPDIR to the storage of interest with file larger than RAM) to
+measure the real storage throughput.
+"""
+
+import os, sys, time, tempfile
+
+from castlib3.checksum import adler32, ChecksumService
+
+def measure( f, *args ):
+    t = time.time()
+    r = f(*args)
+    return time.time() - t, r
+
+if '__main__' == __name__:
+    sizeMB   = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    nWorkers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    splitMB  = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    fd, path = tempfile.mkstemp( suffix='.dat' )
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            chunk = os.urandom( 1024*1024 )
+            for _ in range(sizeMB):
+                f.write(chunk)
+        tSeq, rSeq = measure( adler32, path )
+        print( 'sequential             : %7.1f MB/s'%(sizeMB/tSeq) )
+        for blocksize in (65536, 1024*1024):
+            for useMmap in (False, True):
+                t, r = measure( lambda: adler32( path, blocksize=blocksize
+                                               , useMmap=useMmap ) )
+                assert( r == rSeq )
+                print( '%-4s x %4d kB         : %7.1f MB/s'%( 'mmap' if useMmap else 'read'
+                        , blocksize/1024, sizeMB/t ) )
+        for processes in (False, True):
+            s = ChecksumService( nWorkers=nWorkers, processes=processes
+                               , splitSize=splitMB*1024*1024 )
+            tPar, rPar = measure( s.adler32, path )
+            s.shutdown()
+            assert( rPar == rSeq )
+            print( '%d %-9s x %3d MB : %7.1f MB/s (x%.2f)'%( nWorkers
+                    , 'processes' if processes else 'threads', splitMB
+                    , sizeMB/tPar, tSeq/tPar ) )
+    finally:
+        os.unlink(path)
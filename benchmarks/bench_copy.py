@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Measures throughput of local file copying methods of castlib3.copying
+against the naive read/write loop, for single file and for several files
+copied concurrently.
+
+Usage:
+    $ python benchmarks/bench_copy.py [sizeMB [nFiles [dir]]]
+
+Point `dir' to the filesystem of interest (reflink is supported by btrfs
+and XFS only). Source files are likely to reside in the page cache, so
+numbers show the copying overhead rather than storage throughput.
+"""
+
+import os, sys, time, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from castlib3.copying import copy_file, COPY_METHODS
+
+def naive_copy( src, dst, methods=None ):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        for block in iter(lambda: s.read(65536), b''):
+            d.write(block)
+    return 'naive'
+
+def measure( copier, srcs, dstDir, method, nThreads ):
+    dsts = [ os.path.join(dstDir, '%s-%d.dat'%(method, n)) for n in range(len(srcs)) ]
+    t = time.time()
+    with ThreadPoolExecutor(max_workers=nThreads) as pool:
+        used = set( pool.map( lambda p: copier(p[0], p[1], methods=[method]),
+                              zip(srcs, dsts) ) )
+    t = time.time() - t
+    for d in dsts:
+        os.unlink(d)
+    return t, used
+
+if '__main__' == __name__:
+    sizeMB = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    nFiles = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    root = tempfile.mkdtemp( dir=sys.argv[3] if len(sys.argv) > 3 else None )
+    try:
+        srcs = []
+        chunk = os.urandom( 1024*1024 )
+        for n in range(nFiles):
+            srcs.append( os.path.join(root, 'src-%d.dat'%n) )
+            with open(srcs[-1], 'wb') as f:
+                for _ in range(sizeMB):
+                    f.write(chunk)
+        for nThreads in (1, nFiles):
+            for method in ('naive',) + COPY_METHODS:
+                copier = naive_copy if 'naive' == method else copy_file
+                try:
+                    t, used = measure( copier, srcs[:nThreads], root, method, nThreads )
+                except Exception as e:
+                    print( '%-16s x %d : not supported (%s)'%(method, nThreads, e) )
+                    continue
+                print( '%-16s x %d : %8.1f MB/s'%( method, nThreads
+                                                 , nThreads*sizeMB/t ) )
+    finally:
+        shutil.rmtree(root)
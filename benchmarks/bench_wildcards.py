@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Compares compiled castlib3.filesystem.PathMatcher against the per-wildcard
+fnmatch filtering previously used by backends' listing routines on a flat
+listing of synthetic names.
+
+Usage:
+    $ python benchmarks/bench_wildcards.py [nNames]
+"""
+
+import sys, time, fnmatch, random
+
+from castlib3.filesystem import PathMatcher
+
+onlyPats = ['cdr*.dat', 'cdr*.raw', 'run-*', '*.root', 'meta-??.yml']
+ignorePats = ['*-tmp*', '*.part', '*~', '.*', '*-old.*']
+
+def per_pattern_filter( contentLst, onlyPats, ignorePats ):
+    """
+    Filtering as it was done by LocalBackend.get_dir_content() prior to
+    PathMatcher.
+    """
+    contentLst_ = []
+    for wcard in onlyPats:
+        contentLst_.extend( fnmatch.filter(contentLst, wcard) )
+    contentLst = contentLst_
+    for wcard in ignorePats:
+        contentLst = list(filter( lambda nm : \
+                            not fnmatch.fnmatch(nm, wcard), contentLst ))
+    return contentLst
+
+def synthetic_names( n, seed=1337 ):
+    rnd = random.Random(seed)
+    fmts = [ 'cdr%05d-%06d.dat', 'cdr%05d-%06d.raw', 'cdr%05d-%06d-tmp.dat'
+           , 'other%05d-%06d.txt', 'cdr%05d-%06d.dat.part', 'hist%05d-%06d.root' ]
+    return [ rnd.choice(fmts)%(rnd.randint(0, 99999), i) for i in range(n) ]
+
+def timeit( f, *args ):
+    best = None
+    for _ in range(3):
+        t = time.time()
+        res = f(*args)
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best, res
+
+if '__main__' == __name__:
+    nNames = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    names = synthetic_names( nNames )
+    tOld, resOld = timeit( per_pattern_filter, names, onlyPats, ignorePats )
+    tNew, resNew = timeit( lambda: PathMatcher( '/data'
+                                              , onlyFiles=onlyPats
+                                              , ignoreFiles=ignorePats ) \
+                                        .select( '/data', names, [] )[0] )
+    assert( sorted(resOld) == sorted(resNew) )
+    print( '%d names, %d selected' % (nNames, len(resNew)) )
+    print( 'per-wildcard fnmatch : %.3f sec' % tOld )
+    print( 'PathMatcher          : %.3f sec (x%.1f)' % (tNew, tOld/tNew) )
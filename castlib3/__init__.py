@@ -28,7 +28,7 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.sql.expression import ClauseElement
 
-from castlib3.models import DeclBase
+from castlib3.models import DeclBase, upgrade_schema
 
 from sqlalchemy.interfaces import PoolListener
 
@@ -46,6 +46,8 @@ def initialize_database(    engineCreateArgs,
                         autocommit=False,
                         autoflush=False))
     DeclBase.metadata.create_all(engine)
+    for column in upgrade_schema(engine):
+        gLogger.info( 'Column %s added to the database schema.'%column )
     return engine, dbS
 
 class _DatabaseShim(object):
@@ -22,9 +22,23 @@
 from __future__ import print_function
 
 from abc import ABCMeta, abstractmethod, abstractproperty
-import os, shlex, zlib, fnmatch, datetime
+import os, stat, shlex, time, datetime, functools
 from urlparse import urlparse
 from castlib3.models.filesystem import File, Folder
+from castlib3.filesystem import walk, PathMatcher
+from castlib3.copying import copy_file, append_tail, delta_rewrite, COPY_METHODS
+from castlib3.logs import gLogger
+from castlib3.checksum import adler32, adler32_range, digests, gDigestAlgorithms, \
+                             ChecksumService, ChecksumCache
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 backport (https://pypi.python.org/pypi/scandir)
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Keeps all the declared backends classes indexed by their schemes
 gCastlibBackends = {}
@@ -67,6 +81,45 @@ class AbstractBackend(object):
         """Shall return the hexidecimal digest built from the file content."""
         pass
 
+    def get_adler32_many(self, paths):
+        """
+        Generator yielding pairs of (path, adler32 digest) for given paths.
+        Backends able to compute checksums concurrently may yield them in
+        order of completion. Default implementation invokes get_adler32()
+        one by one.
+        """
+        for path in paths:
+            yield path, self.get_adler32(path)
+
+    def get_adler32_range(self, path, offset, length):
+        """
+        Shall return the hexidecimal adler32 digest of `length' bytes of file
+        starting from `offset'. Backends unable to read file partially do
+        not implement it.
+        """
+        raise NotImplementedError()
+
+    def get_digests(self, path, algos):
+        """
+        Returns dictionary of hexadecimal digests of file content indexed by
+        algorithm names. Backends able to compute several digests within
+        single read shall override it; default implementation invokes
+        get_<algo>() for each algorithm.
+        """
+        return dict( (algo, getattr(self, 'get_' + algo)(path)) for algo in algos )
+
+    def get_digests_many(self, paths, algos):
+        """
+        Generator yielding pairs of (path, digests dictionary) for given
+        paths (see get_digests() and get_adler32_many()).
+        """
+        if list(algos) == ['adler32']:
+            for path, a32 in self.get_adler32_many(paths):
+                yield path, {'adler32' : a32}
+            return
+        for path in paths:
+            yield path, self.get_digests(path, algos)
+
     @abstractmethod
     def get_size(self, path):
         """Returns size (in bytes) of given file. Directories aren't supported."""
@@ -124,7 +177,64 @@ class AbstractBackend(object):
         pass
 
     @abstractmethod
-    def get_dir_content( dirPath, virtualPath, onlyPats=None, ignorePats=None, extra={} ):
+    def get_folder_content( self, dirPath, matcher=None, withStats=False ):
+        """
+        Lists single folder (not recursively). Has to return pair of
+        content entry (see get_dir_content()) with empty `subFolders' list
+        and the list of sub-folders paths to be listed further. Both, files
+        and sub-folders have to be sorted and filtered with given
+        filesystem.PathMatcher instance (if any).
+        """
+        pass
+
+    def get_folder_modified(self, dirPath):
+        """
+        Returns the modification time of folder used by incremental listing
+        (see list_folder()). It is only compared with the value returned by
+        this method before, so backends may override it to obtain the time
+        cheaper than get_modified() does.
+        """
+        return self.get_modified( dirPath )
+
+    def list_folder(self, dirPath, matcher=None, withStats=False, unchanged=None):
+        """
+        Returns the same as get_folder_content() does, supporting the
+        incremental listing. If `unchanged' callable is given, it is invoked
+        with folder path and its current modification time:
+            unchanged(dirPath, modified) -> [subFolderName1, ...] or None
+        Returning list means that folder was not changed since it was
+        indexed, so it is not listed. Instead, the record with `unchanged'
+        (and `partial') flag and no files is returned and the traversal
+        proceeds to given sub-folders. Otherwise the folder is listed and
+        its modification time taken prior to listing is put in the record
+        as `modified'.
+
+        Note, that folder modification time reflects only the changes of
+        folder's entries list (creation, deletion or renaming), so the
+        modification of files content in-place remains unnoticed.
+        """
+        if unchanged is None:
+            return self.get_folder_content( dirPath, matcher=matcher
+                                          , withStats=withStats )
+        modified = self.get_folder_modified( dirPath )
+        subFolders = unchanged( dirPath, modified )
+        if subFolders is not None:
+            if matcher:
+                subFolders = matcher.select( dirPath, [], subFolders )[1]
+            return { 'folder' : dirPath
+                   , 'files' : set()
+                   , 'subFolders' : []
+                   , 'partial' : True
+                   , 'unchanged' : True }, \
+                   [ os.path.join(dirPath, d) for d in subFolders ]
+        entry, subdPaths = self.get_folder_content( dirPath, matcher=matcher
+                                                  , withStats=withStats )
+        entry['modified'] = modified
+        return entry, subdPaths
+
+    def get_dir_content( self, dirPath, onlyPats=None, ignorePats=None, extra={},
+                         withStats=False, nThreads=0, order='dfs', maxQueue=0,
+                         matcher=None, unchanged=None ):
         """
         Utility method returning list in form:
         [
@@ -132,14 +242,87 @@ class AbstractBackend(object):
                 'folder' : <pathPair>,
                 'files' : [<filename1>, <filename2>, ...]
                 'subFolders' : [ <dir1>, <dir2>, ... ],
+                'fileStats' : { <filename1> : <statPayload>, ... }  # optional
                 ...  # 
             },
             ...
         ]
         Will be invoked once by filesystem.discover_entries(). See additional
         information there.
+
+        When `withStats' is set, the backend may put the file attributes it
+        has obtained while listing the directory into `fileStats' dict,
+        indexed by filename. Values are dictionaries with keys named after
+        the `File' model attributes (`size', `modified', etc.), so they may
+        be directly forwarded to new_file() as `_stat' argument.
+
+        The tree is traversed with filesystem.walk() using
+        get_folder_content() for every folder. The `nThreads', `order' and
+        `maxQueue' are forwarded to walk(). Result does not depend on them.
+
+        Entries are filtered with `matcher' (filesystem.PathMatcher
+        instance). If it is not given, it will be built from `onlyPats' and
+        `ignorePats' wildcards.
+
+        The `unchanged' callable enables incremental listing, see
+        list_folder().
         """
-        pass
+        if matcher is None:
+            matcher = PathMatcher( dirPath, only=onlyPats, ignore=ignorePats )
+        def _expand( node ):
+            entry, subdPaths = self.list_folder( node[2]
+                                               , matcher=matcher
+                                               , withStats=withStats
+                                               , unchanged=unchanged )
+            # Reserve slots to keep sub-folders order regardless of
+            # traversal order:
+            entry['subFolders'] = [None]*len(subdPaths)
+            return entry, [ (entry, n, p) for n, p in enumerate(subdPaths) ]
+        ret = None
+        for (parent, n, path), entry in walk( [(None, 0, dirPath)], _expand
+                                            , order=order
+                                            , maxQueue=maxQueue
+                                            , nThreads=nThreads ):
+            if parent is None:
+                ret = entry
+            else:
+                parent['subFolders'][n] = entry
+        ret.update(extra)
+        return ret
+
+    def iter_dir_content( self, dirPath, onlyPats=None, ignorePats=None, extra={},
+                          withStats=False, nThreads=0, order='dfs', maxQueue=0,
+                          matcher=None, unchanged=None ):
+        """
+        Generator yielding flat folder records instead of the nested
+        structure returned by get_dir_content(). Each record is the same
+        dictionary as get_dir_content() returns for a folder, except that
+        `subFolders' is always empty and `parent' key refers to the
+        parent's `folder' value (None for the first record). Parent always
+        precedes its children; with default `order' the records follow in
+        depth-first pre-order. The `extra' is applied to the first record
+        only.
+
+        Folders are listed on demand, so only the paths of pending
+        sub-folders are kept in memory between iterations (and the ones
+        being listed ahead, if `nThreads' is set).
+        """
+        if matcher is None:
+            matcher = PathMatcher( dirPath, only=onlyPats, ignore=ignorePats )
+        def _expand( node ):
+            entry, subdPaths = self.list_folder( node[1]
+                                               , matcher=matcher
+                                               , withStats=withStats
+                                               , unchanged=unchanged )
+            return entry, [ (node[1], p) for p in subdPaths ]
+        for (parentPath, path), entry in walk( [(None, dirPath)], _expand
+                                             , order=order
+                                             , maxQueue=maxQueue
+                                             , nThreads=nThreads ):
+            entry['parent'] = parentPath
+            if parentPath is None:
+                entry.update(extra)
+            yield entry
 
     @abstractmethod
     def uri_from_path(self, path, *args, **kwargs):
@@ -160,15 +343,56 @@ class AbstractBackend(object):
         """
         pass
 
+    def append_file(self, srcURI, dstURI, offset, backends={}):
+        """
+        Has to append the content of srcURI following the first `offset'
+        bytes to the dstURI (which is known to be the `offset' bytes long
+        prefix of source). Backends unable to append files do not implement
+        it.
+        """
+        raise NotImplementedError()
+
+    def patch_file(self, srcURI, dstURI, backends={}):
+        """
+        Has to update the dstURI in place, transferring only the changed
+        parts of srcURI. Returns the number of bytes saved (not
+        transferred). Backends unable to patch files do not implement it.
+        """
+        raise NotImplementedError()
+
     def rewrite_file(self, srcURI, dstURI, backends={}):
         """
         This method may be used for incremental appending/patching the file
-        (in case of size or checksum mismatch). The default implementation
-        does not rely on appending/patching, but just deletes the copy and
-        copies original instead of it.
+        (in case of size or checksum mismatch). If the copy is shorter than
+        original and its adler32 checksum matches the checksum of the
+        original's prefix of the same length (i.e. original was appended
+        since it was copied), only the tail is transferred with
+        append_file(). Otherwise the copy is patched in place with
+        patch_file(). If backends support neither, the copy is deleted and
+        the original is copied instead of it.
         """
         origLPP = urlparse( srcURI )
         assert( (origLPP.scheme or 'file') in backends.keys() )
+        srcBackend = backends[origLPP.scheme or 'file']
+        # Do not query sizes nor read the original prefix if copy can't be
+        # appended anyway:
+        canAppend = self.append_file.__func__ is not AbstractBackend.append_file.__func__
+        try:
+            dstSize = self.get_size( dstURI ) if canAppend else 0
+            srcSize = srcBackend.get_size( srcURI ) if dstSize else 0
+            if 0 < dstSize < srcSize \
+                and int(srcBackend.get_adler32_range( srcURI, 0, dstSize ), 16) \
+                    == int(self.get_adler32( dstURI ), 16):
+                gLogger.info( 'Copy %s is a prefix of %s; appending %d '
+                        'bytes.'%(dstURI, srcURI, srcSize - dstSize) )
+                return None, self.append_file( srcURI, dstURI, dstSize
+                                             , backends=backends )
+        except NotImplementedError:
+            pass
+        try:
+            return None, self.patch_file( srcURI, dstURI, backends=backends )
+        except NotImplementedError:
+            pass
         delResult = self.del_file( dstURI )
         return delResult, self.cpy_file( srcURI, dstURI, backends=backends )
 
@@ -181,12 +405,21 @@ class AbstractBackend(object):
         """
         kwd = dict(kwargs)
         sf = kwd.pop('syncFields', ['modified', 'size'])
+        # Attributes obtained by backend during directory listing:
+        st = dict(kwd.pop('_stat', None) or {})
+        # Digests are obtained at once to read file content only once:
+        algos = [ k for k in sf if k in gDigestAlgorithms \
+                                and k not in kwd.keys() and k not in st.keys() ]
+        if len(algos) > 1:
+            st.update( self.get_digests(path, algos) )
         for k in sf:
             if k in kwd.keys():
                 # Attribute was explicitly set.
                 continue
+            if k in st.keys():
+                kwd[k] = st[k]
+                continue
             kwd[k] = getattr(self, 'get_' + k)(path)
-        #print( '\nXXX:', kwd )  # XXX
         return File( **kwd )
 
     def new_folder( self, path, **kwargs ):
@@ -206,12 +439,19 @@ class AbstractBackend(object):
 #
 # Local backend
 
-def adler32( filename, blocksize=65536 ):
-    checksum = zlib.adler32("")
-    with open(filename, "rb") as f:
-        for block in iter(lambda: f.read(blocksize), b""):
-            checksum = zlib.adler32(block, checksum)
-    return checksum & 0xffffffff
+def stat_payload( st ):
+    """
+    Converts the os.stat() result into dictionary used as `fileStats' values
+    within get_dir_content() output.
+    """
+    return {
+            'size' : st.st_size,
+            'modified' : datetime.datetime.fromtimestamp(st.st_mtime),
+            'mtime' : st.st_mtime,
+            'mode' : st.st_mode,
+            'inode' : st.st_ino,
+            'device' : st.st_dev
+        }
 
 class LocalBackend(AbstractBackend):
     """
@@ -224,12 +464,145 @@ class LocalBackend(AbstractBackend):
             'scheme' : 'file'
     }
 
+    def __init__(self, checksumWorkers=0, checksumIOLimit=0, checksumProcesses=True,
+                       checksumSplitSize=0, checksumBlockSize=65536,
+                       checksumMmap=False, checksumDropCache=False,
+                       checksumCache=None, checksumCacheMaxAge=0,
+                       copyMethods=COPY_METHODS, deltaBlockSize=0 ):
+        """
+        If `checksumWorkers' is greater than one, the bulk checksum requests
+        (see get_adler32_many()) will be served by the pool of
+        `checksumWorkers' processes (threads, if `checksumProcesses' is
+        False) reading at most `checksumIOLimit' files simultaneously. The
+        files larger than `checksumSplitSize' bytes (if non-zero) will be
+        checksummed by ranges of this size in parallel.
+
+        Files are read by blocks of `checksumBlockSize' bytes into reusable
+        buffer or, if `checksumMmap' is set, through memory mapping. The
+        `checksumDropCache' flag makes the read pages to be evicted from page
+        cache, so the bulk checksumming does not push out the hot data.
+
+        If `checksumCache' path is given, the computed checksums are stored
+        in this SQLite file and reused for files whose inode, size and
+        modification time were not changed (see ChecksumCache).
+
+        The `copyMethods' list restricts the copying methods used by
+        cpy_file() (see castlib3.copying.COPY_METHODS). If `deltaBlockSize'
+        is non-zero, the modified copies are patched in place by blocks of
+        this size instead of being copied again (see patch_file()).
+        """
+        self.copyMethods = copyMethods
+        self.deltaBlockSize = deltaBlockSize
+        self.readerOptions = { 'blocksize' : checksumBlockSize
+                             , 'useMmap' : checksumMmap
+                             , 'dropCache' : checksumDropCache }
+        self.checksumService = None
+        if checksumWorkers > 1:
+            self.checksumService = ChecksumService( nWorkers=checksumWorkers
+                                                  , ioLimit=checksumIOLimit
+                                                  , processes=checksumProcesses
+                                                  , splitSize=checksumSplitSize
+                                                  , readerOptions=self.readerOptions )
+        self.checksumCache = None
+        if checksumCache:
+            self.checksumCache = ChecksumCache( os.path.expanduser(checksumCache)
+                                              , maxAge=checksumCacheMaxAge )
+
+    def _cached_digests(self, localPath, algos):
+        """
+        Returns pair of dictionary with digests found in checksum cache and
+        the file stat to be used for storing computed ones.
+        """
+        if self.checksumCache is None:
+            return {}, None
+        st = os.stat(localPath)
+        ret = {}
+        for algo in algos:
+            digest = self.checksumCache.get( localPath, algo=algo, st=st )
+            if digest is not None:
+                ret[algo] = digest
+        return ret, st
+
+    def _store_digests(self, localPath, digestsDict, st):
+        if self.checksumCache is None:
+            return
+        for algo, digest in digestsDict.iteritems():
+            self.checksumCache.put( localPath, digest, algo=algo, st=st )
+
     def get_adler32(self, path):
         """Shall return the hexidecimal digest built from the file content."""
         #raise NotImplementedError('Checksum calculation for %s algorithm '
         #            'is not being implemented.'%algo)
         lpp = urlparse(path)
-        return '%x'%adler32( lpp.path )
+        cached, st = self._cached_digests( lpp.path, ['adler32'] )
+        if cached:
+            return cached['adler32']
+        if self.checksumService is not None and self.checksumService.splitSize:
+            digest = '%x'%self.checksumService.adler32( lpp.path )
+        else:
+            digest = '%x'%adler32( lpp.path, **self.readerOptions )
+        self._store_digests( lpp.path, {'adler32' : digest}, st )
+        return digest
+
+    def get_adler32_many(self, paths):
+        if self.checksumService is None:
+            for p in super(LocalBackend, self).get_adler32_many(paths):
+                yield p
+            return
+        uris, stats = {}, {}
+        for p in paths:
+            lp = urlparse(p).path
+            cached, stats[lp] = self._cached_digests( lp, ['adler32'] )
+            if cached:
+                yield p, cached['adler32']
+                continue
+            uris[lp] = p
+        for lp, checksum in self.checksumService.imap_unordered(uris.keys()):
+            self._store_digests( lp, {'adler32' : '%x'%checksum}, stats[lp] )
+            yield uris[lp], '%x'%checksum
+
+    def get_adler32_range(self, path, offset, length):
+        lpp = urlparse(path)
+        return '%x'%adler32_range( lpp.path, offset, length, **self.readerOptions )
+
+    def get_md5(self, path):
+        return self.get_digests( path, ['md5'] )['md5']
+
+    def get_crc32c(self, path):
+        return self.get_digests( path, ['crc32c'] )['crc32c']
+
+    def get_digests(self, path, algos):
+        """
+        Computes all the requested digests within single read of file.
+        """
+        if list(algos) == ['adler32']:
+            return {'adler32' : self.get_adler32(path)}
+        lpp = urlparse(path)
+        ret, st = self._cached_digests( lpp.path, algos )
+        missing = [ algo for algo in algos if algo not in ret ]
+        if missing:
+            computed = digests( lpp.path, missing, **self.readerOptions )
+            self._store_digests( lpp.path, computed, st )
+            ret.update(computed)
+        return ret
+
+    def get_digests_many(self, paths, algos):
+        if self.checksumService is None or list(algos) == ['adler32']:
+            for p in super(LocalBackend, self).get_digests_many(paths, algos):
+                yield p
+            return
+        uris, stats = {}, {}
+        for p in paths:
+            lp = urlparse(p).path
+            cached, stats[lp] = self._cached_digests( lp, algos )
+            if len(cached) == len(algos):
+                yield p, cached
+                continue
+            uris[lp] = p
+        func = functools.partial( digests, algos=tuple(algos), **self.readerOptions )
+        for lp, computed in self.checksumService.imap_unordered(uris.keys(), func=func):
+            self._store_digests( lp, computed, stats[lp] )
+            yield uris[lp], computed
 
     def get_size(self, path):
         """Returns size (in bytes) of given file. Directories aren't supported."""
@@ -242,7 +615,14 @@ class LocalBackend(AbstractBackend):
         return datetime.datetime.fromtimestamp(mt)
 
     def set_modified(self, path, dtObject):
-        raise NotImplementedError()
+        """
+        Sets the modification time of file (access time is left intact).
+        The datetime object is treated as local time, as get_modified()
+        returns.
+        """
+        lpp = urlparse(path)
+        ts = time.mktime(dtObject.timetuple()) + dtObject.microsecond*1e-6
+        os.utime( lpp.path, (os.stat(lpp.path).st_atime, ts) )
 
     def get_permissions(self, path):
         """Returns encoded permissions."""
@@ -283,42 +663,122 @@ class LocalBackend(AbstractBackend):
         return os.path.islink(path)
 
     def del_file(self, path):
-        raise NotImplementedError()  # TODO
+        lpp = urlparse(path)
+        os.unlink( lpp.path )
 
     def cpy_file(self, srcURI, dstURI, backends={} ):
-        raise NotImplementedError()  # TODO
-
-    def get_dir_content(self, dirPath, onlyPats=None, ignorePats=None, extra={} ):
-        # Get list of all files and sub-directories in current dir
-        contentLst = [f for f in self.listdir(dirPath) \
-            if self.isfile(os.path.join(dirPath, f)) \
-                or self.isdir(os.path.join(dirPath, f))]
-        if onlyPats:
-            if type(onlyPats) is str:
-                onlyPats = [onlyPats,]
-            contentLst_ = []
-            for wcard in onlyPats:
-                contentLst_.extend( fnmatch.filter(contentLst, wcard) )
-            contentLst = contentLst_
-        if ignorePats:
-            if type(ignorePats) is str:
-                ignorePats = [ignorePats,]
-            for wcard in ignorePats:
-                contentLst = list(filter( lambda nm : \
-                                    not fnmatch.fnmatch(nm, wcard), contentLst ))
-        files = [ f for f in contentLst if self.isfile(os.path.join(dirPath, f)) ]
-        subds = [ d for d in contentLst if self.isdir(os.path.join(dirPath, d)) ]
+        """
+        Copies local file by means of kernel (reflink, copy_file_range(2) or
+        sendfile(2), whichever is supported, see castlib3.copying), creating
+        destination directory if need. Safe to be invoked concurrently.
+        Returns the name of the copying method used.
+        """
+        srcLPP = urlparse(srcURI)
+        dstLPP = urlparse(dstURI)
+        if srcLPP.scheme not in ('', 'file'):
+            raise NotImplementedError('Local backend currently does not '
+                    'support copy from locations other than local.')
+        dstDir = os.path.dirname(dstLPP.path)
+        if dstDir and not os.path.isdir(dstDir):
+            try:
+                os.makedirs(dstDir)
+            except OSError:
+                # May be created by concurrent copy meanwhile
+                if not os.path.isdir(dstDir):
+                    raise
+        method = copy_file( srcLPP.path, dstLPP.path, methods=self.copyMethods )
+        gLogger.debug( 'File %s copied to %s (%s).'%(srcURI, dstURI, method) )
+        return method
+
+    def append_file(self, srcURI, dstURI, offset, backends={}):
+        """
+        Appends the tail of local file following `offset' bytes to the
+        copy by means of kernel (see cpy_file()). Returns the name of the
+        copying method used.
+        """
+        srcLPP = urlparse(srcURI)
+        if srcLPP.scheme not in ('', 'file'):
+            raise NotImplementedError('Local backend currently does not '
+                    'support appending from locations other than local.')
+        return append_tail( srcLPP.path, urlparse(dstURI).path, offset
+                          , methods=self.copyMethods )
+
+    def patch_file(self, srcURI, dstURI, backends={}):
+        """
+        Rewrites only the blocks of copy that differ from the local
+        original (see castlib3.copying.delta_rewrite()), if `deltaBlockSize'
+        was set. Returns the number of bytes saved.
+        """
+        srcLPP = urlparse(srcURI)
+        if not self.deltaBlockSize or srcLPP.scheme not in ('', 'file'):
+            raise NotImplementedError()
+        written, saved = delta_rewrite( srcLPP.path, urlparse(dstURI).path
+                                      , blockSize=self.deltaBlockSize )
+        gLogger.info( 'Copy %s patched: %d bytes written, %d bytes saved.'%(
+                    dstURI, written, saved) )
+        return saved
+
+    def scan_dir(self, path, withStats=False):
+        """
+        Lists the directory given by URI within single pass. Returns the
+        tuple of (files, subFolders, stats) where `files' and `subFolders'
+        are sorted lists of names of regular files and directories
+        correspondingly (symbolic links are followed, other entries are
+        omitted). The `stats' is a dictionary of stat_payload() values
+        indexed by entry name, filled only when `withStats' is set.
+
+        When `scandir' is available, entry types are determined from the
+        directory listing itself, so no stat() calls are performed unless
+        `withStats' is requested. Otherwise, exactly one stat() call is
+        performed per entry.
+        """
+        dirPath = urlparse(path).path
+        files, subds, stats = [], [], {}
+        if scandir is not None:
+            for entry in scandir(dirPath):
+                try:
+                    if entry.is_file():
+                        dest = files
+                    elif entry.is_dir():
+                        dest = subds
+                    else:
+                        continue
+                    if withStats:
+                        stats[entry.name] = stat_payload(entry.stat())
+                except OSError:
+                    # Entry vanished or is a dangling symlink
+                    continue
+                dest.append(entry.name)
+        else:
+            for name in os.listdir(dirPath):
+                try:
+                    st = os.stat(os.path.join(dirPath, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files.append(name)
+                elif stat.S_ISDIR(st.st_mode):
+                    subds.append(name)
+                else:
+                    continue
+                if withStats:
+                    stats[name] = stat_payload(st)
+        files.sort()
+        subds.sort()
+        return files, subds, stats
+
+    def get_folder_content(self, dirPath, matcher=None, withStats=False ):
+        files, subds, stats = self.scan_dir(dirPath, withStats=withStats)
+        if matcher:
+            files, subds = matcher.select( dirPath, files, subds )
         ret = {
             'folder' : dirPath,
             'files' : set(files),
             'subFolders' : []
         }
-        for subd in subds:
-            ret['subFolders'].append(
-                        self.get_dir_content( os.path.join(dirPath, subd),
-                                        onlyPats=onlyPats, ignorePats=ignorePats) )
-        ret.update(extra)
-        return ret
+        if withStats:
+            ret['fileStats'] = dict( (f, stats[f]) for f in files )
+        return ret, [ os.path.join(dirPath, d) for d in subds ]
 
     def uri_from_path(self, path):
         return 'file://' + path
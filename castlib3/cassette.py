@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Record/replay of shell utils invocations. In record mode every util
+invocation (name, command line arguments, return code, stdout, stderr
+and wall time) is appended to the cassette file; in replay mode the
+recorded results are served back instead of running the utils, so the
+parsing, database and stages code may be exercised (and profiled) with
+captured workload without access to the actual services.
+"""
+
+import json, threading, time
+
+class Cassette(object):
+    """
+    Cassette file consists of JSON lines, one per invocation:
+        {"util" : <name>, "args" : [<arg1>, ...], "rc" : <returnCode>,
+         "stdout" : <str>, "stderr" : <str>, "time" : <wallTimeSec>}
+    Null return code denotes the invocation killed due to timeout. Output
+    strings are stored as latin-1 decoded, so any bytes are kept intact.
+
+    On replay the invocations are looked up by util name and arguments.
+    Repeated invocations are served with the records in order they were
+    recorded; once they are exhausted, the last one is repeated. If
+    `latency' is set, the recorded wall time is reproduced with sleep.
+    """
+    def __init__(self, filename, mode='record', latency=False):
+        if mode not in ('record', 'replay'):
+            raise ValueError( 'Unknown cassette mode: "%s".'%mode )
+        self.filename = filename
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.nRecorded = self.nReplayed = 0
+        if self.replaying:
+            self._records, self._served = {}, {}
+            with open(filename) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    r = json.loads( line )
+                    key = self._key( r['util'], r['args'] )
+                    self._records.setdefault( key, [] ).append( r )
+            self._file = None
+        else:
+            self._file = open( filename, 'a' )
+
+    @property
+    def replaying(self):
+        return 'replay' == self.mode
+
+    @staticmethod
+    def _key(name, args):
+        return (unicode(name), tuple(a if type(a) is unicode else str(a).decode('latin-1')
+                                     for a in args))
+
+    def record(self, name, args, returnCode, stdout, stderr, wallTime):
+        line = json.dumps( { 'util' : name, 'args' : list(args), 'rc' : returnCode
+                           , 'stdout' : stdout, 'stderr' : stderr
+                           , 'time' : round(wallTime, 6) }
+                         , encoding='latin-1', sort_keys=True )
+        with self._lock:
+            self._file.write( line + '\n' )
+            self._file.flush()
+            self.nRecorded += 1
+
+    def replay(self, name, args):
+        """
+        Returns recorded triplet of (returnCode, stdout, stderr) of util
+        invocation. The return code is None for timed out invocation.
+        """
+        key = self._key( name, args )
+        with self._lock:
+            records = self._records.get( key, None )
+            if not records:
+                raise RuntimeError( 'Cassette %s has no record of `%s\' util '
+                        'invoked with %r.'%(self.filename, name, list(args)) )
+            n = self._served.get( key, 0 )
+            self._served[key] = n + 1
+            self.nReplayed += 1
+        r = records[min(n, len(records) - 1)]
+        if self.latency:
+            time.sleep( r['time'] )
+        return r['rc'], r['stdout'].encode('latin-1'), r['stderr'].encode('latin-1')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __str__(self):
+        return '%s (%s): %d recorded, %d replayed'%( self.filename, self.mode
+                                                   , self.nRecorded, self.nReplayed )
@@ -22,11 +22,84 @@
 from __future__ import print_function
 
 from castlib3.backend import AbstractBackend, BackendMetaclass
-from castlib3.shell import invoke_util
-from castlib3.castor.parsing import rxNSLS, obtain_rfstat_timestamps, rxsNSLS
+from castlib3.shell import invoke_util, iter_invoke_util, iter_util_lines
+from castlib3.castor.parsing import rxNSLS, obtain_rfstat_timestamps, rxsNSLS, \
+                                   iter_nsls_recursive, nsls_timestamp, \
+                                   NSLS_TIMESTAMP_PRECISIONS
+from castlib3.filesystem import PathMatcher
 from urlparse import urlparse, urlunparse
 from castlib3.logs import gLogger
-import fnmatch, datetime
+from castlib3.syscfg import gConfig
+import os, datetime, time, threading
+
+class ListingCache(object):
+    """
+    Keeps the parsed `nsls' listings of directories for `ttl' seconds, so
+    the queries on individual entries (size, checksum, type) may be
+    answered from the parent directory listing. Thread-safe.
+
+    Listing started before the directory was invalidated (e.g. by another
+    thread uploading the file there) is stale, so the generation obtained
+    with generation() prior to listing has to be given to put(): the
+    listing is not stored if the directory was invalidated since then.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._listings = {}  # dirPath -> (timestamp, {name : entry})
+        self._generation = 0
+        self._invalidatedAt = {}  # dirPath -> generation of last invalidation
+        self.hits = self.misses = self.invalidated = 0
+
+    def get(self, dirPath):
+        """
+        Returns cached {name : entry} dictionary of directory or None.
+        """
+        with self._lock:
+            cached = self._listings.get( dirPath )
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            return None
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, dirPath, entries, generation):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if self._invalidatedAt.get( dirPath, -1 ) >= generation:
+                return
+            self._listings[dirPath] = (time.time(), entries)
+
+    def invalidate(self, dirPath):
+        with self._lock:
+            self._invalidatedAt[dirPath] = self._generation
+            self._generation += 1
+            if self._listings.pop( dirPath, None ) is not None:
+                self.invalidated += 1
+
+    def __str__(self):
+        return '%d hits, %d misses, %d invalidated'%(
+                self.hits, self.misses, self.invalidated )
+
+def entry_name( entry ):
+    """
+    Returns name of rxNSLS entry. The symbolic links targets (`name ->
+    target') are stripped.
+    """
+    if 'l' == entry['mode'][0]:
+        return entry['filename'].split(' -> ')[0]
+    return entry['filename']
+
+def index_entries( entries ):
+    """
+    Returns dictionary of rxNSLS entries indexed by name.
+    """
+    return dict( (entry_name(e), e) for e in entries )
 
 class CASTORBackend(AbstractBackend):
     __metaclass__ = BackendMetaclass
@@ -34,68 +107,236 @@ class CASTORBackend(AbstractBackend):
         'scheme' : 'castor'
     }
 
-    def __init__(self, tmpDir=None, castorNetLoc='castorpublic.cern.ch'):
+    def __init__(self, tmpDir=None, castorNetLoc='castorpublic.cern.ch',
+                 recursiveListing=False, listingTTL=60, mtimePrecision='second',
+                 nConcurrentUtils=8):
+        """
+        When `recursiveListing' is set, get_dir_content() and
+        iter_dir_content() obtain the whole tree with single invocation of
+        `nsls-recursive' util (expected to be `nsls -lR' with the same
+        columns as `nsls' util prints) instead of listing every folder
+        separately. The util has to be present in `utils' config section
+        (see README).
+
+        Directory listings are cached for `listingTTL' seconds (see
+        ListingCache), so the entry attributes are taken from the parent
+        directory listing. Zero value disables caching.
+
+        The file attributes (size, adler32 and modification time) are taken
+        from the listing as well. Modification time is printed by nsls with
+        precision depending on the listing flags and entry age (see
+        nsls_timestamp()); if it is less than `mtimePrecision' (one of
+        'day', 'minute' or 'second'), the `rfstat' util is invoked for the
+        entry instead. Only the full timestamps (`YYYY-MM-DD HH:MM:SS') have
+        'second' precision, while the utils templates given in README print
+        ls-style times. So with these templates and the default precision
+        the rfstat is still invoked once per entry whose modification time
+        is requested; coarser `mtimePrecision' saves these invocations at
+        the cost of truncated times.
+
+        The batched queries (e.g. get_adler32_many()) list the directories
+        concurrently, running up to `nConcurrentUtils' utils at once.
+        """
         #self.tmpDir = os.mkdir(tmpDir) if not exists
         # TODO: try to create temp dir if it doesn't exist
         self.castorNetLoc = castorNetLoc
+        self.recursiveListing = recursiveListing
+        if recursiveListing and 'nsls-recursive' not in gConfig.get('utils', {}):
+            raise RuntimeError( 'Recursive listing requires the `nsls-recursive\' '
+                    'util to be configured, e.g.: "nsls-recursive: nsls -lR '
+                    '--class --checksum {remotePath}".' )
+        self.listingCache = ListingCache( listingTTL )
+        if mtimePrecision not in NSLS_TIMESTAMP_PRECISIONS:
+            raise ValueError( 'Unknown timestamp precision: "%s".'%mtimePrecision )
+        self.mtimePrecision = mtimePrecision
+        self.nConcurrentUtils = nConcurrentUtils
+
+    def _listing(self, dirPath, noexcept=False):
+        """
+        Returns {name : entry} dictionary of (possibly cached) directory
+        listing.
+        """
+        entries = self.listingCache.get( dirPath )
+        if entries is None:
+            generation = self.listingCache.generation()
+            entries = index_entries( invoke_util( 'nsls', timeout='long'
+                                                , noexcept=noexcept
+                                                , remotePath=dirPath
+                                                , regexToApply=rxNSLS ) )
+            self.listingCache.put( dirPath, entries, generation )
+        return entries
+
+    def iter_listings(self, dirPaths):
+        """
+        Generator yielding pairs of (dirPath, {name : entry}) for given
+        directories. Cached listings are yielded first, the rest of
+        directories are listed concurrently and yielded in order of
+        completion.
+        """
+        toList = []
+        for dirPath in set(dirPaths):
+            entries = self.listingCache.get( dirPath )
+            if entries is None:
+                toList.append( dirPath )
+            else:
+                yield dirPath, entries
+        calls = [ ('nsls', { 'timeout' : 'long', 'noexcept' : True
+                           , 'remotePath' : dirPath, 'regexToApply' : rxNSLS })
+                  for dirPath in toList ]
+        generation = self.listingCache.generation()
+        for n, entries in iter_invoke_util( calls, nConcurrent=self.nConcurrentUtils ):
+            entries = index_entries( entries )
+            self.listingCache.put( toList[n], entries, generation )
+            yield toList[n], entries
+
+    def _entry(self, path):
+        """
+        Returns rxNSLS entry of given path, looking it up within the parent
+        directory listing if it is cached. Otherwise, the entry itself is
+        listed (the cache is not filled then, as listing of the whole
+        directory for single entry is costly, e.g. for each file uploaded
+        into it). Returns None if entry does not exist.
+        """
+        path = urlparse(path).path.rstrip('/')
+        dirPath, name = os.path.split( path )
+        entries = self.listingCache.get( dirPath ) if name else None
+        if entries is not None:
+            return entries.get( name, None )
+        entries = invoke_util( 'nsls-dir', dirPath=path or '/'
+                             , noexcept=True, regexToApply=rxNSLS )
+        return entries[0] if entries else None
+
+    def _existing_entry(self, path):
+        entry = self._entry( path )
+        if entry is None:
+            raise RuntimeError( 'No such CASTOR entry: "%s".'%path )
+        return entry
+
+    def _invalidate(self, path):
+        self.listingCache.invalidate( os.path.dirname(urlparse(path).path.rstrip('/')) )
+
+    def _entry_modified(self, entry):
+        """
+        Returns modification time of nsls entry or None, if its precision is
+        insufficient.
+        """
+        dt, precision = nsls_timestamp( entry )
+        if NSLS_TIMESTAMP_PRECISIONS.index( precision ) \
+                < NSLS_TIMESTAMP_PRECISIONS.index( self.mtimePrecision ):
+            return None
+        return dt
+
+    def stat_payload(self, entry):
+        """
+        Returns dictionary of file attributes available in nsls entry (see
+        `fileStats' of get_dir_content()).
+        """
+        ret = { 'size' : int(entry['fileSize']) }
+        if entry['adler32']:
+            ret['adler32'] = entry['adler32']
+        modified = self._entry_modified( entry )
+        if modified is not None:
+            ret['modified'] = modified
+        return ret
 
     def get_adler32(self, path):
-        lpp = urlparse(path)
-        return invoke_util( 'nsls'
-                          , remotePath=lpp.path
-                          , regexToApply=rxNSLS)[0]['adler32']
+        return self._existing_entry( path )['adler32']
+
+    def get_adler32_many(self, paths):
+        """
+        Obtains checksums from the listings of parent directories, listing
+        them concurrently (see iter_listings()).
+        """
+        byDir = {}
+        for uri in paths:
+            dirPath, name = os.path.split( urlparse(uri).path.rstrip('/') )
+            byDir.setdefault( dirPath, [] ).append( (uri, name) )
+        for dirPath, entries in self.iter_listings( byDir.keys() ):
+            for uri, name in byDir[dirPath]:
+                if name not in entries:
+                    raise RuntimeError( 'No such CASTOR entry: "%s".'%uri )
+                yield uri, entries[name]['adler32']
 
     def get_permissions(self, path):
         raise NotImplementedError()
 
     def get_size(self, path):
-        lpp = urlparse(path)
-        return int(invoke_util( 'nsls-dir'
-                              , dirPath=lpp.path
-                              , regexToApply=rxNSLS)[0]['fileSize'])
+        return int( self._existing_entry( path )['fileSize'] )
     
     def get_modified(self, path):
+        entry = self._entry( path )
+        modified = self._entry_modified( entry ) if entry else None
+        if modified is not None:
+            return modified
         rfsOut = invoke_util( 'rfstat', remotePath=urlparse(path).path )[1]
         r = obtain_rfstat_timestamps( rfsOut )['modTimestamp']
         return datetime.datetime.fromtimestamp(r)
 
+    def get_folder_modified(self, dirPath):
+        """
+        Takes the folder modification time from the listing of its parent
+        (listed once for all the siblings and cached) whatever precision it
+        has, since it is only compared with the value obtained the same way
+        before. Listing time of folder changed within the last minutes is
+        not reliable (next changes of the same minute won't change it), so
+        the rfstat is invoked for such folders.
+        """
+        path = urlparse(dirPath).path.rstrip('/')
+        parentPath, name = os.path.split( path )
+        entry = self._listing( parentPath, noexcept=True ).get( name, None ) \
+                if name else None
+        if entry is not None:
+            dt, precision = nsls_timestamp( entry )
+            if 'second' == precision \
+                    or datetime.datetime.now() - dt > datetime.timedelta(minutes=2):
+                return dt
+        return self.get_modified( dirPath )
+
     def set_modified(self, path, dtObject):
         lpp = urlparse(path)
+        self._invalidate( path )
         return invoke_util( 'updtstamp'
                               , key='m'
                               , timestamp=dtObject.strftime('%Y%m%d%H%M')
                               , hsmDestFile=lpp.path )
 
+    def iter_listdir(self, path):
+        """
+        Generator yielding names of directory entries. Unless the listing is
+        cached, the names are yielded as nsls prints them, so the listing of
+        huge directory is never kept in memory.
+        """
+        dirPath = urlparse(path).path.rstrip('/') or '/'
+        entries = self.listingCache.get( dirPath )
+        if entries is not None:
+            for name in entries.iterkeys():
+                yield name
+            return
+        for e in iter_util_lines( 'nsls', timeout='long'
+                                , remotePath=dirPath
+                                , regexToApply=rxNSLS ):
+            yield entry_name( e )
+
     def listdir(self, path):
-        lpp = urlparse(path)
-        return map( lambda e: e['filename'],
-                invoke_util( 'nsls'
-                            , timeout='long'
-                            , remotePath=lpp.path
-                            , regexToApply=rxNSLS) )
+        return sorted( self.iter_listdir( path ) )
+
+    def _entry_type(self, path):
+        entry = self._entry( path )
+        return entry['mode'][0] if entry else None
 
     def isfile(self, path):
-        lpp = urlparse(path)
-        fb = invoke_util( 'nsls-dir'
-                        , dirPath=lpp.path
-                        , regexToApply=rxNSLS)['mode'][0][0]
+        fb = self._entry_type( path )
         return '-' == fb or 'm' == fb
 
     def isdir(self, path):
-        lpp = urlparse(path)
-        fb = invoke_util( 'nsls-dir'
-                        , dirPath=lpp.path
-                        , regexToApply=rxNSLS)['mode'][0][0]
-        return 'd' == fb
+        return 'd' == self._entry_type( path )
 
     def islink(self, path):
-        fb = invoke_util( 'nsls-dir'
-                        , dirPath=path
-                        , regexToApply=rxNSLS)['mode'][0][0]
-        return 'l' == fb
+        return 'l' == self._entry_type( path )
 
     def del_file(self, path):
         lpp = urlparse(path)
+        self._invalidate( path )
         return invoke_util('nsrmFile', hsmFile=lpp.path)
 
     def cpy_file(self, srcURI, dstURI, backends={} ):
@@ -117,49 +358,121 @@ class CASTORBackend(AbstractBackend):
                                 , '/' + dstLPP.path     # path
                                 , '', '', ''            # params, query, fragment
                                 ) )
+        self._invalidate( dstURI )
         return invoke_util( 'xrdcp'
                           , srcURI=srcURI
                           , dstURI=dstURImod
                           , timeout='long' )
 
-    def get_dir_content(self, uri, onlyPats=None, ignorePats=None, extra={} ):
-        # Get list of all files and sub-directories in current dir
-        ppl = urlparse(uri)
-        entries = invoke_util('nsls', timeout='long', remotePath=ppl.path, regexToApply=rxNSLS)
-        gLogger.debug('Acquired contents list of "%s".'%ppl.path)
+    def _folder_record(self, uri, entries, matcher, withStats):
+        """
+        Returns folder record and names of sub-folders built from the nsls
+        entries of folder.
+        """
         # Get rid from the logically deleted files and symlinks. The only types
         # to remain is files and directories: '-', 'm' and 'd'.
         entries = filter( lambda e: e['mode'][0] in 'md-', entries )
-        if onlyPats:
-            if type(onlyPats) is str:
-                onlyPats = [onlyPats,]
-            contentLst_ = []
-            for wcard in onlyPats:
-                contentLst_.extend(
-                    filter(
-                        lambda e: fnmatch.fnmatch(e['filename'], wcard), 
-                        entries ) )
-            entries = contentLst_
-        if ignorePats:
-            if type(ignorePats) is str:
-                ignorePats = [ignorePats,]
-            for wcard in ignorePats:
-                entries = list(filter( lambda e: \
-                                    not fnmatch.fnmatch(e['filename'], wcard), entries ))
-        files = filter( lambda e: e['mode'][0] in '-m', entries )
-        subds = filter( lambda e: e['mode'][0] == '', entries )
+        files = sorted( e['filename'] for e in entries if e['mode'][0] in '-m' )
+        subds = sorted( e['filename'] for e in entries if e['mode'][0] == 'd' )
+        if matcher:
+            files, subds = matcher.select( uri, files, subds )
         ret = {
             'folder' : uri,
-            'files' : map( lambda e: e['filename'], files ),
+            'files' : files,
             'subFolders' : []
         }
-        for subd in subds:
-            subd = subd['filename']
-            ret['subFolders'].append(
-                            self.get_dir_content( self.uri_from_path( os.path.join(dirPath, subd)),
-                                        onlyPats=onlyPats, ignorePats=ignorePats) )
-        ret.update(extra)
-        return ret
+        if withStats:
+            byName = dict( (e['filename'], e) for e in entries )
+            ret['fileStats'] = dict( (f, self.stat_payload(byName[f])) for f in files )
+        return ret, subds
+
+    def get_folder_content(self, uri, matcher=None, withStats=False ):
+        ppl = urlparse(uri)
+        entries = self._listing( ppl.path.rstrip('/') or '/' ).values()
+        gLogger.debug('Acquired contents list of "%s".'%ppl.path)
+        ret, subds = self._folder_record( uri, entries, matcher, withStats )
+        return ret, [ self.uri_from_path(os.path.join(ppl.path, d)) for d in subds ]
+
+    def iter_recursive_content(self, uri, matcher=None, withStats=False):
+        """
+        Generator of flat folder records (see iter_dir_content()) obtained
+        with single recursive listing of the `uri'. Folders rejected by
+        `matcher' are skipped with all their content.
+        """
+        rootPath = urlparse(uri).path.rstrip('/') or '/'
+        lines = iter_util_lines( 'nsls-recursive', timeout='long'
+                               , applyRegexOn=None
+                               , remotePath=rootPath )
+        # Folders expected to be listed: path -> (folder URI, parent URI)
+        pending = { rootPath : (uri, None) }
+        generation = self.listingCache.generation()
+        # Output is parsed as it arrives, so only the listing of single
+        # folder is kept in memory
+        for dirPath, entries in iter_nsls_recursive( lines, rootPath ):
+            if dirPath not in pending:
+                continue
+            folderURI, parentURI = pending.pop(dirPath)
+            self.listingCache.put( dirPath, index_entries(entries), generation )
+            record, subds = self._folder_record( folderURI, entries
+                                               , matcher, withStats )
+            for d in subds:
+                path = os.path.join(dirPath, d)
+                pending[path] = (self.uri_from_path(path), folderURI)
+            record['parent'] = parentURI
+            yield record
+        gLogger.debug('Acquired recursive contents list of "%s".'%rootPath)
+        if pending:
+            gLogger.warning( 'Recursive listing of "%s" lacks %d folder(s).'%(
+                        rootPath, len(pending)) )
+
+    def iter_dir_content( self, dirPath, onlyPats=None, ignorePats=None, extra={},
+                          withStats=False, nThreads=0, order='dfs', maxQueue=0,
+                          matcher=None, unchanged=None ):
+        """
+        Uses single recursive listing if `recursiveListing' is set (and
+        incremental listing is not requested). The traversal options are
+        ignored then.
+        """
+        if not self.recursiveListing or unchanged is not None:
+            for entry in super(CASTORBackend, self).iter_dir_content( dirPath
+                        , onlyPats=onlyPats, ignorePats=ignorePats, extra=extra
+                        , withStats=withStats, nThreads=nThreads, order=order
+                        , maxQueue=maxQueue, matcher=matcher, unchanged=unchanged ):
+                yield entry
+            return
+        if matcher is None:
+            matcher = PathMatcher( dirPath, only=onlyPats, ignore=ignorePats )
+        for entry in self.iter_recursive_content( dirPath, matcher=matcher
+                                                , withStats=withStats ):
+            if entry['parent'] is None:
+                entry.update(extra)
+            yield entry
+
+    def get_dir_content( self, dirPath, onlyPats=None, ignorePats=None, extra={},
+                         withStats=False, nThreads=0, order='dfs', maxQueue=0,
+                         matcher=None, unchanged=None ):
+        """
+        Uses single recursive listing if `recursiveListing' is set (and
+        incremental listing is not requested), see iter_dir_content().
+        """
+        if not self.recursiveListing or unchanged is not None:
+            return super(CASTORBackend, self).get_dir_content( dirPath
+                        , onlyPats=onlyPats, ignorePats=ignorePats, extra=extra
+                        , withStats=withStats, nThreads=nThreads, order=order
+                        , maxQueue=maxQueue, matcher=matcher, unchanged=unchanged )
+        root, byURI = None, {}
+        for entry in self.iter_dir_content( dirPath, onlyPats=onlyPats
+                                          , ignorePats=ignorePats, extra=extra
+                                          , withStats=withStats, matcher=matcher ):
+            parentURI = entry.pop('parent')
+            byURI[entry['folder']] = entry
+            if parentURI is None:
+                root = entry
+            else:
+                byURI[parentURI]['subFolders'].append( entry )
+        for entry in byURI.itervalues():
+            entry['subFolders'].sort( key=lambda e: e['folder'] )
+        return root
 
     def uri_from_path(self, path):
         return 'castor://' + path
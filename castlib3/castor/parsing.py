@@ -49,7 +49,10 @@ rxsNSLSMode         = r'(?P<mode>[dDlmrwx\-st]+)\s+'
 rxsNSLSDirNentries  = r'(?P<dirNEntries>\w+)\s+'
 rxsNSLSOwnerNGroup  = r'(?P<ownerName>[\w-]+)\s+(?P<ownerGroupName>[\w-]+)\s+'
 rxsNSLSFileSize     = r'(?P<fileSize>\d+)\s+'
-rxsNSLSTimestamp    = r'(?P<modMonth>Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+(?P<modDate>\d{1,2})\s+((?P<modYear>\d{4})|(?P<modTime>\d{1,2}:\d{1,2}))'
+# Either the full timestamp (YYYY-MM-DD HH:MM:SS), or the `ls'-like one with
+# time (for recent entries) or year
+rxsNSLSTimestamp    = r'((?P<modFull>\d{4}-\d{2}-\d{2}\s+\d{1,2}:\d{2}:\d{2})|' \
+                      r'(?P<modMonth>Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+(?P<modDate>\d{1,2})\s+((?P<modYear>\d{4})|(?P<modTime>\d{1,2}:\d{1,2})))'
 rxsNSLSChecksum     = r'(?P<checksum>(:?\s+AD\s+(?P<adler32>[0-9a-fA-F]+)))?\s+'
 # groups: todo
 rxsNSLS = rxsNSLSFileClass      \
@@ -62,6 +65,31 @@ rxsNSLS = rxsNSLSFileClass      \
         + r'(?P<filename>.+)$'
 rxNSLS = re.compile( rxsNSLS, re.M )
 
+# Directory header line of recursive listing (nsls -lR)
+rxNSLSRecursiveHeader = re.compile( r'^(?P<dirPath>/.*):\s*$' )
+
+def iter_nsls_recursive( lines, rootPath ):
+    """
+    Generator parsing the output of recursive nsls listing line by line.
+    Yields pairs of (dirPath, entries) for each listed directory, where the
+    entries are lists of dictionaries with rxNSLS groups. The entries
+    preceding the first directory header (if any) are attributed to the
+    `rootPath'.
+    """
+    dirPath, entries = rootPath, []
+    for line in lines:
+        m = rxNSLSRecursiveHeader.match(line)
+        if m:
+            path = m.group('dirPath').rstrip('/') or '/'
+            if path != dirPath or entries:
+                yield dirPath, entries
+            dirPath, entries = path, []
+            continue
+        m = rxNSLS.match(line)
+        if m:
+            entries.append( m.groupdict() )
+    yield dirPath, entries
+
 rxsStagerQueryError = r'(?:Error\s+(?P<errorCode>\d+))\/(?P<errorMessage>.+)'
 rxStagerQueryError = re.compile( rxsStagerQueryError )
 
@@ -74,6 +102,30 @@ rxStagerSubrequesFailure = re.compile(
     '^' + rxsStagerSubrequesFailure + '|' + rxsStagerRequestID + '$',
     re.M )
 
+# Precisions of timestamps provided by nsls, in ascending order
+NSLS_TIMESTAMP_PRECISIONS = ('day', 'minute', 'second')
+
+def nsls_timestamp( entry, now=None ):
+    """
+    Returns pair of modification time (datetime object) and its precision
+    (one of NSLS_TIMESTAMP_PRECISIONS) of nsls entry (rxNSLS groups
+    dictionary). For the recent entries listed with time instead of year
+    the year is inferred the way `ls' does: the entry is assumed to be not
+    from the future.
+    """
+    if entry.get('modFull', None):
+        return datetime.datetime.strptime( ' '.join(entry['modFull'].split())
+                                         , '%Y-%m-%d %H:%M:%S' ), 'second'
+    if entry['modYear']:
+        return datetime.datetime.strptime( '%s %s %s'%(entry['modYear']
+                    , entry['modMonth'], entry['modDate']), '%Y %b %d' ), 'day'
+    now = now or datetime.datetime.now()
+    dt = datetime.datetime.strptime( '%d %s %s %s'%(now.year, entry['modMonth']
+                    , entry['modDate'], entry['modTime']), '%Y %b %d %H:%M' )
+    if dt > now + datetime.timedelta(days=1):
+        dt = dt.replace( year=now.year - 1 )
+    return dt, 'minute'
+
 rfstatTimeReXs = \
     "^Last\s(?P<type>access|modify|stat\.\smod\.)\s+\:\s*(?P<timeString>.*)\s*$"
 
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Routines for computing the file content checksums.
+"""
+
+import io, os, zlib, mmap, ctypes, ctypes.util, sqlite3, threading, time, \
+       hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+                               wait, FIRST_COMPLETED
+
+try:
+    # Optional hardware-accelerated CRC32C (https://pypi.python.org/pypi/crc32c)
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+# Modulus of adler32 sums
+ADLER32_BASE = 65521
+
+# Default size of block being read at once
+DEFAULT_BLOCKSIZE = 65536
+
+# posix_fadvise() advice constants (Linux values)
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED   = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+try:
+    # Python 2: read-only buffer referring to part of object, no copying
+    _view = buffer
+except NameError:
+    def _view( obj, offset, size ):
+        return memoryview(obj)[offset:offset + size]
+
+def _release( view ):
+    if hasattr(view, 'release'):
+        view.release()
+
+_libc = None
+
+def fadvise( fd, offset, length, advice ):
+    """
+    Announces an intention to access file data in a specific pattern (see
+    posix_fadvise(2)). Zero `length' means "till the end of file". Returns
+    False if call is not supported on current platform. The advice is a
+    hint only, so errors are silently ignored.
+    """
+    global _libc
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise( fd, offset, length, advice )
+        except OSError:
+            pass
+        return True
+    if _libc is None:
+        libName = ctypes.util.find_library('c')
+        _libc = ctypes.CDLL(libName) if libName else False
+    if not _libc or not hasattr(_libc, 'posix_fadvise'):
+        return False
+    _libc.posix_fadvise( ctypes.c_int(fd), ctypes.c_longlong(offset)
+                       , ctypes.c_longlong(length), ctypes.c_int(advice) )
+    return True
+
+def read_blocks( filename, offset=0, length=None, blocksize=DEFAULT_BLOCKSIZE,
+                 useMmap=False, dropCache=False ):
+    """
+    Generator yielding consecutive blocks of `length' bytes of file starting
+    from `offset' (till the end of file, if `length' is None). Blocks are
+    read-only views on the single preallocated buffer (or on the memory
+    mapped file, if `useMmap' is set) of `blocksize' bytes, so no data is
+    copied. Each block remains valid only until the next one is requested.
+
+    The kernel is advised for sequential read of the range. If `dropCache'
+    is set, the pages of range are dropped from the page cache afterwards,
+    so bulk reading does not evict the data being actually used by others.
+    """
+    fd = os.open( filename, os.O_RDONLY )
+    try:
+        if length is None:
+            length = max( os.fstat(fd).st_size - offset, 0 )
+        fadvise( fd, offset, length, POSIX_FADV_SEQUENTIAL )
+        if useMmap:
+            blocks = _read_mmap_blocks( fd, offset, length, blocksize )
+        else:
+            blocks = _read_buffer_blocks( fd, offset, length, blocksize )
+        for block in blocks:
+            yield block
+        if dropCache:
+            fadvise( fd, offset, length, POSIX_FADV_DONTNEED )
+    finally:
+        os.close(fd)
+
+def _read_buffer_blocks( fd, offset, length, blocksize ):
+    buf = bytearray(blocksize)
+    with io.FileIO( fd, 'r', closefd=False ) as f:
+        f.seek(offset)
+        while length > 0:
+            n = f.readinto( buf if length >= blocksize \
+                                else memoryview(buf)[:length] )
+            if not n:
+                break
+            view = _view(buf, 0, n)
+            yield view
+            _release(view)
+            length -= n
+
+def _read_mmap_blocks( fd, offset, length, blocksize ):
+    if not length:
+        return
+    # mapping offset has to be aligned to allocation granularity
+    shift = offset % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap( fd, length + shift, access=mmap.ACCESS_READ
+                  , offset=offset - shift )
+    try:
+        for blockOffset in range(shift, shift + length, blocksize):
+            view = _view( mm, blockOffset
+                        , min(blocksize, shift + length - blockOffset) )
+            yield view
+            _release(view)
+    finally:
+        mm.close()
+
+def adler32( filename, blocksize=DEFAULT_BLOCKSIZE, useMmap=False, dropCache=False ):
+    return adler32_range( filename, blocksize=blocksize
+                        , useMmap=useMmap, dropCache=dropCache )
+
+def adler32_range( filename, offset=0, length=None, blocksize=DEFAULT_BLOCKSIZE,
+                   useMmap=False, dropCache=False ):
+    """
+    Computes adler32 checksum of the `length' bytes of file starting from
+    `offset'. If `length' is None, reads till the end of file. See
+    read_blocks() for the rest of arguments.
+    """
+    checksum = zlib.adler32(b"")
+    for block in read_blocks( filename, offset, length, blocksize=blocksize
+                            , useMmap=useMmap, dropCache=dropCache ):
+        checksum = zlib.adler32(block, checksum)
+    return checksum & 0xffffffff
+
+class _ZlibChecksum(object):
+    """
+    Adapts zlib-like running checksum function to the hashlib interface.
+    """
+    def __init__(self, func):
+        self._func = func
+        self._value = func(b"")
+
+    def update(self, data):
+        self._value = self._func(data, self._value)
+
+    def hexdigest(self):
+        return '%x'%(self._value & 0xffffffff)
+
+def _new_crc32c():
+    if _crc32c is None:
+        raise RuntimeError( 'The crc32c digest requires the "crc32c" module '
+                'to be installed.' )
+    return _ZlibChecksum( lambda data, value=0: _crc32c.crc32c(data, value) )
+
+# Digests that may be computed by digests(): name -> factory of object
+# with update() and hexdigest() methods.
+gDigestAlgorithms = {
+    'adler32' : lambda: _ZlibChecksum( zlib.adler32 ),
+    'crc32'   : lambda: _ZlibChecksum( zlib.crc32 ),
+    'md5'     : hashlib.md5,
+    'crc32c'  : _new_crc32c,
+}
+
+def digests( filename, algos=('adler32',), blocksize=DEFAULT_BLOCKSIZE,
+             useMmap=False, dropCache=False ):
+    """
+    Computes several digests of file within single read. Returns dictionary
+    of hexadecimal digests indexed by algorithm names (see
+    gDigestAlgorithms). See read_blocks() for the rest of arguments.
+    """
+    hashers = [ (algo, gDigestAlgorithms[algo]()) for algo in algos ]
+    for block in read_blocks( filename, blocksize=blocksize
+                            , useMmap=useMmap, dropCache=dropCache ):
+        for _, h in hashers:
+            h.update(block)
+    return dict( (algo, h.hexdigest()) for algo, h in hashers )
+
+def adler32_combine( adler1, adler2, len2 ):
+    """
+    Returns adler32 checksum of two concatenated sequences given their
+    checksums and the length of the second one (same as zlib's
+    adler32_combine()).
+    """
+    a1, b1 = adler1 & 0xffff, (adler1 >> 16) & 0xffff
+    a2, b2 = adler2 & 0xffff, (adler2 >> 16) & 0xffff
+    a = (a1 + a2 - 1) % ADLER32_BASE
+    b = (b1 + b2 + (len2 % ADLER32_BASE)*(a1 - 1)) % ADLER32_BASE
+    return (b << 16) | a
+
+def split_ranges( size, chunkSize ):
+    """
+    Returns list of (offset, length) pairs covering `size' bytes with chunks
+    of `chunkSize' bytes.
+    """
+    return [ (offset, min(chunkSize, size - offset)) \
+             for offset in range(0, size, chunkSize) ] or [(0, 0)]
+
+def _combine_ranges( results ):
+    """
+    Combines list of (length, adler32) pairs of consecutive ranges.
+    """
+    checksum = results[0][1]
+    for length, r in results[1:]:
+        checksum = adler32_combine( checksum, r, length )
+    return checksum
+
+class ChecksumService(object):
+    """
+    Computes checksums of multiple files concurrently, using pool of
+    processes (or threads). The number of files being read simultaneously
+    is limited by `ioLimit' (equals to number of workers by default), so
+    one may use more workers than the storage is able to serve.
+
+    If `splitSize' is non-zero, the adler32 checksums of files larger than
+    it are computed by ranges of `splitSize' bytes in parallel and then
+    combined with adler32_combine(). The read ranges count against
+    `ioLimit' as well.
+
+    The `readerOptions' dictionary is forwarded to read_blocks() when
+    computing the adler32 sums (blocksize, useMmap, dropCache).
+    """
+    def __init__(self, nWorkers=4, ioLimit=0, processes=True, splitSize=0,
+                       readerOptions={}):
+        self.nWorkers = nWorkers
+        self.ioLimit = ioLimit or nWorkers
+        self.processes = processes
+        self.splitSize = splitSize
+        self.readerOptions = dict(readerOptions)
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.nWorkers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.nWorkers)
+        return self._executor
+
+    def _tasks(self, path, func):
+        """
+        Returns list of (callable, args, kwargs, length) tasks to be
+        evaluated for the path. The `length' is the length of range being read by the
+        task (None for whole file).
+        """
+        if func is not None:
+            return [ (func, (path,), {}, None) ]
+        if self.splitSize:
+            size = os.path.getsize(path)
+            if size > self.splitSize:
+                return [ (adler32_range, (path, offset, length), self.readerOptions, length) \
+                         for offset, length in split_ranges(size, self.splitSize) ]
+        return [ (adler32, (path,), self.readerOptions, None) ]
+
+    def imap_unordered(self, paths, func=None):
+        """
+        Generator yielding pairs (path, checksum) as they are computed. By
+        default the adler32 checksum is computed. Otherwise, given `func'
+        is invoked for every path (note, that it must be picklable for
+        process pool). Exception raised during computation will be
+        re-raised here.
+        """
+        paths = enumerate(paths)
+        pending = {}  # future -> (input index, task number, length)
+        results = {}  # input index -> (path, [(length, result), ...])
+        nLeft = {}    # input index -> number of tasks not finished yet
+        tasks = []    # (input index, task number, task) of path being submitted
+        try:
+            while True:
+                while len(pending) < self.ioLimit:
+                    if not tasks:
+                        nPath, path = next(paths, (None, None))
+                        if nPath is None:
+                            break
+                        tasks = [ (nPath, n, t) for n, t \
+                                        in enumerate(self._tasks(path, func)) ]
+                        results[nPath] = (path, [None]*len(tasks))
+                        nLeft[nPath] = len(tasks)
+                    nPath, n, (f, args, kwargs, length) = tasks.pop(0)
+                    pending[self.executor.submit(f, *args, **kwargs)] = (nPath, n, length)
+                if not pending:
+                    break
+                done, _ = wait( pending.keys(), return_when=FIRST_COMPLETED )
+                for future in done:
+                    nPath, n, length = pending.pop(future)
+                    results[nPath][1][n] = (length, future.result())
+                    nLeft[nPath] -= 1
+                    if nLeft[nPath]:
+                        continue
+                    del nLeft[nPath]
+                    path, parts = results.pop(nPath)
+                    yield path, _combine_ranges( parts )
+        finally:
+            for future in pending.keys():
+                future.cancel()
+
+    def adler32(self, path):
+        """
+        Returns adler32 checksum of single file (computed by ranges in
+        parallel, if file is larger than `splitSize').
+        """
+        for p, checksum in self.imap_unordered([path]):
+            return checksum
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+def stat_key( st ):
+    """
+    Returns tuple (device, inode, size, mtime_ns) identifying the file
+    content state by its os.stat() result. The nanosecond resolution of
+    modification time is lost on Python 2, where it is derived from float
+    value.
+    """
+    mtimeNs = getattr(st, 'st_mtime_ns', None)
+    if mtimeNs is None:
+        mtimeNs = int(round(st.st_mtime*1e9))
+    return (st.st_dev, st.st_ino, st.st_size, mtimeNs)
+
+class ChecksumCache(object):
+    """
+    Persistent cache of file digests, kept in sidecar SQLite database. The
+    entries are keyed on (device, inode, algorithm) and are valid as long as
+    the file size and modification time remain the same, so unchanged files
+    don't have to be read again on subsequent runs.
+
+    The entries of files that were deleted or changed (as well as ones not
+    checked for more than `maxAge' seconds, if it is non-zero) are evicted
+    by evict(). It is invoked automatically on opening the cache, if the
+    previous eviction was performed more than `evictPeriod' seconds ago.
+
+    The instance may be shared among threads.
+    """
+    def __init__(self, filename, maxAge=0, evictPeriod=24*3600):
+        self.filename = filename
+        self.maxAge = maxAge
+        self.hits = self.misses = self.evicted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect( filename, check_same_thread=False )
+        with self._conn:
+            self._conn.execute( 'CREATE TABLE IF NOT EXISTS digests ('
+                    'device INTEGER, inode INTEGER, algo TEXT, '
+                    'size INTEGER, mtime_ns INTEGER, path TEXT, '
+                    'digest TEXT, checked REAL, '
+                    'PRIMARY KEY (device, inode, algo))' )
+            self._conn.execute( 'CREATE TABLE IF NOT EXISTS meta ('
+                    'key TEXT PRIMARY KEY, value REAL)' )
+        row = self._conn.execute( 'SELECT value FROM meta WHERE key=?'
+                                , ('evicted',) ).fetchone()
+        if evictPeriod and (row is None or time.time() - row[0] > evictPeriod):
+            self.evict()
+
+    def get(self, path, algo='adler32', st=None):
+        """
+        Returns cached digest of file, or None if there is no valid entry.
+        The `st' is the os.stat() result of file, if already known.
+        """
+        dev, ino, size, mtimeNs = stat_key( st or os.stat(path) )
+        with self._lock:
+            row = self._conn.execute( 'SELECT digest FROM digests WHERE '
+                    'device=? AND inode=? AND algo=? AND size=? AND mtime_ns=?'
+                    , (dev, ino, algo, size, mtimeNs) ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._conn:
+                self._conn.execute( 'UPDATE digests SET checked=?, path=? WHERE '
+                        'device=? AND inode=? AND algo=?'
+                        , (time.time(), path, dev, ino, algo) )
+            return row[0]
+
+    def put(self, path, digest, algo='adler32', st=None):
+        """
+        Stores the digest of file with stat `st' (taken before the digest
+        computation). If the file was modified meanwhile, the digest is not
+        stored.
+        """
+        key = stat_key( st or os.stat(path) )
+        try:
+            if st is not None and stat_key( os.stat(path) ) != key:
+                return False
+        except OSError:
+            return False
+        dev, ino, size, mtimeNs = key
+        with self._lock:
+            with self._conn:
+                self._conn.execute( 'INSERT OR REPLACE INTO digests VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?)'
+                        , (dev, ino, algo, size, mtimeNs, path, digest, time.time()) )
+        return True
+
+    def evict(self):
+        """
+        Removes entries of files that do not exist anymore, were modified or
+        weren't checked for `maxAge' seconds. Returns number of removed
+        entries.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute( 'SELECT device, inode, algo, size, '
+                    'mtime_ns, path, checked FROM digests' ).fetchall()
+            stale = []
+            for dev, ino, algo, size, mtimeNs, path, checked in rows:
+                if self.maxAge and now - checked > self.maxAge:
+                    stale.append( (dev, ino, algo) )
+                    continue
+                try:
+                    valid = stat_key( os.stat(path) ) == (dev, ino, size, mtimeNs)
+                except OSError:
+                    valid = False
+                if not valid:
+                    stale.append( (dev, ino, algo) )
+            with self._conn:
+                self._conn.executemany( 'DELETE FROM digests WHERE '
+                        'device=? AND inode=? AND algo=?', stale )
+                self._conn.execute( 'INSERT OR REPLACE INTO meta VALUES (?, ?)'
+                                  , ('evicted', now) )
+            self.evicted += len(stale)
+        return len(stale)
+
+    def close(self):
+        self._conn.close()
+
+    def __str__(self):
+        return '%d hits, %d misses, %d evicted'%( self.hits, self.misses
+                                                 , self.evicted )
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Pool of long-lived shell processes executing the commands sent over their
+stdin. Output of each command is delimited with the marker line followed
+by return code, so the command does not require the fork of Python
+interpreter, session set-up and timer thread as TimeoutPopen does.
+"""
+
+import os, re, errno, select, signal, subprocess, threading, time, uuid, pipes
+
+class CoprocessTimeout( RuntimeError ):
+    pass
+
+class Coprocess(object):
+    """
+    Single shell process executing commands one by one.
+    """
+    def __init__(self, shell='/bin/sh'):
+        self.marker = '__castlib3_%s__'%uuid.uuid4().hex
+        self._rxStdoutEnd = re.compile( r'\n%s (\d+)\n$'%self.marker )
+        self.p = subprocess.Popen( [shell], stdin=subprocess.PIPE
+                                 , stdout=subprocess.PIPE
+                                 , stderr=subprocess.PIPE
+                                 , preexec_fn=os.setsid
+                                 , close_fds=True, bufsize=0 )
+        self.nCommands = 0
+
+    @property
+    def alive(self):
+        return self.p.poll() is None
+
+    def run(self, args, timeout):
+        """
+        Executes command given by the list of arguments. Returns triplet
+        (returnCode, stdout, stderr). If command does not finish within the
+        `timeout' seconds, the shell is killed and CoprocessTimeout raised.
+        """
+        cmd = ' '.join( pipes.quote(a) for a in args )
+        # The leading newline of markers guarantees that they start on the
+        # new line; it is stripped from the output afterwards.
+        self.p.stdin.write( "%s </dev/null\nprintf '\\n%s %%d\\n' $?\n"
+                            "printf '\\n%s\\n' >&2\n"%(cmd, self.marker, self.marker) )
+        self.p.stdin.flush()
+        self.nCommands += 1
+        deadline = time.time() + timeout
+        chunks = { self.p.stdout.fileno() : [], self.p.stderr.fileno() : [] }
+        tails = dict( (fd, '') for fd in chunks.keys() )
+        stdoutFd = self.p.stdout.fileno()
+        stderrEnd = '\n%s\n'%self.marker
+        pending = set(chunks.keys())
+        while pending:
+            left = deadline - time.time()
+            if left <= 0:
+                self.kill()
+                raise CoprocessTimeout( 'Command "%s" timeout expired (%d sec).'%(
+                            cmd, timeout) )
+            try:
+                ready = select.select( list(pending), [], [], left )[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                chunk = os.read( fd, 65536 )
+                if not chunk:
+                    self.kill()
+                    raise RuntimeError( 'Coprocess shell exited while running '
+                            '"%s".'%cmd )
+                chunks[fd].append( chunk )
+                # Marker may be split between the chunks, so check the tail:
+                tails[fd] = (tails[fd] + chunk)[-len(stderrEnd) - 16:]
+                if fd == stdoutFd:
+                    m = self._rxStdoutEnd.search( tails[fd] )
+                    if m:
+                        pending.discard( fd )
+                        rc, markerLen = int(m.group(1)), len(m.group(0))
+                elif tails[fd].endswith( stderrEnd ):
+                    pending.discard( fd )
+        out = ''.join(chunks[stdoutFd])[:-markerLen]
+        err = ''.join(chunks[self.p.stderr.fileno()])[:-len(stderrEnd)]
+        return rc, out, err
+
+    def kill(self):
+        try:
+            os.killpg( self.p.pid, signal.SIGKILL )
+        except OSError:
+            pass
+        self.p.wait()
+
+    def close(self):
+        if self.alive:
+            self.p.stdin.close()
+            self.p.wait()
+
+class CoprocessPool(object):
+    """
+    Thread-safe pool of at most `nProcesses' coprocesses, spawned on demand.
+    Killed (timed out) coprocesses are replaced with the new ones.
+    """
+    def __init__(self, nProcesses=2, shell='/bin/sh'):
+        self.nProcesses = nProcesses
+        self.shell = shell
+        self._cond = threading.Condition()
+        self._idle = []
+        self._nSpawned = 0
+        self.nCommands = self.nTimeouts = 0
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    cp = self._idle.pop()
+                    if cp.alive:
+                        return cp
+                    self._nSpawned -= 1
+                if self._nSpawned < self.nProcesses:
+                    self._nSpawned += 1
+                    break
+                self._cond.wait()
+        try:
+            return Coprocess( self.shell )
+        except:
+            with self._cond:
+                self._nSpawned -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, cp):
+        with self._cond:
+            if cp.alive:
+                self._idle.append( cp )
+            else:
+                self._nSpawned -= 1
+            self._cond.notify()
+
+    def run(self, args, timeout):
+        """
+        Runs the command on one of the coprocesses, see Coprocess.run().
+        """
+        cp = self._acquire()
+        try:
+            with self._cond:
+                self.nCommands += 1
+            return cp.run( args, timeout )
+        except CoprocessTimeout:
+            with self._cond:
+                self.nTimeouts += 1
+            raise
+        finally:
+            self._release( cp )
+
+    def close(self):
+        with self._cond:
+            for cp in self._idle:
+                cp.close()
+            self._nSpawned -= len(self._idle)
+            self._idle = []
+
+    def __str__(self):
+        return '%d commands, %d timeouts'%( self.nCommands, self.nTimeouts )
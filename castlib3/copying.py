@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Local files copying routines delegating the data transfer to the kernel:
+reflink (FICLONE ioctl) on filesystems supporting copy-on-write, then
+copy_file_range(2) and sendfile(2). The read/write loop with reusable
+buffer is used as a last resort. Syscalls missing in Python 2 `os' module
+are invoked via ctypes (releasing the GIL), so concurrent copies are
+performed in parallel.
+"""
+
+import os, errno, fcntl, threading, zlib, hashlib, ctypes, ctypes.util
+
+# Preference order of copying methods
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'readwrite')
+
+# ioctl(dstFd, FICLONE, srcFd), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Maximum number of bytes transferred by single syscall
+CHUNK_SIZE = 1 << 30
+
+# Errors meaning that the method is not applicable to the particular pair
+# of files (e.g. they reside on different filesystems) or not supported at
+# all, so the next method has to be tried
+_FALLBACK_ERRNOS = set([ errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY
+                       , errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY
+                       , errno.EPERM ])
+
+_libc = ctypes.CDLL( ctypes.util.find_library('c') or None, use_errno=True )
+
+def _libc_func( name, restype, argtypes ):
+    f = getattr(_libc, name, None)
+    if f is not None:
+        f.restype = restype
+        f.argtypes = argtypes
+    return f
+
+_libc_copy_file_range = _libc_func( 'copy_file_range', ctypes.c_ssize_t
+                                  , [ ctypes.c_int, ctypes.c_void_p, ctypes.c_int
+                                    , ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint ] )
+_libc_sendfile = _libc_func( 'sendfile', ctypes.c_ssize_t
+                           , [ ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t ] )
+
+# Methods found to be not supported by kernel (ENOSYS)
+_unsupported = set()
+
+def _check( n ):
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError( err, os.strerror(err) )
+    return n
+
+def _check_progress( n, size, what ):
+    """
+    Some filesystems (procfs, some FUSE/network ones) make the syscalls
+    return zero before the whole file is transferred. Such a method is not
+    applicable then, so the next one has to be tried.
+    """
+    if not n and size > 0:
+        raise OSError( errno.EINVAL, '%s() returned 0 with %d bytes left.'%(what, size) )
+
+def _copy_reflink( srcFd, dstFd, size ):
+    fcntl.ioctl( dstFd, FICLONE, srcFd )
+
+def _copy_range( srcFd, dstFd, size ):
+    if _libc_copy_file_range is None:
+        raise OSError( errno.ENOSYS, 'copy_file_range() is not available.' )
+    while size > 0:
+        n = _check( _libc_copy_file_range( srcFd, None, dstFd, None
+                                         , min(size, CHUNK_SIZE), 0 ) )
+        _check_progress( n, size, 'copy_file_range' )
+        size -= n
+
+def _copy_sendfile( srcFd, dstFd, size ):
+    if _libc_sendfile is None:
+        raise OSError( errno.ENOSYS, 'sendfile() is not available.' )
+    while size > 0:
+        n = _check( _libc_sendfile( dstFd, srcFd, None, min(size, CHUNK_SIZE) ) )
+        _check_progress( n, size, 'sendfile' )
+        size -= n
+
+def _copy_readwrite( srcFd, dstFd, size, blocksize=1 << 20 ):
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with os.fdopen( os.dup(srcFd), 'rb', 0 ) as src:
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write( dstFd, view[written:n] )
+
+_methods = {
+    'reflink' : _copy_reflink,
+    'copy_file_range' : _copy_range,
+    'sendfile' : _copy_sendfile,
+    'readwrite' : _copy_readwrite,
+}
+
+def _transfer( srcFd, dstFd, offset, size, methods ):
+    """
+    Transfers `size' bytes of source starting from `offset' to the same
+    offset of destination with first of `methods' succeeded. Returns the
+    name of method used.
+    """
+    for method in methods:
+        if method in _unsupported or (offset and 'reflink' == method):
+            continue
+        os.lseek( srcFd, offset, os.SEEK_SET )
+        os.lseek( dstFd, offset, os.SEEK_SET )
+        try:
+            _methods[method]( srcFd, dstFd, size )
+        except (OSError, IOError) as e:
+            if e.errno not in _FALLBACK_ERRNOS or 'readwrite' == method:
+                raise
+            if errno.ENOSYS == e.errno:
+                _unsupported.add( method )
+            # Method may have been failed in the middle of transfer:
+            os.ftruncate( dstFd, offset )
+            continue
+        return method
+    raise RuntimeError( 'None of the copying methods (%s) succeeded.'%(
+                ', '.join(methods)) )
+
+def copy_file( src, dst, methods=COPY_METHODS ):
+    """
+    Copies the content and permission bits of the regular file `src' to
+    `dst' with first of given `methods' succeeded (see COPY_METHODS).
+    Returns the name of the method used.
+
+    The data is written to temporary file near the `dst' which is then
+    renamed to `dst', so the destination never contains partially copied
+    file and concurrent copies to the same destination do not interfere.
+    """
+    dstDir, dstName = os.path.split( os.path.abspath(dst) )
+    tmpPath = os.path.join( dstDir, '.%s.part-%d-%d'%( dstName, os.getpid()
+                                                     , threading.current_thread().ident ) )
+    srcFd = os.open( src, os.O_RDONLY )
+    try:
+        st = os.fstat(srcFd)
+        dstFd = os.open( tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                       , st.st_mode & 0o777 )
+        try:
+            used = _transfer( srcFd, dstFd, 0, st.st_size, methods )
+            os.fchmod( dstFd, st.st_mode & 0o777 )
+        finally:
+            os.close(dstFd)
+        os.rename( tmpPath, dst )
+    except:
+        if os.path.exists(tmpPath):
+            os.unlink(tmpPath)
+        raise
+    finally:
+        os.close(srcFd)
+    return used
+
+def append_tail( src, dst, offset, methods=COPY_METHODS ):
+    """
+    Appends the content of `src' following its first `offset' bytes to the
+    `dst' (truncated to `offset' bytes, if it is longer). Used to bring the
+    copy of growing file up to date, once the `dst' content is known to be
+    the prefix of `src'. Returns the name of the method used.
+    """
+    srcFd = os.open( src, os.O_RDONLY )
+    try:
+        dstFd = os.open( dst, os.O_WRONLY )
+        try:
+            os.ftruncate( dstFd, offset )
+            return _transfer( srcFd, dstFd, offset
+                            , os.fstat(srcFd).st_size - offset, methods )
+        finally:
+            os.close(dstFd)
+    finally:
+        os.close(srcFd)
+
+def _pread( fd, size, offset ):
+    os.lseek( fd, offset, os.SEEK_SET )
+    chunks = []
+    while size > 0:
+        chunk = os.read( fd, size )
+        if not chunk:
+            break
+        chunks.append( chunk )
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _pwrite( fd, data, offset ):
+    os.lseek( fd, offset, os.SEEK_SET )
+    view = memoryview(data)
+    while view:
+        view = view[os.write( fd, view ):]
+
+def block_signatures( fd, size, blockSize ):
+    """
+    Returns list of (weak, strong) checksums of consecutive blocks of
+    `blockSize' bytes of first `size' bytes of file (adler32 and md5 digest
+    correspondingly).
+    """
+    ret = []
+    for offset in range(0, size, blockSize):
+        block = _pread( fd, min(blockSize, size - offset), offset )
+        ret.append( (zlib.adler32(block) & 0xffffffff, hashlib.md5(block).digest()) )
+    return ret
+
+def delta_rewrite( src, dst, blockSize=1 << 20 ):
+    """
+    Updates the `dst' file in place to match the `src', writing only the
+    blocks of `blockSize' bytes that differ. Blocks are compared by weak
+    (adler32) checksum, confirmed by the strong one (md5).
+
+    Unlike rsync, this is NOT a rolling-checksum delta transfer: blocks are
+    matched at the same offsets only. The destination is patched in place,
+    so the data shifted by insertion or removal in the middle of file could
+    not be reused without temporary copy anyway; everything following such
+    a change is rewritten. That suits files modified in place or appended,
+    which is the case for the updated data files this is meant for.
+    Returns pair of numbers of bytes written and bytes saved (not
+    written).
+    """
+    srcFd = os.open( src, os.O_RDONLY )
+    try:
+        dstFd = os.open( dst, os.O_RDWR )
+        try:
+            srcSize = os.fstat(srcFd).st_size
+            dstSize = os.fstat(dstFd).st_size
+            signatures = block_signatures( dstFd, min(srcSize, dstSize), blockSize )
+            written = 0
+            for nBlock, offset in enumerate(range(0, srcSize, blockSize)):
+                block = _pread( srcFd, blockSize, offset )
+                if nBlock < len(signatures):
+                    weak, strong = signatures[nBlock]
+                    if weak == zlib.adler32(block) & 0xffffffff \
+                        and strong == hashlib.md5(block).digest():
+                        continue
+                _pwrite( dstFd, block, offset )
+                written += len(block)
+            os.ftruncate( dstFd, srcSize )
+        finally:
+            os.close(dstFd)
+    finally:
+        os.close(srcFd)
+    return written, srcSize - written
@@ -33,8 +33,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from castlib3 import dbShim as DB
-from castlib3.models import DeclBase
+from castlib3.models import DeclBase, upgrade_schema
 from castlib3.backend import gCastlibBackends
+from castlib3.logs import gLogger
 
 from collections import OrderedDict
 
@@ -69,6 +70,8 @@ def initialize_database( engineCreateArgs,
     DB.set_engine(engine)
     DB.set_session(dbS)
     DeclBase.metadata.create_all(engine)
+    for column in upgrade_schema(engine):
+        gLogger.info( 'Column %s added to the database schema.'%column )
 
 def initialize_backends( schemes, cfg ):
     backends = {}
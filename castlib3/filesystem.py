@@ -19,7 +19,9 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import os, fnmatch
+import os, re, itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urlparse import urlparse, urlunsplit
 from castlib3.logs import gLogger
 
@@ -40,7 +42,251 @@ def split_path( path ):
     pToks.reverse()
     return pToks
 
-def discover_entries( entriesDict, backends={} ):
+def wildcard_to_regex( pattern ):
+    """
+    Translates shell wildcard into regular expression string (not anchored).
+    Differs from fnmatch.translate() in that `*' and `?' never match the
+    path separator, so the wildcards may be joined into path patterns.
+    """
+    i, n = 0, len(pattern)
+    res = ''
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if '*' == c:
+            res += '[^/]*'
+        elif '?' == c:
+            res += '[^/]'
+        elif '[' == c:
+            j = i
+            if j < n and '!' == pattern[j]:
+                j += 1
+            if j < n and ']' == pattern[j]:
+                j += 1
+            while j < n and ']' != pattern[j]:
+                j += 1
+            if j >= n:
+                res += '\\['
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if '!' == stuff[0]:
+                    stuff = '^' + stuff[1:]
+                elif '^' == stuff[0]:
+                    stuff = '\\' + stuff
+                res += '[%s]'%stuff
+        else:
+            res += re.escape(c)
+    return res
+
+class _WildcardRules(object):
+    """
+    Single set of wildcards compiled into regular expressions. Wildcards
+    without `/' are matched against entry name. Wildcards containing `/' are
+    path-anchored: matched against the path relative to the listing root.
+    """
+    def __init__(self, patterns, prefixes=False):
+        if type(patterns) is str:
+            patterns = [patterns,]
+        patterns = patterns or []
+        names = [ wildcard_to_regex(p) for p in patterns if '/' not in p ]
+        paths = [ p.strip('/') for p in patterns if '/' in p ]
+        self.nameRx = re.compile( '(?:%s)\\Z'%'|'.join(names), re.S ) \
+                      if names else None
+        self.pathRx = re.compile( '(?:%s)\\Z'%'|'.join(
+                            wildcard_to_regex(p) for p in paths ), re.S ) \
+                      if paths else None
+        # For directories matched against path-anchored "only" rules, the
+        # leading path tokens have to be matched to descend into parents
+        # of the selected directories and into their sub-directories:
+        self.tokensRxs = [ [ re.compile(wildcard_to_regex(t) + '\\Z', re.S) \
+                                for t in p.split('/') ] for p in paths ] \
+                         if prefixes else None
+        self.empty = not patterns
+
+    def match(self, relDir, name):
+        if self.nameRx and self.nameRx.match(name):
+            return True
+        if self.pathRx is None:
+            return False
+        relPath = relDir + '/' + name if relDir else name
+        if self.tokensRxs is None:
+            return bool(self.pathRx.match(relPath))
+        pToks = relPath.split('/')
+        for rxs in self.tokensRxs:
+            if all( rx.match(t) for rx, t in zip(rxs, pToks) ):
+                return True
+        return False
+
+class PathMatcher(object):
+    """
+    Include/exclude rules for directory listing, compiled once per location.
+    The `only' and `ignore' wildcards lists apply to both, files and
+    directories (as `only' and `ignore' options of discover_entries() always
+    did). The `onlyFiles', `ignoreFiles', `onlyDirs' and `ignoreDirs' lists
+    apply to files or directories only. Entry is selected if it matches any
+    of the `only' rules (if there are any) and none of `ignore' rules.
+
+    Wildcards containing `/' are matched against the path relative to the
+    `root' (e.g. `run-*/raw/*.dat'); for directories matched by
+    path-anchored `only' rules the leading path tokens are considered, so
+    parents of selected directories are listed as well as their content.
+
+    Directories rejected by the matcher are never listed.
+    """
+    def __init__( self, root='', only=None, ignore=None
+                , onlyFiles=None, ignoreFiles=None
+                , onlyDirs=None, ignoreDirs=None ):
+        self.root = urlparse(root).path.rstrip('/')
+        def _merge(*lists):
+            ret = []
+            for l in lists:
+                ret.extend( [l,] if type(l) is str else l or [] )
+            return ret
+        self.onlyFiles   = _WildcardRules( _merge(only, onlyFiles) )
+        self.ignoreFiles = _WildcardRules( _merge(ignore, ignoreFiles) )
+        self.onlyDirs    = _WildcardRules( _merge(only, onlyDirs), prefixes=True )
+        self.ignoreDirs  = _WildcardRules( _merge(ignore, ignoreDirs) )
+
+    def relative_dir(self, dirPath):
+        """
+        Returns folder path relative to the root.
+        """
+        path = urlparse(dirPath).path.rstrip('/')
+        if path == self.root:
+            return ''
+        if not path.startswith(self.root + '/'):
+            raise ValueError( 'Path "%s" is not within the "%s".'%(path, self.root) )
+        return path[len(self.root) + 1:]
+
+    def _select(self, relDir, names, only, ignore):
+        if not only.empty:
+            names = [ nm for nm in names if only.match(relDir, nm) ]
+        if not ignore.empty:
+            names = [ nm for nm in names if not ignore.match(relDir, nm) ]
+        return names
+
+    def select(self, dirPath, files, subFolders):
+        """
+        Returns the (files, subFolders) lists of names filtered according
+        to rules. Order is preserved.
+        """
+        relDir = self.relative_dir(dirPath)
+        return self._select( relDir, files, self.onlyFiles, self.ignoreFiles ), \
+               self._select( relDir, subFolders, self.onlyDirs, self.ignoreDirs )
+
+def walk( roots, expand, order='dfs', maxQueue=0, nThreads=0 ):
+    """
+    Recursion-free tree traversal engine. Generator yielding pairs of
+    (node, result) where result is obtained with `expand' callable:
+        expand(node) -> (result, [child1, child2, ...])
+    Children are put in queue of pending nodes to be expanded further.
+
+    :param order:
+        either 'dfs' (depth-first, pre-order) or 'bfs' (breadth-first).
+        Siblings are always yielded in the order returned by `expand'.
+    :param maxQueue:
+        if non-zero, when the number of pending nodes reaches this value,
+        the children of expanded node are put ahead of the queue (i.e. the
+        nodes will be taken in depth-first order until queue size
+        decreases). This keeps the breadth-first frontier bounded on wide
+        trees.
+    :param nThreads:
+        if greater than one, the pending nodes will be expanded ahead by the
+        pool of threads. Only the next `nThreads' nodes to be yielded
+        (besides the current one) are being expanded ahead, so the number of kept results is
+        bounded. The yield order does not depend on threads timing.
+        The `expand' callable must be thread-safe then.
+    """
+    if order not in ('dfs', 'bfs'):
+        raise ValueError( 'Unknown traversal order: "%s".'%order )
+    pool = ThreadPoolExecutor(max_workers=nThreads) if nThreads > 1 else None
+    # Entries are [node, future] lists; nodes are taken from the right end
+    # in depth-first order and from the left one in breadth-first order
+    queue = deque()
+    def _enqueue(nodes):
+        pending = [ [node, None] for node in nodes ]
+        if 'dfs' == order:
+            queue.extend(reversed(pending))
+        elif maxQueue and len(queue) >= maxQueue:
+            queue.extendleft(reversed(pending))
+        else:
+            queue.extend(pending)
+    def _take():
+        if pool:
+            # Submit the node being taken and the ones to be taken next
+            ahead = reversed(queue) if 'dfs' == order else iter(queue)
+            for entry in itertools.islice( ahead, nThreads + 1 ):
+                if entry[1] is None:
+                    entry[1] = pool.submit(expand, entry[0])
+        return queue.pop() if 'dfs' == order else queue.popleft()
+    try:
+        _enqueue(roots)
+        while queue:
+            node, future = _take()
+            result, children = future.result() if future else expand(node)
+            yield node, result
+            _enqueue(children)
+    finally:
+        if pool:
+            for node, future in queue:
+                if future is not None:
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+def _iter_location_records( prefixURIs, netloc, records ):
+    """
+    Prepends the folder records of enclosing folders (given by URIs,
+    top-most first) to the flat records stream produced by backend's
+    iter_dir_content() method.
+    """
+    parent = None
+    for uri in prefixURIs:
+        record = {
+                'folder' : uri,
+                'parent' : parent,
+                'files' : [],
+                'subFolders' : []
+            }
+        if netloc:
+            record['node'] = netloc
+        yield record
+        parent = uri
+    for record in records:
+        if record['parent'] is None:
+            record['parent'] = parent
+            if netloc:
+                record['node'] = netloc
+        yield record
+
+def location_matcher( uri, prescript ):
+    """
+    Builds PathMatcher instance for location, popping the wildcards lists
+    from location's prescript dictionary (see discover_entries()).
+    """
+    return PathMatcher( uri
+                      , only=prescript.pop('only', None)
+                      , ignore=prescript.pop('ignore', None)
+                      , onlyFiles=prescript.pop('onlyFiles', None)
+                      , ignoreFiles=prescript.pop('ignoreFiles', None)
+                      , onlyDirs=prescript.pop('onlyDirs', None)
+                      , ignoreDirs=prescript.pop('ignoreDirs', None) )
+
+def enclosing_uris( uri ):
+    """
+    Returns the list of URIs of folders enclosing the given one, top-most
+    first.
+    """
+    lpp = urlparse(uri)
+    prefixURIs = []
+    pToks = split_path( os.path.split(lpp.path)[0] )
+    while pToks:
+        prefixURIs.insert(0, urlunsplit((lpp.scheme or '', lpp.netloc or '',
+                                         os.path.join(*pToks), '', '')))
+        pToks.pop()
+    return prefixURIs
+
+def discover_entries( entriesDict, backends={}, stream=False, unchanged=None ):
     """
     This function builds a filesystem entries dictionary for stages. It expects
     a dictionary in form:
@@ -50,14 +296,35 @@ def discover_entries( entriesDict, backends={} ):
             'localPath' : <local-path>,
             'ignore' : [ <wildcard1>, <wildcard2>, ... ],
             'only' : [ <wildcard1>, <wildcard2>, ... ],
+            'ignoreFiles' : [ <wildcard1>, <wildcard2>, ... ],  # optional
+            'onlyFiles' : [ <wildcard1>, <wildcard2>, ... ],  # optional
+            'ignoreDirs' : [ <wildcard1>, <wildcard2>, ... ],  # optional
+            'onlyDirs' : [ <wildcard1>, <wildcard2>, ... ],  # optional
+            'stats' : <bool>,  # optional
+            'threads' : <int>,  # optional
+            'traversal' : <dfs|bfs>,  # optional
+            'maxQueue' : <int>,  # optional
+            'incremental' : <bool>,  # optional
             ... # stage-specific arguments (e.g. castorSync: <flag>)
         }
         ...
     }
     Where `ignore' and `only' wildcards lists are not mutually exclusive. When
     both given the `ignore' will be applied after `only' selector. The
+    `*Files' and `*Dirs' wildcards are applied to files or directories
+    only; wildcards containing `/' are matched against the path relative to
+    the `localPath' (see PathMatcher for details). The
     `inner-entry-id' is used for runtime operations and won't affect any
-    persistent data.
+    persistent data. When `stats' is set, the file attributes obtained by
+    backend during listing will be kept in `fileStats' dictionaries, so
+    no additional per-file requests are needed during indexing. The
+    `threads' value sets the number of concurrent listing threads for
+    backends supporting it (directory-wise listing of network-mounted
+    filesystems benefits from it). The `traversal' and `maxQueue' are
+    forwarded to walk() and control the order and the queue size limit of
+    directories listing. If `incremental' is set and `unchanged' callable
+    is given, the folders which weren't modified since they were indexed
+    will not be listed (see AbstractBackend.list_folder()).
     
     The folder value is a tuple of (realPath, virtualFolderName).
     The `files' entries are merely string filenames of files to be indexed.
@@ -71,6 +338,16 @@ def discover_entries( entriesDict, backends={} ):
 
     localPaths are always a full paths while `files' are just
     filenames.
+
+    If `stream' is set, the directories will not be listed here. Instead,
+    for each location a dictionary of form
+        {'folder' : <top-most-folder>, 'records' : <generator>}
+    will be returned where generator lazily yields flat folder records (see
+    AbstractBackend.iter_dir_content()) in depth-first pre-order (whatever
+    the `traversal' is). This
+    way the listing is performed while the records are being consumed
+    (e.g. by index-dir stage), and the memory footprint is bounded by the
+    directories width rather than the whole tree size.
     """
     # Traverse directories content, forming the list without directories
     # resolution:
@@ -81,21 +358,43 @@ def discover_entries( entriesDict, backends={} ):
         uri = dirListPrescript.pop('localPath')
         lpp = urlparse(uri)
         backend = backends[lpp.scheme or 'file']
+        matcher = location_matcher( uri, dirListPrescript )
+        listingKWargs = {
+                'matcher' : matcher,
+                'withStats' : dirListPrescript.pop('stats', False),
+                'nThreads' : dirListPrescript.pop('threads', 0),
+                'order' : dirListPrescript.pop('traversal', 'dfs'),
+                'maxQueue' : dirListPrescript.pop('maxQueue', 0),
+                'extra' : dirListPrescript
+            }
+        if dirListPrescript.pop('incremental', False) and unchanged:
+            listingKWargs['unchanged'] = unchanged
+            if listingKWargs['nThreads']:
+                gLogger.warning( 'Incremental listing of "%s" will be performed '
+                        'in single thread.'%innerFolderID )
+                listingKWargs['nThreads'] = 0
+        prefixURIs = enclosing_uris( uri )
+        if stream:
+            if 'dfs' != listingKWargs['order']:
+                # Streamed records have to follow their parents
+                gLogger.warning( 'Location "%s" will be listed in depth-first '
+                        'order (`traversal\' is ignored in stream mode).'%innerFolderID )
+                listingKWargs['order'] = 'dfs'
+            gLogger.info( 'Contents of directory "%s" : %s will be listed '
+                'on demand.'%(innerFolderID, uri) )
+            ret.append({
+                    'folder' : (prefixURIs or [uri])[0],
+                    'records' : _iter_location_records( prefixURIs, lpp.netloc,
+                                backend.iter_dir_content(uri, **listingKWargs) )
+                })
+            continue
         gLogger.info( 'Listing contents of directory "%s" : %s...'%(
             innerFolderID, uri) )
-        dirContent = backend.get_dir_content(
-                uri,
-                onlyPats=dirListPrescript.pop('only', None),
-                ignorePats=dirListPrescript.pop('ignore', None),
-                extra=dirListPrescript
-            )
+        dirContent = backend.get_dir_content( uri, **listingKWargs )
         if lpp.netloc:
             dirContent['node'] = lpp.netloc
         # Prepend folder path:
-        pToks = split_path( os.path.split(lpp.path)[0] )
-        while pToks:
-            uri = urlunsplit((lpp.scheme or '', lpp.netloc or '', os.path.join(*pToks), '', ''))
-            pToks.pop()
+        for uri in reversed(prefixURIs):
             dirContent = {
                     'folder' : uri,
                     'files' : [],
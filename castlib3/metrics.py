@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Metrics of shell utils invocations: calls count, wall time histogram,
+output volume, return codes and timeouts per util. Collected by
+castlib3.shell routines into gUtilMetrics; may be dumped as JSON or as
+Prometheus text exposition format (e.g. for node exporter's textfile
+collector). The summary is printed after each stages pipeline run, and the
+metrics are dumped to the file given by `dump' key of `metrics' config
+section (or by --metrics-dump option of cstl3-run).
+"""
+
+import os, json, threading
+
+# Upper bounds (seconds) of wall time histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1., 5., 10., 60., 300., 1800.)
+
+class UtilMetrics(object):
+    """
+    Metrics of single util.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.wallTime = 0.
+        self.maxWallTime = 0.
+        self.buckets = [0]*(len(DURATION_BUCKETS) + 1)  # last is +Inf
+        self.stdoutBytes = 0
+        self.stderrBytes = 0
+        self.returnCodes = {}
+        self.timeouts = 0
+
+    def as_dict(self):
+        return {
+                'calls' : self.calls,
+                'wallTime' : self.wallTime,
+                'maxWallTime' : self.maxWallTime,
+                'buckets' : dict( zip( [str(b) for b in DURATION_BUCKETS] + ['+Inf']
+                                     , self.buckets ) ),
+                'stdoutBytes' : self.stdoutBytes,
+                'stderrBytes' : self.stderrBytes,
+                'returnCodes' : dict( (str(k), v) for k, v in self.returnCodes.iteritems() ),
+                'timeouts' : self.timeouts
+            }
+
+class MetricsRegistry(object):
+    """
+    Thread-safe collection of UtilMetrics indexed by util name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.utils = {}
+
+    def _get(self, name):
+        if name not in self.utils:
+            self.utils[name] = UtilMetrics()
+        return self.utils[name]
+
+    def record(self, name, wallTime, returnCode=None, timedOut=False):
+        """
+        Records finished invocation of util.
+        """
+        with self._lock:
+            m = self._get( name )
+            m.calls += 1
+            m.wallTime += wallTime
+            m.maxWallTime = max( m.maxWallTime, wallTime )
+            n = 0
+            while n < len(DURATION_BUCKETS) and wallTime > DURATION_BUCKETS[n]:
+                n += 1
+            m.buckets[n] += 1
+            if timedOut:
+                m.timeouts += 1
+            elif returnCode is not None:
+                m.returnCodes[returnCode] = m.returnCodes.get(returnCode, 0) + 1
+
+    def add_output(self, name, stdoutBytes=0, stderrBytes=0):
+        with self._lock:
+            m = self._get( name )
+            m.stdoutBytes += stdoutBytes
+            m.stderrBytes += stderrBytes
+
+    def reset(self):
+        with self._lock:
+            self.utils = {}
+
+    def __nonzero__(self):
+        return bool(self.utils)
+
+    def summary(self):
+        """
+        Returns human-readable table of metrics.
+        """
+        with self._lock:
+            rows = [ ('util', 'calls', 'total, s', 'mean, s', 'max, s', 'output'
+                     , 'failed', 'timeouts') ]
+            for name in sorted(self.utils.keys()):
+                m = self.utils[name]
+                rows.append( ( name, str(m.calls), '%.2f'%m.wallTime
+                             , '%.3f'%(m.wallTime/m.calls if m.calls else 0)
+                             , '%.3f'%m.maxWallTime
+                             , '%.1fkB'%((m.stdoutBytes + m.stderrBytes)/1024.)
+                             , str(sum( v for k, v in m.returnCodes.iteritems() if k ))
+                             , str(m.timeouts) ) )
+        widths = [ max(len(r[n]) for r in rows) for n in range(len(rows[0])) ]
+        return '\n'.join( '  '.join( c.rjust(w) if n else c.ljust(w)
+                                     for n, (c, w) in enumerate(zip(r, widths)) )
+                          for r in rows )
+
+    def as_dict(self):
+        with self._lock:
+            return dict( (k, v.as_dict()) for k, v in self.utils.iteritems() )
+
+    def prometheus_text(self):
+        """
+        Returns metrics in Prometheus text exposition format.
+        """
+        lines = []
+        def _metric( name, mType, helpStr ):
+            lines.append( '# HELP castlib3_%s %s'%(name, helpStr) )
+            lines.append( '# TYPE castlib3_%s %s'%(name, mType) )
+        data = self.as_dict()
+        _metric( 'util_duration_seconds', 'histogram', 'Wall time of util invocations.' )
+        for util, m in sorted(data.items()):
+            cumulative = 0
+            for le in [str(b) for b in DURATION_BUCKETS] + ['+Inf']:
+                cumulative += m['buckets'][le]
+                lines.append( 'castlib3_util_duration_seconds_bucket{util="%s",le="%s"} %d'%(
+                                util, le, cumulative) )
+            lines.append( 'castlib3_util_duration_seconds_sum{util="%s"} %f'%(util, m['wallTime']) )
+            lines.append( 'castlib3_util_duration_seconds_count{util="%s"} %d'%(util, m['calls']) )
+        _metric( 'util_exits_total', 'counter', 'Util invocations by return code.' )
+        for util, m in sorted(data.items()):
+            for rc, n in sorted(m['returnCodes'].items()):
+                lines.append( 'castlib3_util_exits_total{util="%s",code="%s"} %d'%(util, rc, n) )
+        _metric( 'util_timeouts_total', 'counter', 'Util invocations killed due to timeout.' )
+        for util, m in sorted(data.items()):
+            lines.append( 'castlib3_util_timeouts_total{util="%s"} %d'%(util, m['timeouts']) )
+        _metric( 'util_output_bytes_total', 'counter', 'Bytes of util output.' )
+        for util, m in sorted(data.items()):
+            for stream in ('stdout', 'stderr'):
+                lines.append( 'castlib3_util_output_bytes_total{util="%s",stream="%s"} %d'%(
+                                util, stream, m[stream + 'Bytes']) )
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        """
+        Writes the metrics to file: JSON if its name ends with `.json',
+        Prometheus text format otherwise. File is replaced atomically.
+        """
+        if filename.endswith('.json'):
+            content = json.dumps( self.as_dict(), indent=2, sort_keys=True )
+        else:
+            content = self.prometheus_text()
+        tmpName = '%s.tmp-%d'%(filename, os.getpid())
+        with open(tmpName, 'w') as f:
+            f.write( content )
+        os.rename( tmpName, filename )
+
+gUtilMetrics = MetricsRegistry()
@@ -21,3 +21,31 @@ assert(DeclBase)
 import sys
 setattr( sys.modules[__name__], 'DeclBase', DeclBase )
 
+
+def upgrade_schema( engine ):
+    """
+    Adds the columns declared in models but missing in the existing tables
+    (e.g. File.md5 and File.crc32c appeared in newer versions), so the
+    database created by previous versions may be used as is. Only
+    nullable columns are added this way; the values are NULL until the
+    entries will be synchronized. Returns the list of added columns as
+    `table.column' strings.
+    """
+    from sqlalchemy import inspect
+    inspector = inspect(engine)
+    existingTables = set(inspector.get_table_names())
+    added = []
+    for table in DeclBase.metadata.sorted_tables:
+        if table.name not in existingTables:
+            continue
+        existing = set( c['name'] for c in inspector.get_columns(table.name) )
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable or column.primary_key:
+                raise RuntimeError( 'Column %s.%s is missing in database and '
+                        'can not be added automatically.'%(table.name, column.name) )
+            engine.execute( 'ALTER TABLE %s ADD COLUMN %s %s'%( table.name
+                          , column.name, column.type.compile(dialect=engine.dialect) ) )
+            added.append( '%s.%s'%(table.name, column.name) )
+    return added
@@ -135,10 +135,11 @@ class File(FSEntry, UpdatingMixin):
 
     size = Column( Integer )
     adler32 = Column( String )
+    md5 = Column( String )
+    crc32c = Column( String )
     # TODO: creation date?
     # TODO: last sync date?
     # TODO: local path?
-    # TODO: md5 checksum?
 
     def __str__(self):
         return "-%r: {id=%r, parent_id=%r}" % (
@@ -25,11 +25,14 @@ from __future__ import print_function
 File contains miscellaneous routines for working with system utils via shell.
 """
 
-import os, subprocess, threading, signal
+import os, subprocess, threading, signal, errno, time, atexit, heapq, itertools
 import re, select, sys
 from string import Formatter
 from castlib3.syscfg import gConfig
 from castlib3.logs import gLogger
+from castlib3.coprocess import CoprocessPool, CoprocessTimeout
+from castlib3.metrics import gUtilMetrics
+from castlib3.cassette import Cassette
 
 class TimeoutError( RuntimeError ):
     """
@@ -39,34 +42,121 @@ class TimeoutError( RuntimeError ):
         super(TimeoutError, self).__init__(*args, **kwargs)
 
 
+def timeout_seconds( timeout ):
+    """
+    Returns number of seconds for the timeout specifier: either string
+    ('default', 'short' or 'long', see `timeouts' config section) or
+    positive integer.
+    """
+    if type(timeout) is str:
+        if 'default' == timeout or 'short' == timeout:
+            return gConfig['timeouts']['shortSec']
+        elif 'long' == timeout:
+            return gConfig['timeouts']['longSec']
+        raise RuntimeError( "Couldn't interpret the timeout specifier "
+            "\"%s\"."%timeout )
+    elif type(timeout) is int and timeout > 0:
+        return timeout
+    raise TypeError('"timeout" argument must be either of string value '
+            '=[short|long] or integer.')
+
+class TimeoutReaper(object):
+    """
+    Keeps the heap of deadlines of child processes, serviced by single
+    daemon thread (started on demand) which invokes the expiration callback
+    of the ones being expired. The `nTimeouts' counts the children killed
+    due to timeout (see note_timeout()).
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # [deadline, seq, callback]
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopped = False
+        self.nTimeouts = 0
+
+    def schedule(self, timeoutSecs, callback):
+        """
+        Schedules the `callback' to be invoked in `timeoutSecs'. Returns the
+        handle for cancel().
+        """
+        entry = [ time.time() + timeoutSecs, next(self._seq), callback ]
+        with self._cond:
+            heapq.heappush( self._heap, entry )
+            if self._thread is None:
+                self._thread = threading.Thread( target=self._run
+                                               , name='castlib3-timeout-reaper' )
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        # Entry is removed lazily, once it reaches the top of the heap
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop( self._heap )
+                    left = self._heap[0][0] - time.time() if self._heap else None
+                    if left is not None and left <= 0:
+                        callback = heapq.heappop( self._heap )[2]
+                        break
+                    self._cond.wait( left )
+            try:
+                callback()
+            except Exception as e:
+                gLogger.exception( e )
+
+    def stop(self):
+        """
+        Stops the thread (pending deadlines are not serviced anymore).
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def note_timeout(self):
+        with self._cond:
+            self.nTimeouts += 1
+
+    def __len__(self):
+        with self._cond:
+            return sum( 1 for e in self._heap if e[2] is not None )
+
+gTimeoutReaper = TimeoutReaper()
+# Daemon thread must not be woken up during interpreter shutdown
+atexit.register( gTimeoutReaper.stop )
+
 class TimeoutPopen(subprocess.Popen):
     """
     As we have not the timeout feature in Python 2.6 Popen(), we implemented it.
+    The None `timeout' disables the timer (the caller is responsible for
+    the timeout then). Deadlines of all the children are tracked by single
+    thread of gTimeoutReaper; the deadline is cancelled upon communicate()
+    or wait() returns.
+
+    Wall time, return code and timeout of the process are recorded into
+    gUtilMetrics under the `metricsName' (executable name by default) once
+    the process is waited.
     """
     def __init__(self, *args, **kwargs):
         timeout = kwargs.pop('timeout', 'default')
         dry = kwargs.pop('popenDry', False)
+        self.metricsName = kwargs.pop('metricsName', None) \
+                        or (os.path.basename(args[0]) if args else '?')
+        self.startedAt = None
         self.timeoutInterruptFlag = False
-        if type(timeout) is str:
-            if 'default' == timeout or 'short' == timeout:
-                self.timeoutSecs = gConfig['timeouts']['shortSec']
-            elif 'long' == timeout:
-                self.timeoutSecs = gConfig['timeouts']['longSec']
-            else:
-                raise RuntimeError( "Couldn't interpret the timeout specifier "
-                    "\"%s\"."%timeout )
-        elif type(timeout) is int and timeout > 0:
-            self.timeoutSecs = timeout
-        else:
-            raise TypeError('"timeout" argument must be either of string value '
-                    '=[short|long] or integer.')
-        if timeout:
-            self.timer = threading.Timer(self.timeoutSecs,
-                                         self.terminate_as_timeout_expired)
-            self.timer.daemon = True
-            self.timer.start()
-        else:
-            self.timer = None
+        self.timeoutSecs = None if timeout is None else timeout_seconds( timeout )
+        self.timer = None
         kwargs.update({'preexec_fn' : os.setsid})
         self.poArgs = list(args)
         self.poKwargs = dict(kwargs)
@@ -74,6 +164,25 @@ class TimeoutPopen(subprocess.Popen):
                         + 'kwargs=' + str(kwargs) )
         if not dry:
             super(self.__class__, self).__init__(self.poArgs, bufsize=0, **kwargs)
+            self.startedAt = time.time()
+            if timeout:
+                self.timer = gTimeoutReaper.schedule( self.timeoutSecs
+                                            , self.terminate_as_timeout_expired )
+
+    def cancel_timeout(self):
+        if self.timer:
+            gTimeoutReaper.cancel( self.timer )
+            self.timer = None
+
+    def wait(self, *args, **kwargs):
+        ret = super(TimeoutPopen, self).wait(*args, **kwargs)
+        self.cancel_timeout()
+        if self.startedAt is not None:
+            gUtilMetrics.record( self.metricsName, time.time() - self.startedAt
+                               , returnCode=self.returncode
+                               , timedOut=self.timeoutInterruptFlag )
+            self.startedAt = None
+        return ret
 
     def communicate(self, *args, **kwargs):
         out, err = super(TimeoutPopen, self).communicate(*args, **kwargs)
@@ -81,12 +190,14 @@ class TimeoutPopen(subprocess.Popen):
             raise TimeoutError("Process timeout expired (%d sec)." \
                     "Arguments: args=%r, kwargs=%s" %(self.timeoutSecs, self.poArgs, self.poKwargs) )
         else:
-            if self.timer:
-                self.timer.cancel()
+            self.cancel_timeout()
         return out, err
 
     def terminate_as_timeout_expired(self):
+        if self.returncode is not None:
+            return
         self.timeoutInterruptFlag = True
+        gTimeoutReaper.note_timeout()
         os.killpg(self.pid, signal.SIGKILL)
 
 
@@ -120,6 +231,84 @@ def format_cmdline_args( fmt, *args, **kwargs ):
     assert(fmt)
     return CyclicFormatter().format( fmt, *args, **kwargs )
 
+# Pool of coprocesses, created on demand by coprocess_pool()
+gCoprocessPool = None
+_coprocessPoolLock = threading.Lock()
+
+def coprocess_pool():
+    """
+    Returns the pool of coprocesses (see castlib3.coprocess) configured by
+    `coprocesses' config section or None if it is not configured:
+        coprocesses:
+            utils: [nsls, nsls-dir, rfstat]  # utils to be run by pool
+            nProcesses: 2
+            shell: /bin/sh
+    """
+    global gCoprocessPool
+    cfg = gConfig.get( 'coprocesses', None )
+    if not cfg:
+        return None
+    with _coprocessPoolLock:
+        if gCoprocessPool is None:
+            gCoprocessPool = CoprocessPool( nProcesses=cfg.get('nProcesses', 2)
+                                          , shell=cfg.get('shell', '/bin/sh') )
+            atexit.register( gCoprocessPool.close )
+    return gCoprocessPool
+
+# Cassette of utils invocations, created on demand by active_cassette()
+gCassette = None
+_cassetteLock = threading.Lock()
+
+def active_cassette():
+    """
+    Returns the cassette (see castlib3.cassette) the utils invocations are
+    recorded to or replayed from, configured by `cassette' config section,
+    or None if it is not configured:
+        cassette:
+            file: /tmp/castor-utils.jsonl
+            mode: record  # or replay
+            latency: false  # sleep for recorded wall time on replay
+    """
+    global gCassette
+    cfg = gConfig.get( 'cassette', None )
+    if not cfg:
+        return None
+    with _cassetteLock:
+        if gCassette is None:
+            gCassette = Cassette( cfg['file'], mode=cfg.get('mode', 'record')
+                                , latency=cfg.get('latency', False) )
+            atexit.register( gCassette.close )
+    return gCassette
+
+def _replayed( name, popenArgs ):
+    """
+    Returns the (returnCode, stdout, stderr) triplet of the util invocation
+    recorded in replaying cassette or None, if there is no one. Recorded
+    timeouts are raised as TimeoutError.
+    """
+    cassette = active_cassette()
+    if cassette is None or not cassette.replaying:
+        return None
+    started = time.time()
+    returnCode, stdoutStr, stderrStr = cassette.replay( name, popenArgs )
+    gUtilMetrics.record( name, time.time() - started, returnCode=returnCode
+                       , timedOut=returnCode is None )
+    if returnCode is None:
+        raise TimeoutError( 'Process timeout expired (replayed from %s). '
+                'Arguments: args=%r'%(cassette.filename, popenArgs) )
+    gUtilMetrics.add_output( name, len(stdoutStr), len(stderrStr) )
+    return returnCode, stdoutStr, stderrStr
+
+def _record( name, popenArgs, started, returnCode, stdoutStr='', stderrStr='' ):
+    """
+    Appends the util invocation to the recording cassette, if there is one.
+    The None `returnCode' denotes the timeout.
+    """
+    cassette = active_cassette()
+    if cassette is not None and not cassette.replaying:
+        cassette.record( name, popenArgs, returnCode, stdoutStr, stderrStr
+                       , time.time() - started )
+
 def invoke_util( name,
                  expectedReturnCode=0,
                  noexcept=False,
@@ -147,6 +336,215 @@ def invoke_util( name,
     will be returned.
     @param communicate --- if False, the child's stderr/stdout will be printed
     into terminal as well as stored to string objects.
+
+    Utils listed in `coprocesses' config section are executed by the pool
+    of persistent shell processes (see coprocess_pool()).
+
+    If the cassette is configured (see active_cassette()), the invocations
+    are recorded to it or replayed from it instead of running the util.
+    """
+    popenArgs, popenKwArgs, regexToApply = _util_popen_args( name
+                                    , applyRegexOn, regexToApply, args, kwargs )
+    popenDry = popenKwArgs.get( 'popenDry', False )
+    gLogger.debug( 'popenArgs=%r popenKwArgs=%r'%(popenArgs, popenKwArgs) )
+    replayed = None if popenDry else _replayed( name, popenArgs )
+    if replayed is not None:
+        return _util_result( *(replayed + ( expectedReturnCode, noexcept
+                                          , applyRegexOn, regexToApply
+                                          , popenArgs, popenKwArgs )) )
+    if communicate and not popenDry and name in gConfig['utils'] \
+            and name in (gConfig.get('coprocesses', None) or {}).get('utils', []):
+        timeoutSecs = timeout_seconds( popenKwArgs.get('timeout', 'default') )
+        started = time.time()
+        try:
+            returnCode, stdoutStr, stderrStr = coprocess_pool().run( popenArgs
+                                                                   , timeoutSecs )
+        except CoprocessTimeout as e:
+            gTimeoutReaper.note_timeout()
+            gUtilMetrics.record( name, time.time() - started, timedOut=True )
+            _record( name, popenArgs, started, None )
+            raise TimeoutError( str(e) )
+        gUtilMetrics.record( name, time.time() - started, returnCode=returnCode )
+        gUtilMetrics.add_output( name, len(stdoutStr), len(stderrStr) )
+        _record( name, popenArgs, started, returnCode, stdoutStr, stderrStr )
+        return _util_result( returnCode, stdoutStr, stderrStr
+                           , expectedReturnCode, noexcept
+                           , applyRegexOn, regexToApply
+                           , popenArgs, popenKwArgs )
+    p = None
+    started = time.time()
+    try:
+        p = TimeoutPopen( stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE,
+                      metricsName=name,
+                      *popenArgs, **popenKwArgs )
+    except OSError as e:
+        gLogger.exception(e)
+        gLogger.error( 'TimeoutPopen arguments: args=%r, kwargs=%r'%(popenArgs, popenKwArgs) )
+    if popenDry:
+        return
+    stdoutStr, stderrStr = '', ''
+    if communicate:
+        try:
+            stdoutStr, stderrStr = p.communicate()
+        except TimeoutError:
+            _record( name, popenArgs, started, None )
+            raise
+        gUtilMetrics.add_output( name, len(stdoutStr), len(stderrStr) )
+    else:
+        # Performs real-time forwarding the child's stdout/stderr to the
+        # terminal as well as saving it to strings. Pipes are read with no
+        # buffering, so the output is forwarded as soon as it appears (e.g.
+        # xrdcp's progressbar).
+        chunks = { p.stdout.fileno() : [], p.stderr.fileno() : [] }
+        for fd, chunk in _iter_pipe_chunks( p ):
+            (sys.stdout if fd == p.stdout.fileno() else sys.stderr).write( chunk )
+            chunks[fd].append( chunk )
+        p.wait()
+        stdoutStr = ''.join( chunks[p.stdout.fileno()] )
+        stderrStr = ''.join( chunks[p.stderr.fileno()] )
+        gUtilMetrics.add_output( name, len(stdoutStr), len(stderrStr) )
+        if p.timeoutInterruptFlag:
+            _record( name, popenArgs, started, None )
+            raise TimeoutError("Process timeout expired (%d sec)." \
+                    "Arguments: args=%r, kwargs=%s" %(p.timeoutSecs, p.poArgs, p.poKwargs) )
+    _record( name, popenArgs, started, p.returncode, stdoutStr, stderrStr )
+    return _util_result( p.returncode, stdoutStr, stderrStr
+                       , expectedReturnCode, noexcept
+                       , applyRegexOn, regexToApply
+                       , popenArgs, popenKwArgs )
+
+def _iter_pipe_chunks( p ):
+    """
+    Generator yielding pairs of (fd, chunk) of data read from the child's
+    stdout and stderr pipes as it arrives, until both are closed.
+    """
+    fds = [p.stdout.fileno(), p.stderr.fileno()]
+    while fds:
+        try:
+            ready = select.select( fds, [], [] )[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            chunk = os.read( fd, 65536 )
+            if chunk:
+                yield fd, chunk
+            else:
+                fds.remove( fd )
+
+def iter_util_lines( name,
+                     expectedReturnCode=0,
+                     noexcept=False,
+                     applyRegexOn='stdout',
+                     regexToApply=None,
+                     **kwargs ):
+    """
+    Streaming variant of invoke_util(): generator yielding the util output
+    parsed line by line as it arrives, so the whole output is never kept
+    in memory. If the regex is given (or configured for util), the
+    dictionaries of groups of the lines matching it are yielded; otherwise
+    (or if `applyRegexOn' is None) the stdout lines themselves are yielded
+    (without line endings).
+
+    The return code and timeout are checked once the output is exhausted,
+    raising the same exceptions as invoke_util() does. If the generator is
+    closed before that, the child is killed (and the invocation is not
+    recorded to the cassette).
+    """
+    popenArgs, popenKwArgs, regexToApply = _util_popen_args( name
+                                , applyRegexOn, regexToApply, (), kwargs )
+    if not applyRegexOn:
+        regexToApply = None
+    elif type(regexToApply) is str:
+        regexToApply = re.compile(regexToApply)
+    gLogger.debug( 'popenArgs=%r popenKwArgs=%r'%(popenArgs, popenKwArgs) )
+    def _parse( line ):
+        if regexToApply is None:
+            return line
+        m = regexToApply.match( line )
+        return m.groupdict() if m else None
+    replayed = _replayed( name, popenArgs )
+    if replayed is not None:
+        returnCode, stdoutStr, stderrStr = replayed
+        lines = (stderrStr if 'stderr' == applyRegexOn else stdoutStr).split('\n')
+        if not lines[-1]:
+            lines.pop()
+        for line in lines:
+            record = _parse( line )
+            if record is not None:
+                yield record
+        _util_result( returnCode
+                    , stdoutStr if 'stderr' == applyRegexOn else ''
+                    , stderrStr if 'stderr' != applyRegexOn else ''
+                    , expectedReturnCode, noexcept, None, None
+                    , popenArgs, popenKwArgs )
+        return
+    cassette = active_cassette()
+    # Streamed output is kept only if it has to be recorded
+    streamedChunks = [] if cassette is not None else None
+    started = time.time()
+    p = TimeoutPopen( stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE,
+                      metricsName=name,
+                      *popenArgs, **popenKwArgs )
+    streamFd = p.stderr.fileno() if 'stderr' == applyRegexOn else p.stdout.fileno()
+    otherChunks = []
+    nStreamed = [0]
+    try:
+        tail = ''
+        for fd, chunk in _iter_pipe_chunks( p ):
+            if fd != streamFd:
+                otherChunks.append( chunk )
+                continue
+            nStreamed[0] += len(chunk)
+            if streamedChunks is not None:
+                streamedChunks.append( chunk )
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                record = _parse( line )
+                if record is not None:
+                    yield record
+        if tail:
+            record = _parse( tail )
+            if record is not None:
+                yield record
+        p.wait()
+    finally:
+        if p.returncode is None:
+            try:
+                os.killpg( p.pid, signal.SIGKILL )
+            except OSError:
+                pass
+            p.wait()
+        otherBytes = sum( len(c) for c in otherChunks )
+        if streamFd == p.stdout.fileno():
+            gUtilMetrics.add_output( name, nStreamed[0], otherBytes )
+        else:
+            gUtilMetrics.add_output( name, otherBytes, nStreamed[0] )
+    if p.timeoutInterruptFlag:
+        _record( name, popenArgs, started, None )
+        raise TimeoutError("Process timeout expired (%d sec)." \
+                "Arguments: args=%r, kwargs=%s" %(p.timeoutSecs, p.poArgs, p.poKwargs) )
+    otherStr = ''.join( otherChunks )
+    if streamedChunks is not None:
+        streamedStr = ''.join( streamedChunks )
+        if streamFd == p.stdout.fileno():
+            _record( name, popenArgs, started, p.returncode, streamedStr, otherStr )
+        else:
+            _record( name, popenArgs, started, p.returncode, otherStr, streamedStr )
+    _util_result( p.returncode
+                , otherStr if streamFd == p.stderr.fileno() else ''
+                , otherStr if streamFd == p.stdout.fileno() else ''
+                , expectedReturnCode, noexcept, None, None
+                , popenArgs, popenKwArgs )
+
+def _util_popen_args( name, applyRegexOn, regexToApply, args, kwargs ):
+    """
+    Looks up the util by name and returns the triplet of TimeoutPopen
+    arguments, keyword arguments and the regex to apply on output.
     """
     popenArgs = []
     popenKwArgs = {}
@@ -176,42 +574,16 @@ def invoke_util( name,
         popenKwArgs['popenDry'] = True
     if 'timeout' in kwargs.keys():
         popenKwArgs['timeout'] = kwargs['timeout']
-    gLogger.debug( 'popenArgs=%r popenKwArgs=%r'%(popenArgs, popenKwArgs) )
-    p = None
-    try:
-        p = TimeoutPopen( stdout=subprocess.PIPE,
-                      stderr=subprocess.PIPE,
-                      *popenArgs, **popenKwArgs )
-    except OSError as e:
-        gLogger.exception(e)
-        gLogger.error( 'TimeoutPopen arguments: args=%r, kwargs=%r'%(popenArgs, popenKwArgs) )
-    if popenDry:
-        return
-    stdoutStr, stderrStr = '', ''
-    if communicate:
-        stdoutStr, stderrStr = p.communicate()
-    else:
-        # This code is kinda tricky. Performs real-time forwarding the child's
-        # stdout/stderr to the terminal as well as saving it to strings.
-        # tnx to: http://stackoverflow.com/questions/12270645/can-you-make-a-python-subprocess-output-stdout-and-stderr-as-usual-but-also-cap
-        # TODO: does not work for single line output (like xrdcp's progressbar).
-        # I believe it is because of line-buffering of pty. Suggest other
-        # alternatives: http://stackoverflow.com/questions/12419198/python-subprocess-readlines-hangs
-        while True:
-            reads = [p.stdout.fileno(), p.stderr.fileno()]
-            ret = select.select(reads, [], [])
-            for fd in ret[0]:
-                if fd == p.stdout.fileno():
-                    read = p.stdout.read()  #p.stdout.readline()
-                    sys.stdout.write( read )
-                    stdoutStr += read
-                if fd == p.stderr.fileno():
-                    read = p.stderr.read()  #p.stderr.readline()
-                    sys.stderr.write( read )
-                    stderrStr += read
-            if p.poll() != None:
-                break
-    returnCode = p.returncode
+    return popenArgs, popenKwArgs, regexToApply
+
+def _util_result( returnCode, stdoutStr, stderrStr
+                , expectedReturnCode, noexcept
+                , applyRegexOn, regexToApply
+                , popenArgs, popenKwArgs ):
+    """
+    Checks the util return code and applies the regex on its output (see
+    invoke_util()).
+    """
     gLogger.debug( 'Last subprocess.Popen.communicate() finished with rc=' + \
                     str(returnCode) )
 
@@ -237,3 +609,134 @@ def invoke_util( name,
         strcheck = stderrStr
     return [m.groupdict() for m in regexToApply.finditer(strcheck)]
 
+
+class _UtilChild(object):
+    """
+    Child process of iter_invoke_util() with its output collected so far.
+    """
+    def __init__(self, n, name, kwargs):
+        self.n = n
+        self.name = name
+        self.expectedReturnCode = kwargs.pop('expectedReturnCode', 0)
+        self.noexcept = kwargs.pop('noexcept', False)
+        self.applyRegexOn = kwargs.pop('applyRegexOn', 'stdout')
+        self.popenArgs, self.popenKwArgs, self.regexToApply = _util_popen_args(
+                name, self.applyRegexOn, kwargs.pop('regexToApply', None), (), kwargs )
+        popenKwArgs = dict(self.popenKwArgs)
+        self.timeoutSecs = timeout_seconds( popenKwArgs.pop('timeout', 'default') )
+        self.timeoutInterruptFlag = False
+        self.started = time.time()
+        self.p = TimeoutPopen( stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               timeout=None,
+                               metricsName=name,
+                               *self.popenArgs, **popenKwArgs )
+        self.deadline = time.time() + self.timeoutSecs
+        self.stdoutFd, self.stderrFd = self.p.stdout.fileno(), self.p.stderr.fileno()
+        self.chunks = { self.stdoutFd : [], self.stderrFd : [] }
+        self.open = set(self.chunks.keys())
+
+    def read(self, fd):
+        chunk = os.read( fd, 65536 )
+        if chunk:
+            self.chunks[fd].append( chunk )
+        else:
+            self.open.discard( fd )
+
+    def kill(self):
+        self.timeoutInterruptFlag = True
+        try:
+            os.killpg( self.p.pid, signal.SIGKILL )
+        except OSError:
+            pass  # already finished
+
+    def result(self):
+        self.p.stdout.close()
+        self.p.stderr.close()
+        self.p.wait()
+        gUtilMetrics.add_output( self.name, sum(len(c) for c in self.chunks[self.stdoutFd])
+                                          , sum(len(c) for c in self.chunks[self.stderrFd]) )
+        if self.timeoutInterruptFlag:
+            _record( self.name, self.popenArgs, self.started, None )
+            raise TimeoutError("Process timeout expired (%d sec)." \
+                    "Arguments: args=%r, kwargs=%s" %(self.timeoutSecs, self.popenArgs, self.popenKwArgs) )
+        stdoutStr = ''.join(self.chunks[self.stdoutFd])
+        stderrStr = ''.join(self.chunks[self.stderrFd])
+        _record( self.name, self.popenArgs, self.started, self.p.returncode
+               , stdoutStr, stderrStr )
+        return _util_result( self.p.returncode, stdoutStr, stderrStr
+                           , self.expectedReturnCode, self.noexcept
+                           , self.applyRegexOn, self.regexToApply
+                           , self.popenArgs, self.popenKwArgs )
+
+def iter_invoke_util( calls, nConcurrent=8 ):
+    """
+    Generator running the utils with at most `nConcurrent' children at
+    once. The `calls' is an iterable of (name, kwargs) pairs, where `kwargs'
+    are the keyword arguments of invoke_util() (`communicate' is not
+    supported, util arguments have to be given by keywords). Yields pairs of
+    (call number, result) in order of completion, where result is the same
+    as invoke_util() returns.
+
+    The output of all children is multiplexed with select() in the calling
+    thread and timeouts are tracked there as well, so no threads are
+    created. Exceptions are raised the same way invoke_util() does; the
+    rest of running children are killed then.
+
+    When replaying the cassette, the recorded results are yielded in order
+    of `calls' (so the recorded latencies are reproduced one by one).
+    """
+    cassette = active_cassette()
+    if cassette is not None and cassette.replaying:
+        for n, (name, kwargs) in enumerate(calls):
+            yield n, invoke_util( name, **kwargs )
+        return
+    calls = enumerate(calls)
+    active = []
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(active) < nConcurrent:
+                try:
+                    n, (name, kwargs) = next(calls)
+                except StopIteration:
+                    exhausted = True
+                    break
+                active.append( _UtilChild( n, name, dict(kwargs) ) )
+            if not active:
+                break
+            fds = dict( (fd, c) for c in active for fd in c.open )
+            timeout = max(0, min( c.deadline for c in active if c.open ) - time.time()) \
+                      if fds else 0
+            try:
+                ready = select.select( fds.keys(), [], [], timeout )[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                ready = []
+            for fd in ready:
+                fds[fd].read( fd )
+            now = time.time()
+            for c in list(active):
+                if c.open:
+                    if now >= c.deadline and not c.timeoutInterruptFlag:
+                        gTimeoutReaper.note_timeout()
+                        c.p.timeoutInterruptFlag = True
+                        c.kill()
+                    continue
+                active.remove( c )
+                yield c.n, c.result()
+    finally:
+        for c in active:
+            c.kill()
+            c.p.wait()
+
+def invoke_util_many( calls, nConcurrent=8 ):
+    """
+    Runs the utils concurrently (see iter_invoke_util()) and returns the
+    list of results in order of `calls'.
+    """
+    ret = {}
+    for n, result in iter_invoke_util( calls, nConcurrent=nConcurrent ):
+        ret[n] = result
+    return [ ret[n] for n in range(len(ret)) ]
@@ -27,6 +27,8 @@ from sqlalchemy.exc import DatabaseError
 
 from castlib3 import dbShim as DB
 from castlib3.logs import gLogger
+from castlib3.metrics import gUtilMetrics
+from castlib3.syscfg import gConfig
 import castlib3.logs
 import castlib3.utils
 
@@ -160,6 +162,14 @@ class Stages(list):
                 gLogger.info( "Updating local caching database..." )
                 stageInstance.commit()
                 gLogger.info( "\033[1mLocal cache updated.\033[0m" )
+        if gUtilMetrics:
+            gLogger.info( 'Shell utils invocations:\n%s'%gUtilMetrics.summary() )
+            dumpFile = (gConfig.get('metrics', None) or {}).get('dump', None)
+            if dumpFile:
+                gUtilMetrics.dump( dumpFile )
+            # Each run (e.g. in watch mode) is summarized on its own, including
+            # the invocations performed before it (directories listing)
+            gUtilMetrics.reset()
         return results
 
     def __str__(self):
@@ -23,6 +23,8 @@ from castlib3.stage import Stage, StageMetaclass
 from castlib3.models.filesystem import Folder, File, RemoteFolder, StoragingNode, FSEntry
 from castlib3.logs import gLogger
 from castlib3.backend import LocalBackend
+from castlib3.filesystem import walk, split_path
+from castlib3.checksum import gDigestAlgorithms
 from castlib3 import dbShim as DB
 
 from sqlalchemy import exists, and_
@@ -38,6 +40,8 @@ class Stats(object):
     """
     def __init__(self):
         self.stats = {}
+        # Number of folders left intact as unchanged (incremental mode)
+        self.nUnchanged = 0
 
     def get_stats_for(self, cls):
         if cls in self.stats.keys():
@@ -66,38 +70,42 @@ class Stats(object):
         return ret
 
 
-def index_directory( dirEntry, backend
-                    , parent=None
-                    , syncFields=[]
-                    , report=None
-                    , maxNewFiles=0 ):
+def _bulk_digests( backend, localPath, filenames, fileStats, algos ):
     """
-    This recursive function performs synchronization fielsystem entries
-    (files and directories) against database entries.
+    Obtains digests (checksums) of given files with backend's bulk routine,
+    reading each file only once for all the algorithms. Returns copy of
+    `fileStats' dictionary updated with them.
+    """
+    ret = dict( (k, dict(v)) for k, v in fileStats.iteritems() )
+    paths = [ P.join(localPath, fn) for fn in filenames \
+              if any( algo not in ret.get(fn, {}) for algo in algos ) ]
+    if paths:
+        gLogger.info( 'Computing %s checksums for %d files in %s...'%(
+                    ', '.join(algos), len(paths), localPath) )
+    for path, digests in backend.get_digests_many( paths, algos ):
+        ret.setdefault( P.basename(path), {} ).update( digests )
+    return ret
 
-    The function is usually called within the :class:`IndexDirectory` stage
-    performing recursive traversal along the filesystem-like structure.
+def index_folder( dirEntry, backend
+                 , parent=None
+                 , syncFields=[]
+                 , report=None
+                 , maxNewFiles=0 ):
+    """
+    Performs synchronization of single folder content (files and folder
+    itself) against database entries. Sub-folders are not considered here,
+    see :func:`index_directory` and :func:`index_directory_stream`.
 
-    :param dirEntry:
-        is the dictionary of special structure (usually returned by
-        :ref:`discover_entries`) describing the local or remote directory
-        to be considered.
-    :param backend:
-        the :class:`Backend` subclass implementing particular data access
-        methods.
-    :param parent:
-        is the parent node, if exists.
-    :param syncFields:
-        a list contining names of file attributes to be updated/set on
-        creation.
-    :parame maxNewFiles:
-        if set to non-zero value, only `maxNewFiles` new files may be added.
-        When this limit will be reached, the no updating procedures will take
-        place and function returns.
+    If the folder entry has `partial' flag set, only the listed files are
+    considered and the rest of cached ones are left intact (the watch mode
+    provides such entries for folders with few changed files, see
+    :class:`castlib3.watch.DirectoryWatcher`).
+
+    Arguments are the same as for :func:`index_directory`. Returns the
+    folder database entry.
     """
     # -------------------------------------------------------------------------
     # Querying the parent structures
-    report = report or Stats()
     # Look-up for these files in database:
     localPath = dirEntry['folder']
     dirName = P.split( dirEntry['folder'] )[1] or '/'
@@ -138,6 +146,22 @@ def index_directory( dirEntry, backend
         if nodeCreated or folderCreated:
             DB.session.add(node)
             DB.session.flush()
+    if dirEntry.get('unchanged', False):
+        # Folder wasn't modified since last indexing (incremental listing)
+        report.nUnchanged += 1
+        return folderEntry
+    # Attributes obtained during listing (if any):
+    fileStats = dirEntry.get('fileStats', None) or {}
+    # Checksums are requested for the whole folder at once, so backend may
+    # compute them concurrently:
+    algos = [ f for f in syncFields if f in gDigestAlgorithms ]
+    if algos:
+        newNames = [ fn for fn in dirEntry['files'] if fn not in folderEntry.children ]
+        if maxNewFiles > 0:
+            newNames = newNames[:max(0, maxNewFiles - report.get_stats_for(File)['created'])]
+        fileStats = _bulk_digests( backend, localPath,
+                [ fn for fn in dirEntry['files'] if fn in folderEntry.children ] + newNames,
+                fileStats, algos )
     # -------------------------------------------------------------------------
     # Verification of existing caches
     if len(folderEntry.children):
@@ -151,12 +175,19 @@ def index_directory( dirEntry, backend
             if not type(cEntry) is File:
                 continue
             if not cEntry.name in dirEntry['files']:
+                if dirEntry.get('partial', False):
+                    # Only some of the files were listed
+                    continue
                 # TODO:
                 raise NotImplementedError('File deletion is not yet implemented.')
             upd = {}
             filePath = P.join( localPath, cEntry.name )
+            st = fileStats.get(cEntry.name, {})
             for fName in syncFields:
-                upd[fName] = getattr(backend, 'get_' + fName)(filePath)
+                if fName in st.keys():
+                    upd[fName] = st[fName]
+                else:
+                    upd[fName] = getattr(backend, 'get_' + fName)(filePath)
             fileUpdated = cEntry.update_fields(**upd)
             if fileUpdated:
                 DB.session.add(cEntry)
@@ -172,6 +203,7 @@ def index_directory( dirEntry, backend
     # -------------------------------------------------------------------------
     # Introducing new file entries
     bar = None
+    limitReached = False
     if len((dirEntry['files'])) > 10:
         bar = progress.bar.Bar( '  listing new entries at %s'%dirEntry['folder'],
                 max=( len((dirEntry['files'])) if 0 == maxNewFiles else maxNewFiles ),
@@ -181,18 +213,28 @@ def index_directory( dirEntry, backend
         fileEntry = backend.new_file( filePath
                                     , name=filename
                                     , syncFields=syncFields
-                                    , parent=folderEntry )
+                                    , parent=folderEntry
+                                    , _stat=fileStats.get(filename, None) )
         folderUpdated = True
         report.crd_inc(File)
         if bar:
             bar.next()
         if maxNewFiles > 0 \
             and report.get_stats_for(File)['created'] >= maxNewFiles:
+            limitReached = True
             break  # maxNewFiles limit exceeded
     if bar:
         bar.finish()
     # -------------------------------------------------------------------------
-    # Recursive invokation on sub-folders
+    # Updating folder entry itself
+    if 'modified' in dirEntry:
+        # Folder modification time taken prior to listing (incremental
+        # listing). Reset it for partially indexed folders so they won't be
+        # considered as unchanged.
+        modified = None if limitReached else dirEntry['modified']
+        if folderEntry.modified != modified:
+            folderEntry.modified = modified
+            folderUpdated = folderUpdated or not folderCreated
     if folderUpdated:
         report.upd_inc(type(folderEntry))
     elif folderCreated:
@@ -201,14 +243,128 @@ def index_directory( dirEntry, backend
         DB.session.add( folderEntry )
         gLogger.info('Flushing caches...')
         DB.session.flush()
-    for subDir in dirEntry['subFolders']:
-        index_directory( subDir
-                       , backend
-                       , parent=folderEntry
-                       , syncFields=syncFields
-                       , report=report
-                       , maxNewFiles=maxNewFiles )
-    return folderEntry, report
+    return folderEntry
+
+def unchanged_folders_lookup():
+    """
+    Returns callable for incremental listing (see
+    :meth:`castlib3.backend.AbstractBackend.list_folder`). It looks up the
+    cached folder entry by its path and, if the cached modification time
+    equals to the current one, returns the names of cached sub-folders.
+    Found entries are memoized, so every folder is queried only once.
+    """
+    cache = {}
+    def _folder( pToks ):
+        if pToks not in cache:
+            parent = None
+            if len(pToks) > 1:
+                parent = _folder( pToks[:-1] )
+                if parent is None:
+                    cache[pToks] = None
+                    return None
+            cache[pToks] = DB.session.query(Folder).filter(
+                      Folder.name == pToks[-1] \
+                    , Folder.parent == parent ).one_or_none()
+        return cache[pToks]
+    def _unchanged( dirPath, modified ):
+        folderEntry = _folder( tuple(split_path(urlparse(dirPath).path)) )
+        if folderEntry is None or folderEntry.modified != modified:
+            return None
+        return sorted( c.name for c in folderEntry.children.values() \
+                       if isinstance(c, Folder) )
+    return _unchanged
+
+def index_directory( dirEntry, backend
+                    , parent=None
+                    , syncFields=[]
+                    , report=None
+                    , maxNewFiles=0
+                    , order='dfs'
+                    , maxQueue=0 ):
+    """
+    This function performs synchronization fielsystem entries (files and
+    directories) against database entries.
+
+    The function is usually called within the :class:`IndexDirectory` stage
+    performing traversal along the filesystem-like structure. Traversal is
+    done by :func:`castlib3.filesystem.walk` without recursion, so only the
+    pending sub-folders entries are kept in memory.
+
+    :param dirEntry:
+        is the dictionary of special structure (usually returned by
+        :ref:`discover_entries`) describing the local or remote directory
+        to be considered.
+    :param backend:
+        the :class:`Backend` subclass implementing particular data access
+        methods.
+    :param parent:
+        is the parent node, if exists.
+    :param syncFields:
+        a list contining names of file attributes to be updated/set on
+        creation. The digests (adler32, md5, crc32c) listed here are
+        computed within single read of each file.
+    :parame maxNewFiles:
+        if set to non-zero value, only `maxNewFiles` new files may be added.
+        When this limit will be reached, the no updating procedures will take
+        place and function returns.
+    :param order:
+        traversal order, 'dfs' or 'bfs'.
+    :param maxQueue:
+        soft limit for pending folders queue (see
+        :func:`castlib3.filesystem.walk`).
+    """
+    report = report or Stats()
+    def _expand( node ):
+        subDir, parentEntry = node
+        folderEntry = index_folder( subDir
+                                  , backend
+                                  , parent=parentEntry
+                                  , syncFields=syncFields
+                                  , report=report
+                                  , maxNewFiles=maxNewFiles )
+        return folderEntry, [ (sd, folderEntry) for sd in subDir['subFolders'] ]
+    topEntry = None
+    for node, folderEntry in walk( [(dirEntry, parent)], _expand
+                                 , order=order
+                                 , maxQueue=maxQueue ):
+        if topEntry is None:
+            topEntry = folderEntry
+    return topEntry, report
+
+def index_directory_stream( records, backend
+                          , parent=None
+                          , syncFields=[]
+                          , report=None
+                          , maxNewFiles=0 ):
+    """
+    Streaming counterpart of :func:`index_directory` consuming flat folder
+    records (see :func:`castlib3.filesystem.discover_entries` with
+    `stream=True`) one by one, as they are being listed. Records are
+    expected to follow in depth-first pre-order, so only the chain of
+    ancestors of current record is kept in memory (thus, records listed in
+    breadth-first order are not supported here).
+
+    Returns the database entry of the first (top-most) folder and report.
+    """
+    report = report or Stats()
+    stack = []  # chain of (folder path, folder entry) pairs
+    topEntry = None
+    for dirEntry in records:
+        while stack and stack[-1][0] != dirEntry['parent']:
+            stack.pop()
+        if dirEntry['parent'] is not None and not stack:
+            raise RuntimeError( 'Record of folder "%s" came before its parent '
+                    '"%s".'%(dirEntry['folder'], dirEntry['parent']) )
+        folderEntry = index_folder( dirEntry
+                                  , backend
+                                  , parent=stack[-1][1] if stack else parent
+                                  , syncFields=syncFields
+                                  , report=report
+                                  , maxNewFiles=maxNewFiles )
+        if topEntry is None:
+            topEntry = folderEntry
+        stack.append( (dirEntry['folder'], folderEntry) )
+    return topEntry, report
 
 
 class IndexDirectory( Stage ):
@@ -231,6 +387,8 @@ class IndexDirectory( Stage ):
                 , backends={}
                 , syncFields=[]
                 , maxNewFiles=0
+                , traversal='dfs'
+                , maxQueue=0
                 , noCommit=False ):
         if directory is None:
             raise RuntimeError( 'Keyword argument directory= is mandatory'
@@ -250,8 +408,23 @@ class IndexDirectory( Stage ):
             gLogger.warning('The "maxNewFiles" limit is set! Only %d new '
                     'files may be introduced during the '
                     'single stage evaluation.'%maxNewFiles )
-        fe, rep = index_directory( directory, backend, parent=None,
+        if 'records' in directory:
+            fe, rep = index_directory_stream( directory['records'], backend,
+                                            parent=None,
                                             syncFields=syncFields,
                                             maxNewFiles=maxNewFiles )
+        else:
+            fe, rep = index_directory( directory, backend, parent=None,
+                                            syncFields=syncFields,
+                                            maxNewFiles=maxNewFiles,
+                                            order=traversal,
+                                            maxQueue=maxQueue )
         gLogger.info( 'Sync stage stats: %s.'%( rep ) )
+        if rep.nUnchanged:
+            gLogger.info( '%d folder(s) were not modified since last indexing '
+                    'and were skipped.'%rep.nUnchanged )
+        if getattr(backend, 'checksumCache', None) is not None:
+            gLogger.info( 'Checksum cache: %s.'%backend.checksumCache )
+        if getattr(backend, 'listingCache', None) is not None:
+            gLogger.info( 'Listing cache: %s.'%backend.listingCache )
 
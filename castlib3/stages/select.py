@@ -58,6 +58,9 @@ def _adler32_compare( refLoc, dstLoc, **kwargs ):
                     .filter_by( parent=dstLoc ) \
                     .join( RefFile,
                            and_( RefFile.name    == File.name
+                               # Files of different size are handled by
+                               # 'size' comparison:
+                               , RefFile.size    == File.size
                                , RefFile.adler32 != File.adler32 ) )
 
 def _modified_compare( refLoc, dstLoc, **kwargs ):
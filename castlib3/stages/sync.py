@@ -29,11 +29,59 @@ import os, json
 
 from castlib3.stage import Stage, StageMetaclass
 from castlib3.logs import gLogger
+from castlib3.transfers import TransferScheduler
 from castlib3 import dbShim as DB
 from urlparse import urlparse, urlunparse
 
 import progress.bar
 
+def _iter_with_adler32( files, backends ):
+    """
+    Generator yielding pairs of (file entry, adler32 checksum). Checksums
+    are requested from backends in bulk, so pairs follow in order of
+    checksums computation completion.
+    """
+    byScheme = {}
+    for f in files:
+        uri = f.get_uri()
+        byScheme.setdefault( urlparse(uri).scheme or 'file', {} )[uri] = f
+    for scheme, entries in byScheme.iteritems():
+        for uri, a32 in backends[scheme].get_adler32_many( entries.keys() ):
+            yield entries[uri], a32
+
+def _upload( backend, srcURI, dstURI, modified, backends, rewrite=False ):
+    """
+    Copies (or re-writes) the file and sets its modification time. Returns
+    the pair of modification time and size of destination file. Invoked
+    by transfer scheduler threads, so it must not touch the database.
+    """
+    if rewrite:
+        backend.rewrite_file( srcURI, dstURI, backends=backends )
+    else:
+        backend.cpy_file( srcURI, dstURI, backends=backends )
+    backend.set_modified( dstURI, modified )
+    return backend.get_modified( dstURI ), backend.get_size( dstURI )
+
+def _rewrite_checksummed( backend, srcURI, dstURI, modified, backends ):
+    """
+    Re-writes the file (see _upload()) and returns the triplet of
+    modification time, size and adler32 checksum of destination file.
+    """
+    newTs, newSize = _upload( backend, srcURI, dstURI, modified, backends
+                            , rewrite=True )
+    return newTs, newSize, backend.get_adler32( dstURI )
+
+def _verify_upload( refModified, refSize, newTs, newSize, truncateSeconds ):
+    if newTs != refModified:
+        if not truncateSeconds \
+            or not newTs.replace(second=0, microsecond=0) \
+                == refModified.replace(second=0, microsecond=0):
+            gLogger.warning('Modified timestamp verification failed. Referential: %r, '
+                'real: %r'%( refModified, newTs ) )
+    if not newSize == refSize:
+        gLogger.warning('Size verification failed. Referential: %d, '
+                'real: %d'%( refSize, newSize ) )
+
 class Sync( Stage ):
     __metaclass__ = StageMetaclass
     __castlib3StageParameters = {
@@ -42,7 +90,9 @@ class Sync( Stage ):
         Stage performing various synchronization routines against the selected
         mismatches. Requires that one or more Select stages was (were)
         performed in pipeline prior to it to choose the particular mismatching
-        entries.
+        entries. Files are transferred concurrently by `nTransfers' threads
+        (see castlib3.transfers.TransferScheduler for the limits and retries
+        options).
         """
     }
 
@@ -59,6 +109,10 @@ class Sync( Stage ):
                 , truncateSeconds=False
                 , extractChecksumOnUpload=True
                 , validateChecksum=True
+                , nTransfers=1
+                , transfersPerDestination=0
+                , transferRetries=0
+                , transferBackoff=5.
             ):
         if not results:
             raise RuntimeError('The Select stage instance has to find out the '
@@ -68,6 +122,10 @@ class Sync( Stage ):
                     'sync stage to reference particular mismatch id.')
         if not mismatches or not len(mismatches):
             mismatches = results[from_].keys()
+        scheduler = TransferScheduler( nTransfers=nTransfers
+                                     , perDestination=transfersPerDestination
+                                     , retries=transferRetries
+                                     , backoff=transferBackoff )
         for n, mismatchesName in enumerate(mismatches):
             n += 1
             if not hasattr(self, 'sync_' + mismatchesName):
@@ -91,7 +149,10 @@ class Sync( Stage ):
                                                    , truncateSeconds=truncateSeconds
                                                    , extractChecksumOnUpload=extractChecksumOnUpload
                                                    , commitEvery=commitEvery
-                                                   , validateChecksum=validateChecksum )
+                                                   , validateChecksum=validateChecksum
+                                                   , scheduler=scheduler )
+        if scheduler.nDone or scheduler.nFailed:
+            gLogger.info( 'Transfers: %s.'%scheduler )
 
     def sync_modified( self
                      , mismatchQuery, refLoc, dstLoc
@@ -99,7 +160,8 @@ class Sync( Stage ):
                      , commitEvery=0
                      , truncateSeconds=False
                      , extractChecksumOnUpload=True
-                     , validateChecksum=True ):
+                     , validateChecksum=True
+                     , scheduler=None ):
         bar = progress.bar.Bar( 'syncing modified timestamps'
                     , max=mismatchQuery.count()
                     , suffix='%(index)d/%(max)d, %(eta)ds remains' )
@@ -132,49 +194,89 @@ class Sync( Stage ):
             # TODO: commitEvery
         bar.finish()
 
-    def sync_size( self
-                 , mismatchQuery, refLoc, dstLoc
-                 , backends={}
-                 , commitEvery=0
-                 , truncateSeconds=False
-                 , extractChecksumOnUpload=True
-                 , validateChecksum=True ):
-        #bar = progress.bar.Bar( 're-uploading files with mismatched size'
-        #            , max=mismatchQuery.count()
-        #            , suffix='%(index)d/%(max)d, %(eta)ds remains' )
+    def _rewrite_mismatching( self, mismatchQuery, backends, commitEvery
+                            , truncateSeconds, scheduler, checksummed=False ):
+        """
+        Re-writes the target files of mismatching pairs with referential
+        ones (see AbstractBackend.rewrite_file()) and updates the target
+        entries. If `checksummed' is set, the adler32 checksum of re-written
+        file is obtained and verified as well.
+        """
+        scheduler = scheduler or TransferScheduler()
         n, nMax = 0, mismatchQuery.count()
-        for entry in mismatchQuery:
+        entries = {}  # job number -> (target URI, target file entry, referential one)
+        def _jobs():
+            trgURIs = set()
+            for nJob, entry in enumerate(mismatchQuery):
+                trgF = entry[0]
+                refF = entry[1]
+                trgURI, refURI = trgF.get_uri(), refF.get_uri()
+                trgLPP, refLPP = urlparse(trgURI), urlparse(refURI)
+                if trgURI in trgURIs:
+                    gLogger.error( 'Skipping re-uploading of %s to %s: the target '
+                            'is already being re-written.'%(refURI, trgURI) )
+                    continue
+                trgURIs.add( trgURI )
+                gLogger.info( 'Re-uploading %s (size=%d, adler32=%s) on location '
+                        '%s (size=%s, adler32=%s).'%( refURI, refF.size, refF.adler32
+                                                    , trgURI, trgF.size, trgF.adler32 ) )
+                entries[nJob] = (trgURI, trgF, refF)
+                trgBackend = backends[trgLPP.scheme or 'file']
+                args = (trgBackend, refURI, trgURI, refF.modified, backends)
+                if checksummed:
+                    yield trgLPP.scheme or 'file', nJob, _rewrite_checksummed, args
+                else:
+                    yield trgLPP.scheme or 'file', nJob, _upload, args + (True,)
+        for nJob, result, e in scheduler.run( _jobs() ):
             n += 1
-            trgF = entry[0]
-            refF = entry[1]
-            trgURI, refURI = trgF.get_uri(), refF.get_uri()
-            trgLPP, refLPP = urlparse(trgURI), urlparse(refURI)
-            gLogger.info( 'Re-uploading \033[1m%d/%d\033[0m : %s (size=%d) on location %s (size=%s).'%(
-                    n, nMax,
-                    refURI, refF.size, trgURI, trgF.size ) )
-            trgBackend = backends[trgLPP.scheme or 'file']
-            trgBackend.rewrite_file( refURI, trgURI, backends=backends )
-            # Correct timestamp:
-            trgBackend.set_modified( trgURI, refF.modified )
+            trgURI, trgF, refF = entries.pop( nJob )
+            if e is not None:
+                gLogger.error( 'Re-uploading \033[1m%d/%d\033[0m to %s failed: %s'%(
+                            n, nMax, trgURI, e ) )
+                continue
+            gLogger.info( 'Re-uploaded \033[1m%d/%d\033[0m : %s.'%(n, nMax, trgURI) )
             # Verify upload:
-            newTs = trgBackend.get_modified( trgURI )
-            newSize = trgBackend.get_size( trgURI )
-            if newTs != refF.modified:
-                if not truncateSeconds \
-                    or not newTs.replace(second=0, microsecond=0) \
-                        == refF.modified.replace(second=0, microsecond=0):
-                    gLogger.warning('Modified timestamp verification failed. Referential: %r, '
-                        'real: %r'%( refF.modified, newTs ) )
+            newTs, newSize = result[:2]
+            _verify_upload( refF.modified, refF.size, newTs, newSize, truncateSeconds )
             trgF.modified = newTs
-            if not newSize == refF.size:
-                gLogger.warning('Size verification failed. Referential: %d, '
-                        'real: %d'%( refF.size, newSize ) )
             trgF.size = newSize
+            if checksummed:
+                if refF.adler32 is not None \
+                        and int(result[2], 16) != int(refF.adler32, 16):
+                    gLogger.warning( 'Checksum verification failed. Referential: '
+                            '%s, real: %s'%( refF.adler32, result[2] ) )
+                trgF.adler32 = result[2]
             DB.session.add( trgF )
             if commitEvery and 0 == n%commitEvery:
                 self.commit()
-            #bar.next()
-        #bar.finish()
+
+    def sync_size( self
+                 , mismatchQuery, refLoc, dstLoc
+                 , backends={}
+                 , commitEvery=0
+                 , truncateSeconds=False
+                 , extractChecksumOnUpload=True
+                 , validateChecksum=True
+                 , scheduler=None ):
+        self._rewrite_mismatching( mismatchQuery, backends, commitEvery
+                                 , truncateSeconds, scheduler )
+
+    def sync_adler32( self
+                    , mismatchQuery, refLoc, dstLoc
+                    , backends={}
+                    , commitEvery=0
+                    , truncateSeconds=False
+                    , extractChecksumOnUpload=True
+                    , validateChecksum=True
+                    , scheduler=None ):
+        """
+        Re-writes the copies whose content differs while their size may
+        match (e.g. patched header), so the backends able to patch the copy
+        in place transfer only the differing blocks.
+        """
+        self._rewrite_mismatching( mismatchQuery, backends, commitEvery
+                                 , truncateSeconds, scheduler
+                                 , checksummed=True )
 
     def sync_missing( self
                     , mismatchQuery, refLoc, dstLoc
@@ -182,50 +284,64 @@ class Sync( Stage ):
                     , commitEvery=0
                     , truncateSeconds=False
                     , extractChecksumOnUpload=True
-                    , validateChecksum=True ):
+                    , validateChecksum=True
+                    , scheduler=None ):
+        scheduler = scheduler or TransferScheduler()
         n, nMax = 0, mismatchQuery.count()
         if nMax > 1e6:
             gLogger.warning('Too much entries to treat. Check selection criteria.')
             return
+        srcFiles = []
         for entry in mismatchQuery:
-            n += 1
-            srcF = entry[0]
             assert( entry[1] is None )  # Has be size mismatch.
-            srcURI, dstURI = srcF.get_uri(), os.path.join(dstLoc.get_uri(), srcF.name)
-            srcLPP = urlparse(srcURI)
-            dstLPP = urlparse(dstURI)
-            # Upload:
-            a32 = None
-            if extractChecksumOnUpload:
-                gLogger.info('Computing adler32 checksum for %s'%srcURI)
-                a32 = backends[srcLPP.scheme or 'file'].get_adler32( srcURI )
-                gLogger.info('... %s'%a32 )
-                srcF.adler32 = a32
-                DB.session.add( srcF )
-            dstBackend = backends[dstLPP.scheme or 'file']
-            dstF = dstBackend.new_file( srcF.name
+            srcFiles.append( entry[0] )
+        if extractChecksumOnUpload:
+            gLogger.info('Computing adler32 checksums for %d files...'%nMax)
+            srcEntries = _iter_with_adler32( srcFiles, backends )
+        else:
+            srcEntries = ( (srcF, None) for srcF in srcFiles )
+        entries = {}  # job number -> (destination URI, source file entry, adler32)
+        def _jobs():
+            dstURIs = set()
+            # Transfers start while the rest of checksums are being computed
+            for nJob, (srcF, a32) in enumerate(srcEntries):
+                srcURI, dstURI = srcF.get_uri(), os.path.join(dstLoc.get_uri(), srcF.name)
+                dstLPP = urlparse(dstURI)
+                if dstURI in dstURIs:
+                    gLogger.error( 'Skipping uploading of %s to %s: the destination '
+                            'is already being uploaded.'%(srcURI, dstURI) )
+                    continue
+                dstURIs.add( dstURI )
+                if extractChecksumOnUpload:
+                    gLogger.info('adler32 checksum for %s: %s'%(srcURI, a32))
+                    srcF.adler32 = a32
+                    DB.session.add( srcF )
+                gLogger.info( 'Uploading %s (size=%d) to location %s.'%(
+                        srcURI, srcF.size, dstURI ) )
+                entries[nJob] = (dstURI, srcF, a32)
+                dstBackend = backends[dstLPP.scheme or 'file']
+                yield dstLPP.scheme or 'file', nJob, _upload, \
+                        (dstBackend, srcURI, dstURI, srcF.modified, backends)
+        for nJob, result, e in scheduler.run( _jobs() ):
+            n += 1
+            dstURI, srcF, a32 = entries.pop( nJob )
+            if e is not None:
+                gLogger.error( 'Uploading \033[1m%d/%d\033[0m to %s failed: %s'%(
+                            n, nMax, dstURI, e ) )
+                continue
+            gLogger.info( 'Uploaded \033[1m%d/%d\033[0m : %s.'%(n, nMax, dstURI) )
+            dstBackend = backends[urlparse(dstURI).scheme or 'file']
+            dstF = dstBackend.new_file( dstURI
+                                      , name=srcF.name
                                       , parent=dstLoc
                                       , size=srcF.size
                                       , adler32=a32
                                       , modified=srcF.modified )
-            gLogger.info( 'Uploading \033[1m%d/%d\033[0m : %s (size=%d) to location %s.'%(
-                    n, nMax,
-                    srcURI, srcF.size, dstURI ) )
-            dstBackend.cpy_file( srcURI, dstURI, backends=backends )
-            dstBackend.set_modified( srcURI, srcF.modified )
-            newTs = dstBackend.get_modified( dstURI )
-            newSize = dstBackend.get_size( dstURI )
-            if newTs != srcF.modified:
-                if not truncateSeconds \
-                    or not newTs.replace(second=0, microsecond=0) \
-                        == srcF.modified.replace(second=0, microsecond=0):
-                    gLogger.warning('Modified timestamp verification failed. Referential: %r, '
-                        'real: %r'%( srcF.modified, newTs ) )
+            newTs, newSize = result
+            _verify_upload( srcF.modified, srcF.size, newTs, newSize, truncateSeconds )
             srcF.modified = newTs
-            if not newSize == srcF.size:
-                gLogger.warning('Size verification failed. Referential: %d, '
-                        'real: %d'%( srcF.size, newSize ) )
             dstF.size = newSize
             dstF.modified = newTs
             DB.session.add(dstF)
-
+            if commitEvery and 0 == n%commitEvery:
+                self.commit()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Concurrent execution of file transfers with limited number of simultaneous
+transfers (in total and per destination) and retrying of failed ones.
+Results are delivered to the calling thread, so the database updates are
+performed by single writer.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from castlib3.logs import gLogger
+
+class TransferScheduler(object):
+    """
+    Runs the transfer jobs in the pool of `nTransfers' threads. Job is a
+    tuple of (destination, tag, callable, args), where `destination' is an
+    arbitrary key (e.g. URI scheme) the `perDestination' limit applies to.
+    The `perDestination' is either the integer limit common for all the
+    destinations, or dictionary of limits indexed by destination (zero or
+    absent limit means no limit except the `nTransfers').
+
+    Failed job is retried up to `retries' times, with delay growing from
+    `backoff' seconds by `backoffFactor' with each attempt (but no more
+    than `maxBackoff').
+    """
+    def __init__( self, nTransfers=1, perDestination=0, retries=0
+                , backoff=5., backoffFactor=2., maxBackoff=600. ):
+        self.nTransfers = max(1, nTransfers)
+        self.perDestination = perDestination or 0
+        self.retries = retries
+        self.backoff = backoff
+        self.backoffFactor = backoffFactor
+        self.maxBackoff = maxBackoff
+        self.nDone = self.nRetried = self.nFailed = 0
+
+    def limit(self, destination):
+        if type(self.perDestination) is dict:
+            return self.perDestination.get( destination, 0 )
+        return self.perDestination
+
+    def run(self, jobs):
+        """
+        Generator executing the jobs and yielding triplets of (tag, result,
+        exception) in order of completion. For the finally failed jobs the
+        result is None and exception is given; otherwise the exception is
+        None. Jobs are taken from the `jobs' iterable lazily, so it may be a
+        generator producing them meanwhile.
+        """
+        jobs = iter(jobs)
+        window = max(16, 2*self.nTransfers)
+        pending = []  # [readyAt, attempt, job]
+        running = {}  # future -> (attempt, job)
+        inFlight = {}  # destination -> number of running jobs
+        exhausted = False
+        with ThreadPoolExecutor( max_workers=self.nTransfers ) as pool:
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        pending.append( [0, 0, next(jobs)] )
+                    except StopIteration:
+                        exhausted = True
+                now = time.time()
+                for item in list(pending):
+                    if len(running) >= self.nTransfers:
+                        break
+                    readyAt, attempt, job = item
+                    destination, limit = job[0], self.limit(job[0])
+                    if readyAt > now or (limit and inFlight.get(destination, 0) >= limit):
+                        continue
+                    pending.remove( item )
+                    inFlight[destination] = inFlight.get(destination, 0) + 1
+                    running[pool.submit( job[2], *job[3] )] = (attempt, job)
+                if not running and not pending and exhausted:
+                    break
+                # Wait for either completion or the next postponed job:
+                delays = [ p[0] - now for p in pending if p[0] > now ]
+                timeout = min(delays) if delays else None
+                if not running:
+                    time.sleep( timeout or 0 )
+                    continue
+                done, _ = wait( running.keys(), timeout=timeout
+                              , return_when=FIRST_COMPLETED )
+                for future in done:
+                    attempt, job = running.pop( future )
+                    inFlight[job[0]] -= 1
+                    e = future.exception()
+                    if e is None:
+                        self.nDone += 1
+                        yield job[1], future.result(), None
+                    elif attempt < self.retries:
+                        delay = min( self.backoff*self.backoffFactor**attempt
+                                   , self.maxBackoff )
+                        gLogger.warning( 'Transfer %s failed (%s), retry %d/%d '
+                                'in %.1f sec.'%( job[1], e, attempt + 1
+                                               , self.retries, delay ) )
+                        self.nRetried += 1
+                        pending.append( [time.time() + delay, attempt + 1, job] )
+                    else:
+                        self.nFailed += 1
+                        yield job[1], None, e
+
+    def __str__(self):
+        return '%d done, %d retried, %d failed'%(
+                self.nDone, self.nRetried, self.nFailed )
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+
+"""
+Watching the local locations for changes with Linux inotify(7) facility.
+Changes are coalesced and represented as the directory entries
+(see castlib3.filesystem.discover_entries()) containing only the affected
+folders and files, so the stages pipeline may be evaluated for them only.
+"""
+
+import os, errno, select, struct, time, ctypes, ctypes.util
+from urlparse import urlparse
+
+from castlib3.logs import gLogger
+from castlib3.filesystem import walk, location_matcher, enclosing_uris
+from castlib3.backend import stat_payload
+
+# Event masks (see <sys/inotify.h>)
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+# Events being subscribed for. Files are considered upon they were closed
+# after writing (or moved in), so incomplete files are not indexed.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+           | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify(object):
+    """
+    Thin wrapper around the inotify(7) syscalls invoked via ctypes (there
+    is no standard module for it in Python 2).
+    """
+    def __init__(self):
+        libName = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libName, use_errno=True) if libName else None
+        if self._libc is None or not hasattr(self._libc, 'inotify_init1'):
+            raise RuntimeError( 'inotify facility is not available on this '
+                    'platform.' )
+        self.fd = self._libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+        if self.fd < 0:
+            self._raise( 'inotify_init1()' )
+
+    def _raise(self, what):
+        err = ctypes.get_errno()
+        msg = '%s failed: %s'%(what, os.strerror(err))
+        if err == errno.ENOSPC:
+            msg += ' (consider increasing fs.inotify.max_user_watches)'
+        raise OSError( err, msg )
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch( self.fd, path, ctypes.c_uint32(mask) )
+        if wd < 0:
+            self._raise( 'inotify_add_watch("%s")'%path )
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch( self.fd, wd )
+
+    def read_events(self):
+        """
+        Returns list of currently pending events as (wd, mask, cookie, name)
+        tuples. Does not block.
+        """
+        ret = []
+        while True:
+            try:
+                buf = os.read( self.fd, 65536 )
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, nameLen = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + nameLen].rstrip(b'\0')
+                offset += nameLen
+                ret.append( (wd, mask, cookie, name) )
+        return ret
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class _Location(object):
+    def __init__(self, uri, prescript):
+        self.uri = uri
+        self.root = urlparse(uri).path.rstrip('/') or '/'
+        self.matcher = location_matcher( uri, prescript )
+        self.withStats = prescript.pop('stats', False)
+        for k in ('threads', 'traversal', 'maxQueue', 'incremental'):
+            prescript.pop(k, None)
+        self.extra = prescript
+        # Changed folders: path -> set of changed file names or None, if
+        # the folder has to be listed recursively
+        self.changes = {}
+
+    def folder_uri(self, relPath):
+        return os.path.join(self.uri, relPath) if relPath else self.uri
+
+class DirectoryWatcher(object):
+    """
+    Watches the local locations for changes with inotify. Every folder of
+    location (selected by location's wildcards) is subscribed. Events
+    following each other within the `settle' seconds are coalesced (but
+    no longer than `maxDelay' seconds) and returned by poll() as the
+    directory entries suitable for index-dir stage.
+
+    The entries consist of the folders with changed files, where only
+    these files are listed. The enclosing folders are provided as well,
+    with no files listed. All these folder records have the `partial' flag
+    set. The folders created (or moved in) since the last poll are listed
+    recursively. If kernel events queue overflows, the whole location is
+    listed again.
+
+    Deletions are not tracked (as index-dir stage does not support them).
+    """
+    def __init__(self, backend, settle=1., maxDelay=30.):
+        self.backend = backend
+        self.settle = settle
+        self.maxDelay = maxDelay
+        self.inotify = Inotify()
+        self._locations = []
+        self._wds = {}  # wd -> (location, folder path)
+
+    def add_location(self, prescript):
+        """
+        Subscribes the location given by the prescript dictionary of the
+        same form as discover_entries() accepts.
+        """
+        prescript = dict(prescript)
+        uri = prescript.pop('localPath')
+        if urlparse(uri).scheme not in ('', 'file'):
+            raise NotImplementedError( 'Only local locations may be watched, '
+                    'got "%s".'%uri )
+        loc = _Location( uri, prescript )
+        self._locations.append( loc )
+        n = self._watch_tree( loc, loc.root )
+        gLogger.info( 'Watching %d folders of location %s.'%(n, uri) )
+
+    def _watch_tree(self, loc, dirPath):
+        """
+        Subscribes folder and its sub-folders. Returns number of folders
+        subscribed.
+        """
+        def _expand( path ):
+            try:
+                wd = self.inotify.add_watch( path )
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    # Deleted meanwhile
+                    return None, []
+                raise
+            self._wds[wd] = (loc, path)
+            _, subFolders = self.backend.get_folder_content( path, matcher=loc.matcher )
+            return None, subFolders
+        return sum( 1 for _ in walk([dirPath], _expand) )
+
+    def _unwatch_tree(self, dirPath):
+        for wd, (loc, path) in self._wds.items():
+            if path == dirPath or path.startswith(dirPath + '/'):
+                del self._wds[wd]
+                self.inotify.rm_watch( wd )
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            gLogger.warning( 'Inotify events queue overflow. Locations will be '
+                    'relisted.' )
+            for loc in self._locations:
+                self._watch_tree( loc, loc.root )
+                loc.changes = { loc.root : None }
+            return
+        if mask & IN_IGNORED:
+            self._wds.pop( wd, None )
+            return
+        if wd not in self._wds or not name:
+            return
+        loc, dirPath = self._wds[wd]
+        if mask & IN_ISDIR:
+            if not loc.matcher.select( dirPath, [], [name] )[1]:
+                return
+            path = os.path.join(dirPath, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree( loc, path )
+                loc.changes[path] = None
+            elif mask & IN_MOVED_FROM:
+                self._unwatch_tree( path )
+        elif not mask & (IN_CREATE | IN_MOVED_FROM):
+            if loc.matcher.select( dirPath, [name], [] )[0]:
+                changed = loc.changes.setdefault( dirPath, set() )
+                if changed is not None:
+                    changed.add( name )
+
+    def _wait(self, timeout):
+        try:
+            return bool( select.select([self.inotify], [], [], timeout)[0] )
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+
+    def poll(self, timeout=None):
+        """
+        Blocks until changes will be observed (or `timeout' seconds will
+        pass). Returns list of directory entries, one per changed location.
+        """
+        if not self._wait(timeout):
+            return []
+        started = time.time()
+        while True:
+            for wd, mask, cookie, name in self.inotify.read_events():
+                self._handle_event( wd, mask, name )
+            left = self.maxDelay - (time.time() - started)
+            if left <= 0 or not self._wait( min(self.settle, left) ):
+                break
+        ret = []
+        for loc in self._locations:
+            if loc.changes:
+                ret.append( self._changes_entry(loc) )
+                loc.changes = {}
+        return ret
+
+    def _changes_entry(self, loc):
+        """
+        Builds directory entry of location's changes.
+        """
+        root = { 'folder' : loc.uri, 'files' : set(), 'subFolders' : []
+               , 'partial' : True }
+        nodes = { '' : root }
+        nFiles = 0
+        def _node( relPath ):
+            if relPath in nodes:
+                return nodes[relPath]
+            parent = _node( os.path.dirname(relPath) )
+            node = { 'folder' : loc.folder_uri(relPath)
+                   , 'files' : set(), 'subFolders' : [], 'partial' : True }
+            parent['subFolders'].append( node )
+            nodes[relPath] = node
+            return node
+        listed = []  # relative paths of folders listed recursively
+        for dirPath in sorted( loc.changes.keys() ):
+            relPath = loc.matcher.relative_dir( dirPath )
+            if any( relPath == l or relPath.startswith(l + '/') or not l \
+                    for l in listed ):
+                continue
+            names = loc.changes[dirPath]
+            if names is None:
+                if not os.path.isdir(dirPath):
+                    continue
+                listed.append( relPath )
+                entry = self.backend.get_dir_content( loc.folder_uri(relPath)
+                                                    , matcher=loc.matcher
+                                                    , withStats=loc.withStats )
+                if relPath:
+                    _node( os.path.dirname(relPath) )['subFolders'].append( entry )
+                    nodes[relPath] = entry
+                else:
+                    root.update( entry )
+                    root.pop( 'partial' )
+                continue
+            node = _node( relPath )
+            for name in names:
+                path = os.path.join(dirPath, name)
+                try:
+                    st = os.stat( path )
+                except OSError:
+                    continue  # deleted meanwhile
+                node['files'].add( name )
+                nFiles += 1
+                if loc.withStats:
+                    node.setdefault( 'fileStats', {} )[name] = stat_payload(st)
+        gLogger.info( 'Changes in %s: %d file(s), %d folder(s) to be listed.'%(
+                        loc.uri, nFiles, len(listed) ) )
+        root.update( loc.extra )
+        for uri in reversed( enclosing_uris(loc.uri) ):
+            root = { 'folder' : uri, 'files' : [], 'subFolders' : [root]
+                   , 'partial' : True }
+        return root
+
+    def close(self):
+        self.inotify.close()
@@ -1,3 +1,11 @@
 __all__ = [
         'test_models'
+      , 'test_backend'
+      , 'test_index'
+      , 'test_filesystem'
+      , 'test_checksum'
+      , 'test_castor'
+      , 'test_transfers'
+      , 'test_shell'
+      , 'test_sync'
     ]
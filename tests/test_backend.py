@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, tempfile, shutil, os, datetime, filecmp
+from concurrent.futures import ThreadPoolExecutor
+
+import castlib3.backend, castlib3.copying
+from castlib3.backend import LocalBackend, AbstractBackend, gCastlibBackends
+
+class TestLocalBackendListing(unittest.TestCase):
+    def setUp(self):
+        """
+        Creates the following struct in temporary dir:
+            root
+             |~ run-1
+             |  |- chunk-1.dat
+             |  `- chunk-2.dat
+             |~ run-2
+             |  `- chunk-1.dat
+             |- one.dat
+             `- two.txt
+        """
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'run-1'))
+        os.mkdir(os.path.join(self.root, 'run-2'))
+        for n, p in enumerate([ 'run-1/chunk-1.dat', 'run-1/chunk-2.dat'
+                              , 'run-2/chunk-1.dat', 'one.dat', 'two.txt' ]):
+            with open(os.path.join(self.root, p), 'wb') as f:
+                f.write( b'x'*(n + 1) )
+        self.backend = gCastlibBackends['file']()
+
+    def test_scan_dir(self):
+        files, subds, stats = self.backend.scan_dir( 'file://' + self.root
+                                                   , withStats=True )
+        self.assertEqual( files, ['one.dat', 'two.txt'] )
+        self.assertEqual( subds, ['run-1', 'run-2'] )
+        self.assertEqual( stats['one.dat']['size'], 4 )
+        self.assertEqual( stats['two.txt']['modified'],
+                self.backend.get_modified('file://' + self.root + '/two.txt') )
+
+    def test_scan_dir_vanished(self):
+        class _Entry(object):
+            def __init__(self, dirPath, name, vanished=False):
+                self.name = name
+                self.path = os.path.join(dirPath, name)
+                self.vanished = vanished
+            def is_file(self):
+                return self.vanished or os.path.isfile(self.path)
+            def is_dir(self):
+                return not self.vanished and os.path.isdir(self.path)
+            def stat(self):
+                if self.vanished:
+                    raise OSError( 2, 'No such file or directory' )
+                return os.stat(self.path)
+        scandir = castlib3.backend.scandir
+        castlib3.backend.scandir = lambda p: [ _Entry(p, 'gone.dat', vanished=True) ] \
+                                           + [ _Entry(p, n) for n in os.listdir(p) ]
+        try:
+            files, subds, stats = self.backend.scan_dir( 'file://' + self.root
+                                                       , withStats=True )
+        finally:
+            castlib3.backend.scandir = scandir
+        self.assertEqual( files, ['one.dat', 'two.txt'] )
+        self.assertTrue( set(files + subds) <= set(stats.keys()) )
+
+    def test_dir_content(self):
+        c = self.backend.get_dir_content( self.root
+                                        , ignorePats=['*.txt']
+                                        , withStats=True )
+        self.assertEqual( c['files'], set(['one.dat']) )
+        self.assertEqual( c['fileStats'].keys(), ['one.dat'] )
+        self.assertEqual( [sf['folder'] for sf in c['subFolders']],
+                [os.path.join(self.root, 'run-1'), os.path.join(self.root, 'run-2')] )
+        self.assertEqual( c['subFolders'][0]['files'],
+                set(['chunk-1.dat', 'chunk-2.dat']) )
+        self.assertEqual( c['subFolders'][0]['fileStats']['chunk-2.dat']['size'], 2 )
+
+    def test_dir_content_traversal(self):
+        seq = self.backend.get_dir_content( self.root, withStats=True )
+        for kwargs in ( {'nThreads' : 2}, {'nThreads' : 4, 'order' : 'bfs'}
+                      , {'order' : 'bfs', 'maxQueue' : 1} ):
+            self.assertEqual( seq, self.backend.get_dir_content( self.root
+                                                    , withStats=True
+                                                    , **kwargs ) )
+
+    def test_iter_dir_content(self):
+        nested = self.backend.get_dir_content( self.root, withStats=True
+                                             , extra={'x' : 1} )
+        lazy = list(self.backend.iter_dir_content( self.root, withStats=True
+                                                 , extra={'x' : 1} ))
+        self.assertEqual( [r['folder'] for r in lazy],
+                [ self.root
+                , os.path.join(self.root, 'run-1')
+                , os.path.join(self.root, 'run-2') ] )
+        self.assertEqual( [r['parent'] for r in lazy],
+                [None, self.root, self.root] )
+        self.assertEqual( lazy[0]['x'], 1 )
+        self.assertNotIn( 'x', lazy[1] )
+        for r, n in zip(lazy, [nested] + nested['subFolders']):
+            self.assertEqual( r['files'], n['files'] )
+            self.assertEqual( r['fileStats'], n['fileStats'] )
+
+    def test_new_file_from_stats(self):
+        c = self.backend.get_dir_content( self.root, withStats=True )
+        # Must not touch the filesystem for fields present in stats:
+        f = self.backend.new_file( '/nonexisting/one.dat'
+                                 , name='one.dat'
+                                 , syncFields=['size', 'modified']
+                                 , _stat=c['fileStats']['one.dat'] )
+        self.assertEqual( f.size, 4 )
+
+    def test_file_operations(self):
+        src = os.path.join(self.root, 'one.dat')
+        with open(src, 'wb') as f:
+            f.write( os.urandom(3*1024*1024 + 5) )
+        for method in ('reflink', 'copy_file_range', 'sendfile', 'readwrite'):
+            backend = gCastlibBackends['file']( copyMethods=[method, 'readwrite'] )
+            dst = os.path.join(self.root, 'copies', method + '.dat')
+            backend.cpy_file( 'file://' + src, 'file://' + dst )
+            self.assertTrue( filecmp.cmp(src, dst, shallow=False) )
+        # Concurrent copies:
+        dsts = [ 'file://' + os.path.join(self.root, 'par', '%d.dat'%n) for n in range(8) ]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map( lambda d: self.backend.cpy_file('file://' + src, d), dsts ))
+        self.assertEqual( sorted(os.listdir(os.path.join(self.root, 'par'))),
+                          sorted(os.path.basename(d) for d in dsts) )
+        mt = datetime.datetime(2017, 3, 4, 5, 6, 7, 890000)
+        self.backend.set_modified( dsts[0], mt )
+        self.assertEqual( self.backend.get_modified(dsts[0]), mt )
+        self.backend.del_file( dsts[0] )
+        self.assertFalse( os.path.exists(dsts[0][7:]) )
+
+    def test_copy_zero_progress(self):
+        src = os.path.join(self.root, 'one.dat')
+        with open(src, 'wb') as f:
+            f.write( os.urandom(1024*1024 + 5) )
+        # Syscalls returning 0 prematurely must not leave the copy truncated:
+        zero = lambda *args: 0
+        orig = ( castlib3.copying._libc_copy_file_range
+               , castlib3.copying._libc_sendfile )
+        castlib3.copying._libc_copy_file_range = zero
+        castlib3.copying._libc_sendfile = zero
+        try:
+            for method in ('copy_file_range', 'sendfile'):
+                dst = os.path.join(self.root, method + '.dat')
+                self.assertEqual( castlib3.copying.copy_file( src, dst
+                                                    , methods=[method, 'readwrite'] )
+                                , 'readwrite' )
+                self.assertTrue( filecmp.cmp(src, dst, shallow=False) )
+        finally:
+            castlib3.copying._libc_copy_file_range, \
+                castlib3.copying._libc_sendfile = orig
+        self.assertFalse( castlib3.copying._unsupported & set(['copy_file_range', 'sendfile']) )
+
+    def test_rewrite_appended(self):
+        src, dst = [ os.path.join(self.root, n) for n in ('src.dat', 'dst.dat') ]
+        data = os.urandom(100000)
+        # Appended original and modified one:
+        for dstData, rewritten in ( (data[:70000], False)
+                                  , (b'y' + data[1:70000], True) ):
+            with open(src, 'wb') as f:
+                f.write(data)
+            with open(dst, 'wb') as f:
+                f.write(dstData)
+            deleted = []
+            backend = gCastlibBackends['file']()
+            backend.del_file = lambda p: deleted.append(p) or os.unlink(p[7:])
+            backend.rewrite_file( 'file://' + src, 'file://' + dst
+                                , backends={'file' : backend} )
+            self.assertTrue( filecmp.cmp(src, dst, shallow=False) )
+            self.assertEqual( bool(deleted), rewritten )
+
+    def test_rewrite_no_append(self):
+        src, dst = [ os.path.join(self.root, n) for n in ('src.dat', 'dst.dat') ]
+        for p, data in ((src, b'abcdef'), (dst, b'abc')):
+            with open(p, 'wb') as f:
+                f.write(data)
+        backend = gCastlibBackends['file']()
+        # Backend unable to append must not query the sizes:
+        backend.append_file = AbstractBackend.append_file.__get__(backend)
+        sized = []
+        backend.get_size = lambda p: sized.append(p)
+        backend.rewrite_file( 'file://' + src, 'file://' + dst
+                            , backends={'file' : backend} )
+        self.assertEqual( sized, [] )
+        self.assertTrue( filecmp.cmp(src, dst, shallow=False) )
+
+    def test_rewrite_delta(self):
+        src, dst = [ os.path.join(self.root, n) for n in ('src.dat', 'dst.dat') ]
+        data = os.urandom(10*4096 + 100)
+        backend = gCastlibBackends['file']( deltaBlockSize=4096 )
+        for dstData, saved in ( (b'hdr' + data[3:], 9*4096 + 100)
+                              , (data[:5000] + b'x'*7000 + data[12000:-50], 8*4096)
+                              , (data + b'tail', 10*4096 + 100) ):
+            with open(src, 'wb') as f:
+                f.write(data)
+            with open(dst, 'wb') as f:
+                f.write(dstData)
+            self.assertEqual( backend.rewrite_file( 'file://' + src, 'file://' + dst
+                                                  , backends={'file' : backend} )[1]
+                            , saved )
+            self.assertTrue( filecmp.cmp(src, dst, shallow=False) )
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+if __name__ == "__main__":
+    unittest.main()
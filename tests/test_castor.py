@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, datetime, os
+
+import castlib3.castor.backend
+from castlib3.syscfg import gConfig
+from castlib3.castor.backend import CASTORBackend, ListingCache, entry_name
+from castlib3.castor.parsing import iter_nsls_recursive, rxNSLS, nsls_timestamp
+
+# Sample output of `nsls -lR --class --checksum'
+gSampleListing = """\
+/castor/cern.ch/na64/data:
+     2 drwxrwxr-x   3 na64cdr  vy                          0 Jun 02  2017 cdr
+     2 mrw-r--r--   1 na64cdr  vy                       1024 Jun 02  2017 AD 0a1b2c3d info.txt
+     2 lrwxrwxrwx   1 na64cdr  vy                          0 Jun 02  2017 latest -> cdr
+     2 drwxrwxr-x   0 na64cdr  vy                          0 Jun 02  2017 tmp
+
+/castor/cern.ch/na64/data/cdr:
+     2 mrw-r--r--   1 na64cdr  vy                 1073741824 Jun 02 12:31 AD 12ab34cd cdr01001-000001.dat
+     2 mrw-r--r--   1 na64cdr  vy                 1073741824 Jun 02 12:45 AD 9f8e7d6c cdr01001-000002.dat
+     2 Drw-r--r--   1 na64cdr  vy                 1073741824 Jun 01 10:00 cdr01000-000001.dat
+     2 drwxrwxr-x   1 na64cdr  vy                          0 Jun 02  2017 old
+
+/castor/cern.ch/na64/data/cdr/old:
+     2 -rw-r--r--   1 na64cdr  vy                        512 Jan 15  2017 cdr00001-000001.dat
+
+/castor/cern.ch/na64/data/tmp:
+"""
+
+class TestCASTORRecursiveListing(unittest.TestCase):
+    root = '/castor/cern.ch/na64/data'
+
+    def setUp(self):
+        """
+        Substitutes invoke_util() with function emulating `nsls' and
+        `nsls-recursive' utils on the sample listing.
+        """
+        self.calls = []
+        self.config = dict(gConfig)
+        gConfig['utils'] = { 'nsls-recursive' : 'nsls -lR --class --checksum {remotePath}' }
+        blocks = {}
+        for block in gSampleListing.split('\n\n'):
+            header, _, content = block.partition(':\n')
+            blocks[header] = content
+        def _invoke_util( name, **kwargs ):
+            self.calls.append( name )
+            if 'nsls' == name:
+                return [ m.groupdict() for m in rxNSLS.finditer(
+                                    blocks.get(kwargs['remotePath'], '') ) ]
+            if 'nsls-dir' == name:
+                dirPath, entryName = os.path.split( kwargs['dirPath'] )
+                return [ m.groupdict() for m in rxNSLS.finditer( blocks.get(dirPath, '') )
+                         if entry_name(m.groupdict()) == entryName ]
+            if 'nsls-recursive' == name:
+                return 0, gSampleListing, ''
+            if 'rfstat' == name:
+                return 0, 'Last modify          : Fri Jun  2 10:20:30 2017\n', ''
+            return 0, '', ''
+        def _iter_invoke_util( calls, nConcurrent=8 ):
+            for n, (name, kwargs) in enumerate(calls):
+                yield n, _invoke_util( name, **kwargs )
+        def _iter_util_lines( name, **kwargs ):
+            if 'nsls-recursive' == name:
+                self.calls.append( name )
+                return iter( gSampleListing.splitlines() )
+            return iter( _invoke_util( name, **kwargs ) )
+        self._utils = dict( (k, getattr(castlib3.castor.backend, k)) for k in
+                    ('invoke_util', 'iter_invoke_util', 'iter_util_lines') )
+        castlib3.castor.backend.invoke_util = _invoke_util
+        castlib3.castor.backend.iter_invoke_util = _iter_invoke_util
+        castlib3.castor.backend.iter_util_lines = _iter_util_lines
+
+    def test_parsing(self):
+        blocks = list(iter_nsls_recursive( gSampleListing.splitlines(), self.root ))
+        self.assertEqual( [d for d, _ in blocks],
+                [ self.root, self.root + '/cdr', self.root + '/cdr/old'
+                , self.root + '/tmp' ] )
+        self.assertEqual( [e['filename'] for e in blocks[0][1]],
+                ['cdr', 'info.txt', 'latest -> cdr', 'tmp'] )
+        self.assertEqual( blocks[1][1][0]['adler32'], '12ab34cd' )
+        self.assertEqual( blocks[3][1], [] )
+        # Output without the header of listed folder:
+        blocks = list(iter_nsls_recursive( gSampleListing.splitlines()[1:], self.root ))
+        self.assertEqual( blocks[0][0], self.root )
+        self.assertEqual( len(blocks), 4 )
+
+    def test_dir_content(self):
+        backend = CASTORBackend( recursiveListing=True )
+        uri = backend.uri_from_path( self.root )
+        c = backend.get_dir_content( uri, ignorePats=['tmp'], extra={'x' : 1} )
+        self.assertEqual( self.calls, ['nsls-recursive'] )
+        self.assertEqual( c['files'], ['info.txt'] )
+        self.assertEqual( c['x'], 1 )
+        self.assertEqual( [sf['folder'] for sf in c['subFolders']],
+                [ uri + '/cdr' ] )
+        cdr = c['subFolders'][0]
+        self.assertEqual( cdr['files'],
+                ['cdr01001-000001.dat', 'cdr01001-000002.dat'] )
+        self.assertEqual( cdr['subFolders'][0]['files'], ['cdr00001-000001.dat'] )
+        # Flat records:
+        self.assertEqual( [ (r['folder'], r['parent']) for r in
+                            backend.iter_dir_content( uri, ignorePats=['old'] ) ],
+                [ (uri, None), (uri + '/cdr', uri), (uri + '/tmp', uri) ] )
+
+    def test_timestamps(self):
+        e = rxNSLS.match( '     2 mrw-r--r--   1 na64cdr  vy  1024 2017-06-02 12:31:05'
+                          ' AD 0a1b2c3d info.txt' ).groupdict()
+        self.assertEqual( (e['filename'], e['adler32']), ('info.txt', '0a1b2c3d') )
+        self.assertEqual( nsls_timestamp(e),
+                (datetime.datetime(2017, 6, 2, 12, 31, 5), 'second') )
+        e = rxNSLS.match( gSampleListing.splitlines()[7] ).groupdict()
+        self.assertEqual( nsls_timestamp(e, now=datetime.datetime(2017, 7, 1)),
+                (datetime.datetime(2017, 6, 2, 12, 31), 'minute') )
+        self.assertEqual( nsls_timestamp(e, now=datetime.datetime(2018, 1, 1))[0],
+                datetime.datetime(2017, 6, 2, 12, 31) )
+        self.assertEqual( nsls_timestamp(e, now=datetime.datetime(2017, 6, 2, 13))[0],
+                datetime.datetime(2017, 6, 2, 12, 31) )
+        e = rxNSLS.match( gSampleListing.splitlines()[2] ).groupdict()
+        self.assertEqual( nsls_timestamp(e),
+                (datetime.datetime(2017, 6, 2), 'day') )
+
+    def test_file_stats(self):
+        # Imprecise listing times are not used by default:
+        backend = CASTORBackend( recursiveListing=True )
+        c = backend.get_dir_content( backend.uri_from_path(self.root), withStats=True )
+        self.assertNotIn( 'modified', c['subFolders'][0]['fileStats']['cdr01001-000001.dat'] )
+        self.calls = []
+        backend = CASTORBackend( recursiveListing=True, mtimePrecision='minute' )
+        c = backend.get_dir_content( backend.uri_from_path(self.root), withStats=True )
+        self.assertEqual( c['fileStats']['info.txt'],
+                {'size' : 1024, 'adler32' : '0a1b2c3d'} )
+        st = c['subFolders'][0]['fileStats']['cdr01001-000001.dat']
+        self.assertEqual( (st['size'], st['adler32']), (1073741824, '12ab34cd') )
+        self.assertEqual( (st['modified'].month, st['modified'].minute), (6, 31) )
+        # Nothing but the listing is needed for the file entry:
+        f = backend.new_file( c['subFolders'][0]['folder'] + '/cdr01001-000001.dat'
+                            , syncFields=['size', 'modified', 'adler32']
+                            , _stat=st )
+        self.assertEqual( f.adler32, '12ab34cd' )
+        self.assertEqual( self.calls, ['nsls-recursive'] )
+        # Imprecise timestamp has to be obtained with rfstat:
+        self.assertEqual( backend.get_modified( c['folder'] + '/info.txt' ),
+                datetime.datetime(2017, 6, 2, 10, 20, 30) )
+        self.assertEqual( self.calls, ['nsls-recursive', 'rfstat'] )
+        backend = CASTORBackend( mtimePrecision='day' )
+        self.assertEqual( backend.get_modified( c['folder'] + '/info.txt' ),
+                datetime.datetime(2017, 6, 2) )
+        self.assertEqual( self.calls[-1], 'nsls-dir' )
+
+    def test_listing_cache(self):
+        backend = CASTORBackend()
+        uri = backend.uri_from_path( self.root + '/cdr' )
+        # Entries of not listed directory are queried one by one:
+        self.assertEqual( backend.get_size( uri + '/cdr01001-000001.dat' ), 1073741824 )
+        self.assertFalse( backend.isfile( uri + '/nonexisting.dat' ) )
+        self.assertEqual( self.calls, ['nsls-dir', 'nsls-dir'] )
+        backend.get_folder_content( uri )
+        backend.get_folder_content( backend.uri_from_path(self.root) )
+        self.assertEqual( backend.get_adler32( uri + '/cdr01001-000002.dat' ), '9f8e7d6c' )
+        self.assertTrue( backend.isfile( uri + '/cdr01001-000002.dat' ) )
+        self.assertTrue( backend.isdir( uri + '/old' ) )
+        self.assertFalse( backend.isfile( uri + '/old' ) )
+        self.assertFalse( backend.isfile( uri + '/nonexisting.dat' ) )
+        self.assertTrue( backend.islink( backend.uri_from_path(self.root + '/latest') ) )
+        self.assertEqual( self.calls, ['nsls-dir', 'nsls-dir', 'nsls', 'nsls'] )
+        self.assertEqual( (backend.listingCache.hits, backend.listingCache.misses), (6, 4) )
+        # Modification of directory content drops its listing, the entries
+        # are queried individually then:
+        backend.del_file( uri + '/cdr01001-000001.dat' )
+        backend.get_size( uri + '/cdr01001-000002.dat' )
+        self.assertEqual( self.calls[-2:], ['nsrmFile', 'nsls-dir'] )
+        self.assertEqual( backend.listingCache.invalidated, 1 )
+        backend.get_folder_content( uri )
+        self.assertEqual( self.calls[-1], 'nsls' )
+        # Recursive listing fills the cache:
+        backend = CASTORBackend( recursiveListing=True )
+        backend.get_dir_content( backend.uri_from_path(self.root) )
+        backend.get_size( uri + '/old/cdr00001-000001.dat' )
+        self.assertEqual( self.calls[-1], 'nsls-recursive' )
+        # Disabled cache:
+        backend = CASTORBackend( listingTTL=0 )
+        backend.get_folder_content( uri )
+        backend.get_size( uri + '/cdr01001-000001.dat' )
+        self.assertEqual( self.calls[-2:], ['nsls', 'nsls-dir'] )
+
+    def test_incremental(self):
+        backend = CASTORBackend()
+        seen = {}
+        def _unchanged( dirPath, modified ):
+            seen[dirPath] = modified
+            return None
+        backend.get_dir_content( backend.uri_from_path(self.root), unchanged=_unchanged )
+        # Folder times are taken from the listings of parents; only the root
+        # one, whose parent listing is not available, needs rfstat:
+        self.assertEqual( seen[backend.uri_from_path(self.root + '/cdr/old')],
+                          datetime.datetime(2017, 6, 2) )
+        self.assertEqual( len(seen), 4 )
+        self.assertEqual( self.calls.count('rfstat'), 1 )
+        self.assertEqual( self.calls.count('nsls'), 4 + 1 )
+
+    def test_stale_listing(self):
+        cache = ListingCache()
+        generation = cache.generation()
+        # Directory is modified while it is being listed:
+        cache.invalidate( '/a' )
+        cache.put( '/a', {'x' : {}}, generation )
+        cache.put( '/b', {'y' : {}}, generation )
+        self.assertIsNone( cache.get('/a') )
+        self.assertEqual( cache.get('/b'), {'y' : {}} )
+        cache.put( '/a', {'x' : {}}, cache.generation() )
+        self.assertEqual( cache.get('/a'), {'x' : {}} )
+
+    def test_batched_checksums(self):
+        backend = CASTORBackend()
+        uri = backend.uri_from_path( self.root )
+        backend.get_folder_content( uri )
+        paths = [ uri + '/cdr/cdr01001-000002.dat', uri + '/info.txt'
+                , uri + '/cdr/cdr01001-000001.dat' ]
+        self.assertEqual( sorted(backend.get_adler32_many( paths )),
+                sorted(zip(paths, ['9f8e7d6c', '0a1b2c3d', '12ab34cd'])) )
+        self.assertEqual( self.calls, ['nsls', 'nsls'] )
+        self.assertEqual( backend.listingCache.hits, 1 )
+
+    def test_listdir(self):
+        backend = CASTORBackend()
+        uri = backend.uri_from_path( self.root )
+        self.assertEqual( backend.listdir( uri ), ['cdr', 'info.txt', 'latest', 'tmp'] )
+        # Streamed listing is not cached:
+        self.assertEqual( backend.listingCache.misses, 1 )
+        backend.get_folder_content( uri )
+        self.assertEqual( backend.listdir( uri ), ['cdr', 'info.txt', 'latest', 'tmp'] )
+        self.assertEqual( self.calls, ['nsls', 'nsls'] )
+
+    def test_recursive_util_required(self):
+        del gConfig['utils']['nsls-recursive']
+        with self.assertRaises( RuntimeError ):
+            CASTORBackend( recursiveListing=True )
+        CASTORBackend()
+
+    def tearDown(self):
+        for k, v in self._utils.items():
+            setattr( castlib3.castor.backend, k, v )
+        gConfig.clear()
+        gConfig.update( self.config )
+
+if __name__ == "__main__":
+    unittest.main()
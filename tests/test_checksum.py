@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, tempfile, shutil, os, random, zlib
+
+from castlib3.checksum import adler32, adler32_range, adler32_combine, \
+                              read_blocks, ChecksumService, ChecksumCache
+from castlib3.backend import gCastlibBackends
+
+class TestChecksumService(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        rnd = random.Random(42)
+        self.paths = []
+        for n in range(12):
+            p = os.path.join(self.root, 'f%02d.dat'%n)
+            with open(p, 'wb') as f:
+                f.write( bytearray(rnd.getrandbits(8) for _ in range(rnd.randint(0, 200000))) )
+            self.paths.append(p)
+        self.expected = dict( (p, adler32(p)) for p in self.paths )
+
+    def test_pools(self):
+        for processes in (True, False):
+            s = ChecksumService( nWorkers=3, ioLimit=2, processes=processes )
+            self.assertEqual( dict(s.imap_unordered(self.paths)), self.expected )
+            s.shutdown()
+
+    def test_backend_bulk(self):
+        backend = gCastlibBackends['file']( checksumWorkers=2 )
+        uris = [ 'file://' + p for p in self.paths ]
+        self.assertEqual( dict(backend.get_adler32_many(uris)),
+                          dict( (u, backend.get_adler32(u)) for u in uris ) )
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+class TestChecksumCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.root, 'cache.sqlite')
+        self.paths = []
+        for n in range(3):
+            p = os.path.join(self.root, 'f%d.dat'%n)
+            with open(p, 'wb') as f:
+                f.write( b'x'*(n*1000 + 1) )
+            self.paths.append(p)
+
+    def test_backend_cache(self):
+        for workers in (0, 2):
+            backend = gCastlibBackends['file']( checksumWorkers=workers
+                                              , checksumCache=self.cachePath )
+            uris = [ 'file://' + p for p in self.paths ]
+            first = dict(backend.get_adler32_many(uris))
+            self.assertEqual( dict(backend.get_adler32_many(uris)), first )
+            self.assertEqual( (backend.checksumCache.hits, backend.checksumCache.misses)
+                            , (3, 3) )
+            # modified file has to be recomputed
+            with open(self.paths[0], 'ab') as f:
+                f.write(b'y')
+            os.utime( self.paths[0], (1, 1) )
+            self.assertEqual( backend.get_adler32(uris[0]),
+                              '%x'%adler32(self.paths[0]) )
+            backend.checksumCache.close()
+            os.unlink(self.cachePath)
+
+    def test_evict(self):
+        cache = ChecksumCache( self.cachePath )
+        for p in self.paths:
+            cache.put( p, '%x'%adler32(p) )
+        os.unlink( self.paths[1] )
+        self.assertEqual( cache.evict(), 1 )
+        self.assertEqual( cache.get(self.paths[0]), '%x'%adler32(self.paths[0]) )
+        self.assertEqual( (cache.hits, cache.misses), (1, 0) )
+        cache.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+class TestAdler32Combine(unittest.TestCase):
+    def test_combine(self):
+        rnd = random.Random(1)
+        for _ in range(200):
+            a = bytes(bytearray(rnd.getrandbits(8) for _ in range(rnd.randint(0, 3000))))
+            b = bytes(bytearray(rnd.getrandbits(8) for _ in range(rnd.randint(0, 3000))))
+            self.assertEqual( adler32_combine( zlib.adler32(a) & 0xffffffff
+                                             , zlib.adler32(b) & 0xffffffff
+                                             , len(b) ),
+                              zlib.adler32(a + b) & 0xffffffff )
+
+    def test_split_files(self):
+        root = tempfile.mkdtemp()
+        try:
+            rnd = random.Random(2)
+            paths = []
+            for n, size in enumerate([0, 1, 4095, 4096, 4097, 65536*3 + 17, 300000]):
+                p = os.path.join(root, 'f%d.dat'%n)
+                with open(p, 'wb') as f:
+                    f.write( bytearray(rnd.getrandbits(8) for _ in range(size)) )
+                paths.append(p)
+            expected = dict( (p, adler32(p)) for p in paths )
+            for splitSize, processes in ((4096, False), (65536, True), (1000, False)):
+                s = ChecksumService( nWorkers=4, processes=processes
+                                   , splitSize=splitSize )
+                self.assertEqual( dict(s.imap_unordered(paths)), expected )
+                for p in paths:
+                    self.assertEqual( s.adler32(p), expected[p] )
+                s.shutdown()
+            # Repeated paths are yielded as many times as given:
+            s = ChecksumService( nWorkers=2, ioLimit=64, processes=False
+                               , splitSize=4096 )
+            self.assertEqual( sorted(s.imap_unordered(paths[-1:]*2 + paths[-2:])),
+                              sorted([ (p, expected[p]) for p in paths[-1:]*2 + paths[-2:] ]) )
+            s.shutdown()
+        finally:
+            shutil.rmtree(root)
+
+class TestBlockReader(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(3)
+        self.data = bytes(bytearray(rnd.getrandbits(8) for _ in range(100000)))
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def test_read_blocks(self):
+        for useMmap in (False, True):
+            for offset, length, blocksize in ( (0, None, 4096), (5, 70001, 1000)
+                                             , (99999, None, 10), (100000, None, 7)
+                                             , (4097, 0, 64) ):
+                kwargs = { 'blocksize' : blocksize, 'useMmap' : useMmap
+                         , 'dropCache' : True }
+                blocks = [ bytes(b) for b in read_blocks(self.path, offset,
+                                                         length, **kwargs) ]
+                end = None if length is None else offset + length
+                self.assertTrue( all(len(b) <= blocksize for b in blocks) )
+                self.assertEqual( b''.join(blocks), self.data[offset:end] )
+                self.assertEqual( adler32_range(self.path, offset, length, **kwargs),
+                        zlib.adler32(self.data[offset:end]) & 0xffffffff )
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+if __name__ == "__main__":
+    unittest.main()
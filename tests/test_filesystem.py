@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest
+
+from castlib3.filesystem import walk, PathMatcher
+
+def _expand_tree( node ):
+    """
+    Expands the node of complete binary tree of depth 3 given by its path
+    string.
+    """
+    return node, ([node + '0', node + '1'] if len(node) < 3 else [])
+
+class TestWalk(unittest.TestCase):
+    def test_orders(self):
+        dfs = [ n for n, r in walk(['r'], _expand_tree, order='dfs') ]
+        self.assertEqual( dfs, ['r', 'r0', 'r00', 'r01', 'r1', 'r10', 'r11'] )
+        bfs = [ n for n, r in walk(['r'], _expand_tree, order='bfs') ]
+        self.assertEqual( bfs, ['r', 'r0', 'r1', 'r00', 'r01', 'r10', 'r11'] )
+        for nThreads in (2, 3):
+            self.assertEqual( bfs, [ n for n, r in walk( ['r'], _expand_tree
+                                                       , order='bfs'
+                                                       , nThreads=nThreads ) ] )
+
+    def test_bounded_queue(self):
+        def _expand( node ):
+            return None, [node + str(i) for i in range(4)] if len(node) < 4 else []
+        nodes = [ n for n, r in walk(['r'], _expand, order='bfs', maxQueue=8) ]
+        self.assertEqual( len(nodes), 1 + 4 + 16 + 64 )
+        self.assertEqual( len(set(nodes)), len(nodes) )
+        # Queue limit is reached after expanding `r1', so traversal goes deep
+        # (keeping the siblings order):
+        self.assertEqual( nodes[:7], ['r', 'r0', 'r1', 'r2', 'r20', 'r200', 'r201'] )
+        for nThreads in (2, 3):
+            self.assertEqual( nodes, [ n for n, r in walk( ['r'], _expand
+                                                         , order='bfs', maxQueue=8
+                                                         , nThreads=nThreads ) ] )
+
+    def test_threads_ahead(self):
+        import threading
+        lock = threading.Lock()
+        expanded = set()
+        def _expand( node ):
+            with lock:
+                expanded.add( node )
+            return None, [node + str(i) for i in range(8)] if len(node) < 3 else []
+        nodes = walk( ['r'], _expand, order='bfs', nThreads=2 )
+        for _ in range(3):
+            next(nodes)
+        # Nodes taken (3) and at most 2 ahead of them are expanded:
+        self.assertLessEqual( len(expanded), 5 )
+        nodes.close()
+        self.assertEqual( [ n for n, r in walk(['r'], _expand_tree, order='dfs', nThreads=2) ],
+                          ['r', 'r0', 'r00', 'r01', 'r1', 'r10', 'r11'] )
+
+    def test_deep(self):
+        # Must not hit the recursion limit
+        depth = [ r for n, r in walk( [0], lambda n: (n, [n + 1] if n < 10000 else []) ) ]
+        self.assertEqual( depth[-1], 10000 )
+
+class TestPathMatcher(unittest.TestCase):
+    def test_legacy_wildcards(self):
+        names = ['a.dat', 'b.txt', 'c.dat', 'run-1']
+        m = PathMatcher('/data', only='*.dat')
+        self.assertEqual( m.select('/data', names, names),
+                          (['a.dat', 'c.dat'], ['a.dat', 'c.dat']) )
+        m = PathMatcher('file:///data', only=['*.dat', 'run-*'], ignore=['c*'])
+        self.assertEqual( m.select('file:///data/x', names, [])[0],
+                          ['a.dat', 'run-1'] )
+
+    def test_separate_rules(self):
+        m = PathMatcher( '/data', onlyFiles=['*.dat'], ignoreDirs=['tmp*'] )
+        self.assertEqual( m.select('/data', ['a.dat', 'b.txt'], ['run-1', 'tmp1']),
+                          (['a.dat'], ['run-1']) )
+
+    def test_anchored(self):
+        m = PathMatcher( '/data', onlyDirs=['run-*/raw/'], onlyFiles=['run-*/raw/*.dat']
+                       , ignoreDirs=['run-2'] )
+        # Parents of selected directories are listed, but not their files:
+        self.assertEqual( m.select('/data', ['a.dat'], ['run-1', 'run-2', 'misc']),
+                          ([], ['run-1']) )
+        self.assertEqual( m.select('/data/run-1', ['a.dat'], ['raw', 'cooked']),
+                          ([], ['raw']) )
+        # Selected directories content is considered with sub-directories:
+        self.assertEqual( m.select('/data/run-1/raw', ['a.dat', 'b.txt'], ['x']),
+                          (['a.dat'], ['x']) )
+        self.assertEqual( m.select('/data/run-1/raw/x', ['a.dat'], []),
+                          ([], []) )
+        # Wildcards do not match path separators:
+        m = PathMatcher( '/data', ignoreFiles=['*/*.tmp'] )
+        self.assertEqual( m.select('/data/a/b', ['x.tmp'], [])[0], ['x.tmp'] )
+        self.assertEqual( m.select('/data/a', ['x.tmp'], [])[0], [] )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, tempfile, shutil, os, hashlib
+from urlparse import urlparse
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from castlib3 import dbShim as DB
+from castlib3.models import DeclBase
+from castlib3.models.filesystem import Folder, File
+from castlib3.backend import gCastlibBackends
+from castlib3.filesystem import discover_entries
+from castlib3.stages.indexLocalDir import index_directory, index_directory_stream, \
+                                         unchanged_folders_lookup
+from castlib3.watch import DirectoryWatcher
+
+class TestIndexDirectory(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        DB.set_engine(self.engine)
+        DB.set_session(scoped_session(sessionmaker(bind=self.engine)))
+        DeclBase.metadata.create_all(self.engine)
+        self.root = tempfile.mkdtemp()
+        for p in ['run-1/a/x.dat', 'run-1/b.dat', 'run-2/c.dat', 'd.dat']:
+            p = os.path.join(self.root, p)
+            if not os.path.isdir(os.path.dirname(p)):
+                os.makedirs(os.path.dirname(p))
+            with open(p, 'wb') as f:
+                f.write( b'x'*len(p) )
+        self.backends = { 'file' : gCastlibBackends['file']() }
+
+    def _cached(self):
+        """
+        Returns sorted list of (path, size) pairs of cached files.
+        """
+        return sorted( (f.get_uri(), f.size) for f in DB.session.query(File) )
+
+    def _locations(self, **kwargs):
+        d = { 'localPath' : 'file://' + self.root }
+        d.update(kwargs)
+        return { 'root' : d }
+
+    def test_stream_matches_nested(self):
+        d, = discover_entries( self._locations(stats=True), backends=self.backends )
+        index_directory( d, self.backends['file'], syncFields=['size'] )
+        nested = self._cached()
+        self.assertEqual( len(nested), 4 )
+        DeclBase.metadata.drop_all(self.engine)
+        DeclBase.metadata.create_all(self.engine)
+        for traversal in ('dfs', 'bfs'):
+            d, = discover_entries( self._locations(stats=True, traversal=traversal)
+                                 , backends=self.backends, stream=True )
+            fe, rep = index_directory_stream( d['records'], self.backends['file']
+                                            , syncFields=['size'] )
+            self.assertEqual( nested, self._cached() )
+            self.assertEqual( fe.name, '/' )
+
+    def test_bulk_checksums(self):
+        backend = gCastlibBackends['file']( checksumWorkers=2, checksumProcesses=False )
+        d, = discover_entries( self._locations(), backends={'file' : backend} )
+        index_directory( d, backend, syncFields=['size', 'adler32'] )
+        for f in DB.session.query(File):
+            self.assertEqual( f.adler32, backend.get_adler32(f.get_uri()) )
+
+    def test_multiple_digests(self):
+        for workers in (0, 2):
+            backend = gCastlibBackends['file']( checksumWorkers=workers )
+            d, = discover_entries( self._locations(), backends={'file' : backend} )
+            index_directory( d, backend, syncFields=['adler32', 'md5'] )
+            for f in DB.session.query(File):
+                with open(urlparse(f.get_uri()).path, 'rb') as fl:
+                    self.assertEqual( f.md5, hashlib.md5(fl.read()).hexdigest() )
+                self.assertEqual( f.adler32, backend.get_adler32(f.get_uri()) )
+            DeclBase.metadata.drop_all(self.engine)
+            DeclBase.metadata.create_all(self.engine)
+
+    def test_incremental(self):
+        def _index(stream=False):
+            d, = discover_entries( self._locations(incremental=True)
+                                 , backends=self.backends, stream=stream
+                                 , unchanged=unchanged_folders_lookup() )
+            if stream:
+                fe, rep = index_directory_stream( d['records'], self.backends['file']
+                                                , syncFields=['size'] )
+            else:
+                fe, rep = index_directory( d, self.backends['file']
+                                         , syncFields=['size'] )
+            DB.session.commit()
+            return rep.nUnchanged
+        self.assertEqual( _index(), 0 )
+        full = self._cached()
+        self.assertEqual( _index(), 4 )
+        self.assertEqual( _index(stream=True), 4 )
+        self.assertEqual( self._cached(), full )
+        with open(os.path.join(self.root, 'run-2', 'e.dat'), 'wb') as f:
+            f.write(b'e')
+        self.assertEqual( _index(stream=True), 3 )
+        self.assertEqual( len(self._cached()), len(full) + 1 )
+
+    def test_watch_changes(self):
+        d, = discover_entries( self._locations(), backends=self.backends )
+        index_directory( d, self.backends['file'], syncFields=['size'] )
+        watcher = DirectoryWatcher( self.backends['file'], settle=0.2 )
+        watcher.add_location( self._locations(stats=True, ignore=['*.tmp'])['root'] )
+        try:
+            for p in ['run-1/a/y.dat', 'run-3/e/f.dat', 'run-2/c.dat', 'g.tmp']:
+                p = os.path.join(self.root, p)
+                if not os.path.isdir(os.path.dirname(p)):
+                    os.makedirs(os.path.dirname(p))
+                with open(p, 'ab') as f:
+                    f.write( b'y'*10 )
+            entries = watcher.poll( timeout=5 )
+        finally:
+            watcher.close()
+        self.assertEqual( len(entries), 1 )
+        index_directory( entries[0], self.backends['file'], syncFields=['size'] )
+        expected = []
+        for dirPath, _, files in os.walk(self.root):
+            expected += [ ('file://' + os.path.join(dirPath, f)
+                          , os.path.getsize(os.path.join(dirPath, f))) \
+                          for f in files if not f.endswith('.tmp') ]
+        self.assertEqual( self._cached(), sorted(expected) )
+
+    def tearDown(self):
+        DB.session.remove()
+        shutil.rmtree(self.root)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -22,7 +22,7 @@
 from __future__ import print_function
 import unittest
 
-from castlib3.models import DeclBase
+from castlib3.models import DeclBase, upgrade_schema
 from castlib3.models.filesystem import Folder, File
 
 class TestFilesystemModel(unittest.TestCase):
@@ -91,6 +91,21 @@ class TestFilesystemModel(unittest.TestCase):
     def tearDown(self):
         self.session.close()
 
+class TestSchemaUpgrade(unittest.TestCase):
+    def test_missing_columns(self):
+        from sqlalchemy import create_engine, inspect
+        engine = create_engine('sqlite:///:memory:')
+        DeclBase.metadata.create_all(engine)
+        # Files table as it was before checksum columns were introduced:
+        engine.execute( 'DROP TABLE files' )
+        engine.execute( 'CREATE TABLE files (id INTEGER NOT NULL PRIMARY KEY'
+                        ', size INTEGER, adler32 VARCHAR)' )
+        self.assertEqual( sorted(upgrade_schema(engine)),
+                          ['files.crc32c', 'files.md5'] )
+        self.assertEqual( set(c['name'] for c in inspect(engine).get_columns('files')),
+                          set(['id', 'size', 'adler32', 'md5', 'crc32c']) )
+        self.assertEqual( upgrade_schema(engine), [] )
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, time, threading, subprocess, tempfile, shutil, os, json
+
+from concurrent.futures import ThreadPoolExecutor
+
+import castlib3.shell
+from castlib3.syscfg import gConfig
+from castlib3.shell import invoke_util, invoke_util_many, iter_invoke_util, \
+                           iter_util_lines, TimeoutError, TimeoutPopen, \
+                           gTimeoutReaper
+from castlib3.coprocess import Coprocess
+from castlib3.metrics import gUtilMetrics
+
+class TestInvokeUtilMany(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(gConfig)
+        gConfig['utils'] = {
+                'echo' : ('echo {word}', r'^(?P<word>\w+)$'),
+                'sleep' : 'sleep {secs}',
+                'false' : 'false'
+            }
+        gConfig['timeouts'] = { 'shortSec' : 1, 'longSec' : 5 }
+
+    def test_results(self):
+        self.assertEqual( invoke_util('echo', word='one'), [{'word' : 'one'}] )
+        calls = [ ('echo', {'word' : 'w%d'%n}) for n in range(20) ]
+        nThreads = threading.active_count()
+        self.assertEqual( invoke_util_many( calls, nConcurrent=4 ),
+                [ [{'word' : 'w%d'%n}] for n in range(20) ] )
+        self.assertLessEqual( threading.active_count(), nThreads )
+        # Raw output and noexcept:
+        self.assertEqual( invoke_util_many( [ ('echo', {'word' : 'x', 'applyRegexOn' : None})
+                                            , ('false', {'noexcept' : True}) ] ),
+                [ (0, 'x\n', ''), (1, '', '') ] )
+        with self.assertRaises( RuntimeError ):
+            invoke_util_many( [('false', {})] )
+
+    def test_concurrency(self):
+        started = time.time()
+        order = [ n for n, _ in iter_invoke_util(
+                    [ ('sleep', {'secs' : s}) for s in (0.6, 0.1, 0.3, 0.1) ]
+                    , nConcurrent=4 ) ]
+        self.assertLess( time.time() - started, 1. )
+        self.assertEqual( order[-1], 0 )
+        with self.assertRaises( TimeoutError ):
+            invoke_util_many( [ ('sleep', {'secs' : 3}), ('sleep', {'secs' : 0}) ] )
+
+    def tearDown(self):
+        gConfig.clear()
+        gConfig.update( self.config )
+
+class TestUtilLines(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(gConfig)
+        gConfig['utils'] = {
+                'seq' : ('seq {n}', r'^(?P<n>\d*[05])$'),
+                'ls' : 'ls {path}'
+            }
+        gConfig['timeouts'] = { 'shortSec' : 2, 'longSec' : 5 }
+
+    def test_streaming(self):
+        self.assertEqual( list(iter_util_lines('seq', n=12, applyRegexOn=None)),
+                [ str(n) for n in range(1, 13) ] )
+        self.assertEqual( list(iter_util_lines('seq', n=20)),
+                [ {'n' : str(n)} for n in (5, 10, 15, 20) ] )
+        # Records are yielded before the output is over:
+        lines = iter_util_lines( 'seq', n=10**7, applyRegexOn=None )
+        self.assertEqual( [ next(lines) for _ in range(3) ], ['1', '2', '3'] )
+        lines.close()
+        with self.assertRaises( RuntimeError ):
+            list(iter_util_lines( 'ls', path='/nonexistent' ))
+        self.assertEqual( list(iter_util_lines( 'ls', path='/nonexistent'
+                                              , noexcept=True )), [] )
+
+    def test_no_communicate(self):
+        self.assertEqual( invoke_util('seq', n=3, applyRegexOn=None
+                                     , communicate=False)[1], '1\n2\n3\n' )
+
+    def tearDown(self):
+        gConfig.clear()
+        gConfig.update( self.config )
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(gConfig)
+        gConfig['utils'] = {
+                'seq' : ('seq {n}', r'^(?P<n>\d+)$'),
+                'ls' : 'ls {path}',
+                'sleep' : 'sleep {secs}'
+            }
+        gConfig['timeouts'] = { 'shortSec' : 1, 'longSec' : 5 }
+        gUtilMetrics.reset()
+        self.tmpDir = tempfile.mkdtemp()
+
+    def test_metrics(self):
+        invoke_util( 'seq', n=3 )
+        list(iter_util_lines( 'seq', n=10 ))
+        invoke_util( 'ls', path='/nonexistent', noexcept=True )
+        with self.assertRaises( TimeoutError ):
+            invoke_util_many( [('sleep', {'secs' : 3}), ('seq', {'n' : 1})] )
+        m = gUtilMetrics.as_dict()
+        self.assertEqual( m['seq']['calls'], 3 )
+        self.assertEqual( m['seq']['stdoutBytes'], len('1\n2\n3\n') + 21 + 2 )
+        self.assertEqual( m['seq']['returnCodes'], {'0' : 3} )
+        self.assertEqual( m['ls']['returnCodes'].keys(), ['2'] )
+        self.assertGreater( m['ls']['stderrBytes'], 0 )
+        self.assertEqual( (m['sleep']['timeouts'], m['sleep']['returnCodes']), (1, {}) )
+        self.assertEqual( m['sleep']['buckets']['5.0'], 1 )
+        self.assertIn( 'timeouts', gUtilMetrics.summary() )
+        jsonPath = os.path.join(self.tmpDir, 'metrics.json')
+        gUtilMetrics.dump( jsonPath )
+        with open(jsonPath) as f:
+            self.assertEqual( json.load(f)['seq']['calls'], 3 )
+        promPath = os.path.join(self.tmpDir, 'metrics.prom')
+        gUtilMetrics.dump( promPath )
+        with open(promPath) as f:
+            text = f.read()
+        self.assertIn( 'castlib3_util_duration_seconds_count{util="seq"} 3\n', text )
+        self.assertIn( 'castlib3_util_duration_seconds_bucket{util="sleep",le="+Inf"} 1\n', text )
+        self.assertIn( 'castlib3_util_timeouts_total{util="sleep"} 1\n', text )
+        self.assertEqual( os.listdir(self.tmpDir), ['metrics.json', 'metrics.prom'] )
+
+    def test_per_run(self):
+        from castlib3.stage import Stages
+        gConfig['metrics'] = { 'dump' : os.path.join(self.tmpDir, 'metrics.json') }
+        for n in (2, 1):
+            for _ in range(n):
+                invoke_util( 'seq', n=1 )
+            Stages([])()
+            # Each run is dumped on its own:
+            with open(gConfig['metrics']['dump']) as f:
+                self.assertEqual( json.load(f)['seq']['calls'], n )
+        self.assertFalse( gUtilMetrics )
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpDir )
+        gUtilMetrics.reset()
+        gConfig.clear()
+        gConfig.update( self.config )
+
+class TestTimeoutReaper(unittest.TestCase):
+    def test_many_children(self):
+        nTimeouts, nThreads = gTimeoutReaper.nTimeouts, threading.active_count()
+        started = time.time()
+        ps = [ TimeoutPopen( 'sleep', '%d'%(3 if n%2 else 0)
+                           , timeout=1, stdout=subprocess.PIPE )
+               for n in range(40) ]
+        self.assertLessEqual( threading.active_count(), nThreads + 1 )
+        nRaised = 0
+        # Finished ones are waited first (unwaited child expires as well):
+        for p in ps[::2] + ps[1::2]:
+            try:
+                p.communicate()
+            except TimeoutError:
+                nRaised += 1
+        self.assertLess( time.time() - started, 2.5 )
+        self.assertEqual( nRaised, 20 )
+        self.assertEqual( gTimeoutReaper.nTimeouts - nTimeouts, 20 )
+        self.assertEqual( len(gTimeoutReaper), 0 )
+
+    def test_no_communicate(self):
+        gConfig['timeouts'] = { 'shortSec' : 1, 'longSec' : 5 }
+        try:
+            p = TimeoutPopen( 'true' )
+            p.wait()
+            self.assertIsNone( p.timer )
+        finally:
+            del gConfig['timeouts']
+
+class TestCoprocesses(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(gConfig)
+        gConfig['utils'] = {
+                'echo' : ('echo {word}', r'^(?P<word>\w+)$'),
+                'printf' : 'printf {fmt}',
+                'ls' : 'ls {path}',
+                'sleep' : 'sleep {secs}'
+            }
+        gConfig['timeouts'] = { 'shortSec' : 1, 'longSec' : 5 }
+        gConfig['coprocesses'] = { 'utils' : gConfig['utils'].keys()
+                                 , 'nProcesses' : 2 }
+
+    def test_protocol(self):
+        cp = Coprocess()
+        self.assertEqual( cp.run(['printf', 'no newline'], 1), (0, 'no newline', '') )
+        self.assertEqual( cp.run(['printf', 'a\n\nb\n\n'], 1), (0, 'a\n\nb\n\n', '') )
+        rc, out, err = cp.run(['ls', '/nonexistent'], 1)
+        self.assertNotEqual( rc, 0 )
+        self.assertEqual( out, '' )
+        self.assertIn( 'nonexistent', err )
+        big = 'x'*300000
+        self.assertEqual( cp.run(['printf', big], 5), (0, big, '') )
+        self.assertEqual( cp.nCommands, 4 )
+        cp.close()
+
+    def test_pool(self):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map( lambda n: invoke_util('echo', word='w%d'%n)
+                                   , range(20) ))
+        self.assertEqual( results, [ [{'word' : 'w%d'%n}] for n in range(20) ] )
+        pool = castlib3.shell.gCoprocessPool
+        self.assertEqual( pool.nCommands, 20 )
+        self.assertLessEqual( pool._nSpawned, 2 )
+        self.assertEqual( invoke_util('ls', path='/nonexistent', noexcept=True)[1], '' )
+        nTimeouts = gTimeoutReaper.nTimeouts
+        gUtilMetrics.reset()
+        with self.assertRaises( TimeoutError ):
+            invoke_util('sleep', secs=3)
+        self.assertEqual( pool.nTimeouts, 1 )
+        # Counted the same way as timeouts of TimeoutPopen children:
+        self.assertEqual( gTimeoutReaper.nTimeouts, nTimeouts + 1 )
+        self.assertEqual( gUtilMetrics.as_dict()['sleep']['timeouts'], 1 )
+        # Killed coprocess is replaced:
+        self.assertEqual( invoke_util('echo', word='again'), [{'word' : 'again'}] )
+
+    def tearDown(self):
+        if castlib3.shell.gCoprocessPool is not None:
+            castlib3.shell.gCoprocessPool.close()
+            castlib3.shell.gCoprocessPool = None
+        gConfig.clear()
+        gConfig.update( self.config )
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(gConfig)
+        self.tmpDir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpDir, 'utils.jsonl')
+        gConfig['utils'] = {
+                'seq' : ('seq {n}', r'^(?P<n>\d+)$'),
+                'ls' : 'ls {path}',
+                'printf' : 'printf {s}',
+                'sleep' : 'sleep {secs}'
+            }
+        gConfig['timeouts'] = { 'shortSec' : 1, 'longSec' : 5 }
+
+    def _use(self, mode, **kwargs):
+        self._eject()
+        gConfig['cassette'] = dict( file=self.filename, mode=mode, **kwargs )
+
+    def _eject(self):
+        if castlib3.shell.gCassette is not None:
+            castlib3.shell.gCassette.close()
+            castlib3.shell.gCassette = None
+
+    def _run(self):
+        ret = [ invoke_util('seq', n=3)
+              , invoke_util('ls', path='/nonexistent', noexcept=True)[0] != 0
+              , invoke_util('printf', s='\\377\\n', applyRegexOn=None)
+              , invoke_util('seq', n=2, applyRegexOn=None, communicate=False)[1]
+              , list(iter_util_lines('seq', n=4, applyRegexOn=None))
+              , invoke_util_many([ ('seq', {'n' : n}) for n in (1, 2) ]) ]
+        with self.assertRaises( TimeoutError ):
+            invoke_util('sleep', secs=3)
+        return ret
+
+    def test_record_replay(self):
+        self._use('record')
+        recorded = self._run()
+        self.assertEqual( castlib3.shell.gCassette.nRecorded, 8 )
+        self.assertEqual( recorded[2], (0, '\xff\n', '') )
+        # Utils are not run on replay:
+        self._use('replay')
+        def _no_popen( *args, **kwargs ):
+            raise AssertionError( 'Util is run on replay.' )
+        castlib3.shell.TimeoutPopen = _no_popen
+        try:
+            started = time.time()
+            self.assertEqual( self._run(), recorded )
+        finally:
+            castlib3.shell.TimeoutPopen = TimeoutPopen
+        self.assertLess( time.time() - started, 0.5 )
+        self.assertEqual( castlib3.shell.gCassette.nReplayed, 8 )
+        with self.assertRaises( RuntimeError ):
+            invoke_util('seq', n=5)
+
+    def test_latency(self):
+        self._use('record')
+        invoke_util('sleep', secs=0.3)
+        self._use('replay', latency=True)
+        started = time.time()
+        invoke_util('sleep', secs=0.3)
+        self.assertGreaterEqual( time.time() - started, 0.3 )
+
+    def tearDown(self):
+        self._eject()
+        shutil.rmtree(self.tmpDir)
+        gConfig.clear()
+        gConfig.update( self.config )
+
+if __name__ == "__main__":
+    unittest.main()
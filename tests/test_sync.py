@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, tempfile, shutil, os, filecmp
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from castlib3 import dbShim as DB
+from castlib3.models import DeclBase
+from castlib3.models.filesystem import File
+from castlib3.backend import gCastlibBackends
+from castlib3.filesystem import discover_entries
+from castlib3.stages.indexLocalDir import index_directory
+from castlib3.stages.select import gComparators, get_location_by_path
+from castlib3.stages.sync import Sync
+
+class TestSyncRewrite(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        DB.set_engine(self.engine)
+        DB.set_session(scoped_session(sessionmaker(bind=self.engine)))
+        DeclBase.metadata.create_all(self.engine)
+        self.root = tempfile.mkdtemp()
+        self.data = os.urandom(10*4096 + 100)
+        for loc, data in ( ('ref', self.data)
+                         , ('dst', b'hdr' + self.data[3:]) ):
+            os.mkdir( os.path.join(self.root, loc) )
+            with open(os.path.join(self.root, loc, 'a.dat'), 'wb') as f:
+                f.write( data )
+        self.backend = gCastlibBackends['file']( deltaBlockSize=4096 )
+        self.backends = { 'file' : self.backend }
+
+    def _index(self):
+        d, = discover_entries( { 'root' : { 'localPath' : 'file://' + self.root } }
+                             , backends=self.backends )
+        index_directory( d, self.backend, syncFields=['size', 'modified', 'adler32'] )
+        DB.session.commit()
+
+    def test_same_size_patch(self):
+        self._index()
+        refLoc, dstLoc = [ get_location_by_path( os.path.join(self.root, loc) )
+                           for loc in ('ref', 'dst') ]
+        self.assertEqual( gComparators['size']( refLoc, dstLoc ).count(), 0 )
+        mismatches = gComparators['adler32']( refLoc, dstLoc )
+        self.assertEqual( mismatches.count(), 1 )
+        deleted = []
+        self.backend.del_file = lambda p: deleted.append(p)
+        Sync().sync_adler32( mismatches, refLoc, dstLoc, backends=self.backends )
+        DB.session.commit()
+        self.assertEqual( deleted, [] )  # patched in place, not re-copied
+        self.assertTrue( filecmp.cmp( os.path.join(self.root, 'ref', 'a.dat')
+                                    , os.path.join(self.root, 'dst', 'a.dat')
+                                    , shallow=False ) )
+        self.assertEqual( gComparators['adler32']( refLoc, dstLoc ).count(), 0 )
+
+    def test_size_mismatch_excluded(self):
+        with open(os.path.join(self.root, 'dst', 'a.dat'), 'ab') as f:
+            f.write( b'tail' )
+        self._index()
+        refLoc, dstLoc = [ get_location_by_path( os.path.join(self.root, loc) )
+                           for loc in ('ref', 'dst') ]
+        # Rewritten once by the size comparison, not twice:
+        self.assertEqual( gComparators['size']( refLoc, dstLoc ).count(), 1 )
+        self.assertEqual( gComparators['adler32']( refLoc, dstLoc ).count(), 0 )
+
+    def test_duplicate_destinations(self):
+        os.mkdir( os.path.join(self.root, 'new') )
+        self._index()
+        refLoc, dstLoc, newLoc = [ get_location_by_path( os.path.join(self.root, loc) )
+                                   for loc in ('ref', 'dst', 'new') ]
+        # Same-named files of different locations are uploaded to the same
+        # destination; the duplicate has to be skipped:
+        files = [ DB.session.query(File).filter_by(parent=loc).one()
+                  for loc in (refLoc, dstLoc) ]
+        class Mismatches(list):
+            def count(self):
+                return len(self)
+        uploaded = []
+        cpy_file = self.backend.cpy_file
+        self.backend.cpy_file = lambda src, dst, **kw: uploaded.append(src) \
+                                                    or cpy_file(src, dst, **kw)
+        Sync().sync_missing( Mismatches( (f, None) for f in files ), refLoc, newLoc
+                           , backends=self.backends, extractChecksumOnUpload=False )
+        DB.session.commit()
+        self.assertEqual( uploaded, [files[0].get_uri()] )
+        self.assertEqual( DB.session.query(File).filter_by(parent=newLoc).count(), 1 )
+        self.assertTrue( filecmp.cmp( os.path.join(self.root, 'ref', 'a.dat')
+                                    , os.path.join(self.root, 'new', 'a.dat')
+                                    , shallow=False ) )
+
+    def tearDown(self):
+        DB.session.remove()
+        shutil.rmtree(self.root)
+
+if __name__ == "__main__":
+    unittest.main()
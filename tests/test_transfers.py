@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Renat R. Dusaev <crank@qcrypt.org>
+# Author: Renat R. Dusaev <crank@qcrypt.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function
+import unittest, threading, time
+
+from castlib3.transfers import TransferScheduler
+
+class TestTransferScheduler(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.maxRunning = {}
+        self.attempts = {}
+
+    def _transfer(self, destination, name, nFailures=0):
+        with self.lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            attempt = self.attempts[name]
+            for k in (destination, None):
+                self.running[k] = self.running.get(k, 0) + 1
+                self.maxRunning[k] = max(self.maxRunning.get(k, 0), self.running[k])
+        time.sleep(.02)
+        with self.lock:
+            for k in (destination, None):
+                self.running[k] -= 1
+        if attempt <= nFailures:
+            raise IOError( 'Transfer of %s failed.'%name )
+        return name.upper()
+
+    def test_limits(self):
+        jobs = [ (d, '%s-%d'%(d, n), self._transfer, (d, '%s-%d'%(d, n)))
+                 for n in range(6) for d in ('castor', 'file') ]
+        s = TransferScheduler( nTransfers=4, perDestination={'castor' : 1} )
+        results = list(s.run( iter(jobs) ))
+        self.assertEqual( sorted(r[0] for r in results), sorted(j[1] for j in jobs) )
+        self.assertTrue( all( r[1] == r[0].upper() and r[2] is None for r in results ) )
+        self.assertEqual( self.maxRunning['castor'], 1 )
+        self.assertEqual( self.maxRunning[None], 4 )
+        self.assertEqual( s.nDone, 12 )
+
+    def test_retries(self):
+        jobs = [ ('file', 'flaky', self._transfer, ('file', 'flaky', 2))
+               , ('file', 'broken', self._transfer, ('file', 'broken', 10))
+               , ('file', 'fine', self._transfer, ('file', 'fine')) ]
+        s = TransferScheduler( nTransfers=2, retries=2, backoff=.01 )
+        results = dict( (r[0], r[1:]) for r in s.run(jobs) )
+        self.assertEqual( results['flaky'], ('FLAKY', None) )
+        self.assertEqual( results['fine'], ('FINE', None) )
+        self.assertIsNone( results['broken'][0] )
+        self.assertIsInstance( results['broken'][1], IOError )
+        self.assertEqual( (self.attempts['flaky'], self.attempts['broken']), (3, 3) )
+        self.assertEqual( str(s), '2 done, 4 retried, 1 failed' )
+
+if __name__ == "__main__":
+    unittest.main()